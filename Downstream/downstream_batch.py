@@ -0,0 +1,261 @@
+#!/home/siyi.sun/miniconda3/bin python3
+# -*- coding: UTF-8 -*-
+"""
+@Description :   Run the downstream RF task on many imputed datasets in one batch
+@Author      :   siyi.sun
+@Time        :   2025/03/15 18:26:07
+"""
+
+import re
+import sys
+import glob
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import StandardScaler
+from category_encoders.leave_one_out import LeaveOneOutEncoder
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import average_precision_score, roc_auc_score
+from imblearn.over_sampling import SMOTE
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "Python_code"))
+from utils.mask_store import load_mask
+from utils.table_store import read_table
+
+target = "cat_IS_HEALTHY"
+# 1. if it's binary string -> map to 0,1 (the dominant category as 0)
+convert_to_int_dict = {'URBAN': 1, 'RURAL': 0, # cat_REGION_TYPE
+                       'Immigrated': 1, 'Member of the household': 0, # cat_MEM_STATUS
+                       'M': 0, 'F': 1} # cat_GENDER
+# 3. if it's multiclass (>4) -> Leave one out encoder
+categorical_features = ["cat_STATE", "cat_HR", "cat_RELIGION", "cat_PLACE_OF_WORK"]
+# Columns the masks never touch (1-based positions 1, 2, 3, 4, 7 of the cohort)
+default_fixed_features = ["con_WAVE_NO", "cat_STATE", "cat_HR", "cat_REGION_TYPE", "cat_GENDER"]
+
+# Imputed datasets are found under data_{method}/{cohort}/{cohort}_all/{mechanism}/miss{ratio}/{sample}
+file_pattern = re.compile(
+    r".*data_(?P<method>[a-z]+)/(?P<cohort>\w+)/(?P=cohort)_all/(?P<mechanism>\w+)/miss(?P<ratio>\d+)/(?P<sample>\d+)\.\w+"
+)
+
+# Fixed preprocessing of each worker, keyed by the hash of the training target
+_fixed_cache = {}
+
+
+def prepare_data(data):
+    """Same cleaning as downstream_RF.py: drop the constant column and map binary strings"""
+    # don't need EMPLOYMENT_STATUS, because it only has one same value
+    data = data.drop(["cat_EMPLOYMENT_STATUS"], axis=1, errors="ignore")
+    for col in ['cat_REGION_TYPE', 'cat_MEM_STATUS', 'cat_GENDER']:
+        data[col] = data[col].map(convert_to_int_dict)
+    return data
+
+
+def return_feature_blocks(columns, binary_passthrough=True):
+    """
+    Output columns of the ColumnTransformer of the single-file scripts, in order:
+    leave-one-out encoded multiclass columns, binary columns (passthrough, RF script
+    only) and standardized continuous columns.
+    """
+    features = [col for col in columns if col != target]
+    blocks = [("cat", col) for col in categorical_features]
+    if binary_passthrough:
+        blocks += [("binary_cat", col) for col in features if col[:3] == 'cat' and col not in categorical_features]
+    blocks += [("num", col) for col in features if col[:3] == 'con']
+    return blocks
+
+
+def fit_transform_block(kind, columns, X_train, y_train, X_test):
+    """Fit the transformer of one block on the training rows, return both transformed sets"""
+    if kind == "cat":
+        encoder = LeaveOneOutEncoder(cols=columns, random_state=42, sigma=0.05)
+        train = encoder.fit_transform(X_train[columns], y_train)
+        test = encoder.transform(X_test[columns])
+        return train.to_numpy(dtype=np.float64), test.to_numpy(dtype=np.float64)
+    if kind == "num":
+        scaler = StandardScaler()
+        train = scaler.fit_transform(X_train[columns])
+        return train, scaler.transform(X_test[columns])
+    return X_train[columns].to_numpy(dtype=np.float64), X_test[columns].to_numpy(dtype=np.float64)
+
+
+def transform_features(blocks, X_train, y_train, X_test, fixed_cache, fixed_features):
+    """
+    Transform every block, taking the never-imputed columns from `fixed_cache`.
+    The leave-one-out encoding uses the target, so the cache is only valid for the
+    training target it was fitted with. The noise of the leave-one-out encoder is drawn
+    per encoder, so results match the single-file scripts exactly only without fixed columns.
+
+    Returns:
+        train (np.ndarray), test (np.ndarray)
+    """
+    train_columns, test_columns = [], []
+    for kind in ["cat", "binary_cat", "num"]:
+        columns = [col for k, col in blocks if k == kind]
+        imputed = [col for col in columns if col not in fixed_features]
+        fixed = [col for col in columns if col in fixed_features]
+        if not columns:
+            continue
+
+        parts = {}
+        if imputed:
+            train, test = fit_transform_block(kind, imputed, X_train, y_train, X_test)
+            parts.update({col: (train[:, j], test[:, j]) for j, col in enumerate(imputed)})
+        for col in fixed:
+            if (kind, col) not in fixed_cache:
+                train, test = fit_transform_block(kind, [col], X_train, y_train, X_test)
+                fixed_cache[(kind, col)] = (train[:, 0], test[:, 0])
+            parts[col] = fixed_cache[(kind, col)]
+
+        train_columns += [parts[col][0] for col in columns]
+        test_columns += [parts[col][1] for col in columns]
+    return np.column_stack(train_columns), np.column_stack(test_columns)
+
+
+def load_completed(path, base_path):
+    """
+    Load an imputed dataset as a complete one. The imputed files only hold the
+    previously missing values, so the observed values come from the full data.
+    """
+    match = file_pattern.fullmatch(Path(path).as_posix())
+    imputed = read_table(path)
+    if base_path is None or match is None:
+        return imputed, match
+
+    truth = read_table(base_path / f"Completed_data/{match['cohort']}/{match['cohort']}_all")
+    mask, mask_columns = load_mask(
+        base_path, match["cohort"], match["mechanism"], int(match["ratio"]), int(match["sample"])
+    )
+    mask = pd.DataFrame(mask, columns=mask_columns)
+    completed = truth.copy()
+    for col in truth.columns:
+        completed[col] = truth[col].mask(mask[col], imputed[col])
+    return completed, match
+
+
+def evaluate_file(path, base_path, train_index, test_index, binary_passthrough, n_jobs,
+                  fixed_features=default_fixed_features):
+    """Fit and score the downstream task on one dataset, with its timing"""
+    start = time.time()
+    data, match = load_completed(path, base_path)
+    data = prepare_data(data)
+    X, y = data.drop(target, axis=1), data[target].astype(int)
+    X_train, X_test = X.iloc[train_index], X.iloc[test_index]
+    y_train, y_test = y.iloc[train_index], y.iloc[test_index]
+    load_time = time.time() - start
+
+    # Never-imputed columns are transformed once per worker and training target
+    key = (binary_passthrough, tuple(fixed_features),
+           hashlib.sha1(y_train.to_numpy().tobytes()).hexdigest())
+    fixed_cache = _fixed_cache.setdefault(key, {})
+    blocks = return_feature_blocks(data.columns, binary_passthrough)
+    start = time.time()
+    train, test = transform_features(blocks, X_train, y_train, X_test, fixed_cache, fixed_features)
+    transform_time = time.time() - start
+
+    start = time.time()
+    train, y_res = SMOTE(random_state=42, sampling_strategy=0.5).fit_resample(train, y_train)
+    classifier = RandomForestClassifier(
+        random_state=42,
+        class_weight='balanced',  # Use balanced class weights
+        n_estimators=200,         # Increase number of trees
+        max_depth=None,           # Allow deep trees to capture rare patterns
+        min_samples_leaf=1,       # Allow leaf nodes to be smaller
+        n_jobs=n_jobs,
+    )
+    classifier.fit(train, y_res)
+    fit_time = time.time() - start
+
+    start = time.time()
+    y_pred_proba = classifier.predict_proba(test)[:, 1]
+    predict_time = time.time() - start
+
+    record = {
+        "file": str(path),
+        "impute_method": match["method"] if match else None,
+        "cohort": match["cohort"] if match else None,
+        "missing_mechanism": match["mechanism"] if match else None,
+        "missing_ratio": int(match["ratio"]) if match else None,
+        "sample": int(match["sample"]) if match else None,
+        "roc_auc": roc_auc_score(y_test, y_pred_proba),
+        "average_precision": average_precision_score(y_test, y_pred_proba),
+        "load_time": load_time,
+        "transform_time": transform_time,
+        "fit_time": fit_time,
+        "predict_time": predict_time,
+    }
+    return record
+
+
+def return_split_indices(reference, n_rows, split_file=None):
+    """
+    Stratified 80/20 split shared by all the datasets, on the target of the reference
+    dataset. It is saved to `split_file` and reused when that file exists.
+    """
+    if split_file is not None and Path(split_file).exists():
+        with np.load(split_file) as split:
+            return split["train_index"], split["test_index"]
+    y = prepare_data(read_table(reference))[target].astype(int)
+    train_index, test_index = train_test_split(
+        np.arange(n_rows), test_size=0.2, random_state=42, stratify=y
+    )
+    if split_file is not None:
+        np.savez(split_file, train_index=train_index, test_index=test_index)
+    return train_index, test_index
+
+
+def run_batch(args):
+    """Evaluate every file of the glob in a process pool and save one results table"""
+    files = sorted(glob.glob(args.files, recursive=True))
+    if not files:
+        raise ValueError(f"No dataset matches {args.files}")
+    base_path = Path(args.base_path) if args.base_path else None
+
+    # Without a reference, the split follows the full data of the first dataset's cohort
+    reference = args.reference or files[0]
+    match = file_pattern.fullmatch(Path(files[0]).as_posix())
+    if args.reference is None and base_path is not None and match is not None:
+        reference = base_path / f"Completed_data/{match['cohort']}/{match['cohort']}_all"
+    n_rows = len(read_table(reference, columns=[target]))
+    train_index, test_index = return_split_indices(reference, n_rows, args.split_file)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        records = list(executor.map(
+            evaluate_file,
+            files,
+            [base_path] * len(files),
+            [train_index] * len(files),
+            [test_index] * len(files),
+            [args.script == "RF"] * len(files),
+            [args.n_jobs] * len(files),
+            [args.fixed_features] * len(files),
+        ))
+
+    results = pd.DataFrame(records)
+    results.to_csv(args.output_file, index=False)
+    print(results[["file", "roc_auc", "average_precision", "fit_time"]].to_string(index=False))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='argparse')
+    parser.add_argument('--files', '-f', type=str, required=True,
+                        help="Glob of the datasets, e.g. 'data_stored/data_*/C19/C19_all/*/miss*/*.csv'.")
+    parser.add_argument('--base_path', type=str, default=None,
+                        help="The data_stored folder; imputed files are completed with its full data and masks.")
+    parser.add_argument('--reference', type=str, default=None,
+                        help="The dataset whose target defines the shared split (default: the full data, or the first file).")
+    parser.add_argument('--split_file', type=str, default=None, help="Where to save/reuse the split indices.")
+    parser.add_argument('--script', type=str, default="RF", choices=["RF", "XGBoost"],
+                        help="The pipeline to reproduce: RF keeps the binary columns, XGBoost drops them.")
+    parser.add_argument('--fixed_features', nargs='*', default=default_fixed_features,
+                        help="Never-imputed columns whose preprocessing is cached (none to disable).")
+    parser.add_argument('--workers', type=int, default=4, help="Num of datasets evaluated in parallel.")
+    parser.add_argument('--n_jobs', type=int, default=1, help="Num of threads of each random forest.")
+    parser.add_argument('--output_file', '-o', type=str, default="downstream_results.csv")
+    args = parser.parse_args()
+    run_batch(args)
@@ -5,61 +5,143 @@
 @Author      :   siyi.sun
 @Time        :   2024/12/09 15:40:24
 """
+import os
+import argparse
+import numpy as np
 import pandas as pd
-data = pd.read_csv('data_need.csv', usecols=[0,1,2], index_col=0)
-data.columns = ['WAVE_NO','HH_ID']
-data = data.drop_duplicates()
-
-# Ensure the data is sorted by WAVE_NO and HH_ID
-data = data.sort_values(by=['WAVE_NO', 'HH_ID'])
-
-# Create a set of all households observed in previous waves
-all_previous_households = set()
-
-# Initialize a dictionary to store the results
-wave_stats = []
-
-# Iterate through each wave
-for wave, group in data.groupby('WAVE_NO'):
-    # Get households in the current wave
-    current_households = set(group['HH_ID'])
-    
-    # Calculate the number of households taking the survey in the current wave
-    num_current = len(current_households)
-    
-    # Calculate disappeared households
-    if wave > data['WAVE_NO'].min():
-        prev_wave_households = data[data['WAVE_NO'] == wave - 1]['HH_ID']
-        disappeared = set(prev_wave_households) - current_households
-        num_disappeared = len(disappeared)
-    else:
-        num_disappeared = 0
-
-    # Calculate new households
-    new_households = current_households - all_previous_households
-    num_new = len(new_households)
-    
-    # Calculate households that are back
-    if wave > data['WAVE_NO'].min():
-        back_households = all_previous_households - set(prev_wave_households)
-        num_back = len(back_households & current_households)
+
+NEVER = -1  # last_seen of a household not observed yet
+
+
+def read_waves(file):
+    """Read the (WAVE_NO, HH_ID) pairs of a file, one row per household and wave"""
+    data = pd.read_csv(file, usecols=[0, 1, 2], index_col=0)
+    data.columns = ['WAVE_NO', 'HH_ID']
+    return data.drop_duplicates()
+
+
+def new_state():
+    """Empty churn state: household ids and the last wave each one was seen in"""
+    return {
+        'hh_ids': pd.Index([]),
+        'last_seen': np.zeros(0, dtype=np.int64),
+        'first_seen': np.zeros(0, dtype=np.int64),
+        'last_wave': None,
+        'last_total': 0,
+    }
+
+
+def update_state(state, data):
+    """
+    Add the waves of `data` to the churn state and return their statistics.
+
+    Households are factorized to integer codes and the data is sorted by wave once;
+    each wave is then a slice of codes, and its counts come from comparisons against
+    the last-seen wave of those households:
+    - New_IN: never seen before
+    - Back: seen before, but not in the previous wave
+    - Disappeared: in the previous wave, but not in this one
+
+    Args:
+        state (dict): Churn state from new_state() or load_state(), updated in place
+        data (pd.DataFrame): WAVE_NO and HH_ID of waves after state['last_wave']
+
+    Returns:
+        list: Statistics of each new wave
+    """
+    # Extend the household table with the ids not seen yet
+    hh_ids = state['hh_ids'].append(pd.Index(data['HH_ID'].unique())).unique()
+    n_new_ids = len(hh_ids) - len(state['hh_ids'])
+    state['hh_ids'] = hh_ids
+    state['last_seen'] = np.append(state['last_seen'], np.full(n_new_ids, NEVER))
+    state['first_seen'] = np.append(state['first_seen'], np.full(n_new_ids, NEVER))
+
+    codes = hh_ids.get_indexer(data['HH_ID'])
+    waves = data['WAVE_NO'].to_numpy(dtype=np.int64)
+    if state['last_wave'] is not None and (waves <= state['last_wave']).any():
+        raise ValueError(f"Waves up to {state['last_wave']} are already counted")
+
+    # Sort once by wave, then every wave is a contiguous slice of household codes
+    order = np.argsort(waves, kind='stable')
+    codes, waves = codes[order], waves[order]
+    wave_values, starts = np.unique(waves, return_index=True)
+    ends = np.append(starts[1:], len(waves))
+
+    wave_stats = []
+    for wave, start, end in zip(wave_values, starts, ends):
+        current = codes[start:end]
+        last_seen = state['last_seen'][current]
+
+        in_prev = last_seen == wave - 1
+        prev_total = state['last_total'] if state['last_wave'] == wave - 1 else 0
+        num_new = int(np.sum(last_seen == NEVER))
+
+        wave_stats.append({
+            'WAVE_NO': int(wave),
+            'Total': len(current),
+            'Disappeared': prev_total - int(np.sum(in_prev)),
+            'New_IN': num_new,
+            'Back': len(current) - num_new - int(np.sum(in_prev)),
+        })
+
+        state['first_seen'][current[last_seen == NEVER]] = wave
+        state['last_seen'][current] = wave
+        state['last_wave'] = int(wave)
+        state['last_total'] = len(current)
+
+    return wave_stats
+
+
+def save_state(state, path):
+    """Save the churn state so later waves can be added without the history"""
+    np.savez(
+        path,
+        hh_ids=state['hh_ids'].to_numpy(),
+        last_seen=state['last_seen'],
+        first_seen=state['first_seen'],
+        last_wave=-1 if state['last_wave'] is None else state['last_wave'],
+        last_total=state['last_total'],
+    )
+
+
+def load_state(path):
+    """Load a churn state saved by save_state"""
+    with np.load(path, allow_pickle=True) as saved:
+        last_wave = int(saved['last_wave'])
+        return {
+            'hh_ids': pd.Index(saved['hh_ids']),
+            'last_seen': saved['last_seen'],
+            'first_seen': saved['first_seen'],
+            'last_wave': None if last_wave < 0 else last_wave,
+            'last_total': int(saved['last_total']),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='argparse')
+    parser.add_argument('--file', '-f', type=str, default='data_need.csv',
+                        help="The data with WAVE_NO and HH_ID as its 2nd and 3rd columns.")
+    parser.add_argument('--update', action='store_true',
+                        help="Only add the new waves of the file to wave_stats.csv.")
+    parser.add_argument('--state', type=str, default='wave_state.npz',
+                        help="The churn state kept between incremental updates.")
+    args = parser.parse_args()
+
+    if args.update and os.path.exists(args.state):
+        state = load_state(args.state)
+        wave_stats_df = pd.read_csv('wave_stats.csv')
     else:
-        num_back = 0
-    
-    # Update the set of all previous households
-    all_previous_households.update(current_households)
-    
-    # Append the stats for this wave
-    wave_stats.append({
-        'WAVE_NO': wave,
-        'Total': num_current,
-        'Disappeared': num_disappeared,
-        'New_IN': num_new,
-        'Back': num_back
-    })
-
-# Convert the results to a DataFrame
-wave_stats_df = pd.DataFrame(wave_stats)
-
-# Save the results to a CSV file
-wave_stats_df.to_csv('wave_stats.csv', index=False)
+        state = new_state()
+        wave_stats_df = pd.DataFrame()
+
+    data = read_waves(args.file)
+    if state['last_wave'] is not None:
+        data = data[data['WAVE_NO'] > state['last_wave']]
+
+    # Convert the results to a DataFrame
+    wave_stats_df = pd.concat([wave_stats_df, pd.DataFrame(update_state(state, data))],
+                              ignore_index=True)
+
+    # Save the results to a CSV file
+    wave_stats_df.to_csv('wave_stats.csv', index=False)
+    save_state(state, args.state)
@@ -8,6 +8,7 @@
 import numpy as np
 import pandas as pd
 import os
+import time
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 import tensorflow as tf
@@ -19,6 +20,7 @@ from parameters.Parameters_setting import parameters_setting
 from tensorflow.python.keras.models import Model
 from tensorflow.python.keras.layers import Input
 from utils.process_data import processed_data
+from utils.run_profiler import Run_profiler
 from sklearn.model_selection import KFold
 from tqdm import tqdm
 
@@ -39,6 +41,18 @@ class GAIN(object):
         epoch,
         sampletest=False,
         index_pick="continuous_first",
+        engine="session",
+        xla_jit=False,
+        patience=None,
+        tolerance=0.0,
+        init_checkpoint=None,
+        checkpoint_epoch=0,
+        output_format="csv",
+        profiler=None,
+        inference_chunk=None,
+        n_draws=1,
+        pool_draws=True,
+        mode="one_hot",
     ):
 
         # Define paths
@@ -50,29 +64,53 @@ class GAIN(object):
         self.index_file = index_file
         self.batch_size = batch_num
         self.index_pick = index_pick
-
-        (
-            self.data,
-            self.column_name,
-            self.column_location,
-            self.label_reverse,
-            self.df_original,
-            self.df_miss,
-            self.label_ori,
-            self.mask_raw,
-        ) = processed_data(
-            self.base_path,
-            self.cohort,
-            self.miss_method,
-            self.miss_ratio,
-            self.index_file,
-            mode="one_hot",
-            sampletest=sampletest,
-        )
+        # Early stopping of the sample test: stop after `patience` epochs without an
+        # improvement larger than `tolerance` (None runs all epochs)
+        self.patience = patience
+        self.tolerance = tolerance
+        # Checkpoint of a sample test to start from, trained for `checkpoint_epoch` more epochs
+        self.init_checkpoint = init_checkpoint
+        self.checkpoint_epoch = checkpoint_epoch
+        self.checkpoint_path = None
+        # Rows imputed and written at a time after training (None: all rows at once)
+        self.inference_chunk = inference_chunk
+        # Imputations drawn from the trained generator with independent noise, saved
+        # pooled (mean/mode) or all of them
+        self.n_draws = n_draws
+        self.pool_draws = pool_draws
+        # "one_hot" encodes every categorical column with one-hot, "embedding" encodes
+        # the high-cardinality ones with learned embeddings (see processed_data)
+        self.mode = mode
+        # Timing and memory of every phase (kept in memory unless the caller logs them)
+        self.profiler = profiler if profiler is not None else Run_profiler()
+
+        with self.profiler.phase("load_data"):
+            (
+                self.data,
+                self.column_name,
+                self.column_location,
+                self.label_reverse,
+                self.df_original,
+                self.df_miss,
+                self.label_ori,
+                self.mask_raw,
+            ) = processed_data(
+                self.base_path,
+                self.cohort,
+                self.miss_method,
+                self.miss_ratio,
+                self.index_file,
+                mode=self.mode,
+                sampletest=sampletest,
+            )
         self.mask = 1.0 - np.isnan(self.data)
 
         self.para = parameters_setting(
-            model_name="GAIN", data_shape=self.data.shape[1], epoch=epoch
+            model_name="GAIN",
+            data_shape=self.data.shape[1],
+            epoch=epoch,
+            engine=engine,
+            xla_jit=xla_jit,
         )
         (
             self.cross_validation,
@@ -86,14 +124,14 @@ class GAIN(object):
             self.noise_high_limit,
         ) = self.para.return_parameters()
         self.dsn = data_shuffle_noise(
-            mode="one_hot", noise_zero=False, high=self.noise_high_limit
+            mode=self.mode, noise_zero=False, high=self.noise_high_limit
         )
         self.model_estimate = Model_test(
             label_reverse=self.label_reverse,
             label_ori=self.label_ori,
             column_location=self.column_location,
             column_name=self.column_name,
-            mode="one_hot",
+            mode=self.mode,
         )
         self.ps = Performance_store(
             self.base_path,
@@ -106,8 +144,9 @@ class GAIN(object):
             self.column_location,
             self.column_name,
             name="GAIN",
-            mode="one_hot",
+            mode=self.mode,
             index_pick=self.index_pick,
+            output_format=output_format,
         )
         self.network_layer_G, self.network_layer_D = self.para.return_layer_size()
 
@@ -162,40 +201,33 @@ class GAIN(object):
 
         return model
 
+    def return_loss_weights(self):
+        """
+        Per-feature weights of the reconstruction loss, so it is one elementwise
+        expression over the full width instead of one slice per column.
+
+        Returns:
+            con_weight (np.ndarray): 1 on the continuous and embedding features (MSE),
+                0 elsewhere
+            cat_weight (np.ndarray): loss_balance on the one-hot categorical features
+        """
+        widths = np.diff(np.concatenate([[0], self.column_location]))
+        is_con = np.repeat(
+            [label[0] in ("con", "emb") for label in self.label_reverse[: len(widths)]],
+            widths,
+        )
+        con_weight = is_con.astype(np.float32)
+        cat_weight = (~is_con).astype(np.float32) * np.float32(self.loss_balance)
+        return con_weight, cat_weight
+
     def loss(self, gen_x, x, m):
         if self.loss_mode == "log_mse_masked":
-            for index, i in enumerate(self.column_location):
-                if self.label_reverse[index][0] == "con":
-                    if index == 0:
-                        loss = tf.reduce_sum(
-                            (gen_x[:, 0:i] * m[:, 0:i] - x[:, 0:i] * m[:, 0:i]) ** 2
-                        )
-                    else:
-                        loss = loss + tf.reduce_sum(
-                            (
-                                gen_x[:, self.column_location[index - 1] : i]
-                                * m[:, self.column_location[index - 1] : i]
-                                - x[:, self.column_location[index - 1] : i]
-                                * m[:, self.column_location[index - 1] : i]
-                            )
-                            ** 2
-                        )
-                else:
-                    if index == 0:
-                        loss_target = (
-                            -x[:, 0:i] * m[:, 0:i] * tf.math.log(gen_x[:, 0:i] + 1e-8)
-                        )
-                        loss = self.loss_balance * tf.reduce_sum(loss_target)
-                    else:
-                        loss_target = (
-                            -x[:, self.column_location[index - 1] : i]
-                            * m[:, self.column_location[index - 1] : i]
-                            * tf.math.log(
-                                gen_x[:, self.column_location[index - 1] : i] + 1e-8
-                            )
-                        )
-                        loss = loss + self.loss_balance * tf.reduce_sum(loss_target)
-
+            con_weight, cat_weight = self.return_loss_weights()
+            # MSE on the continuous features, cross-entropy on the categorical ones
+            loss = tf.reduce_sum(
+                con_weight * (gen_x * m - x * m) ** 2
+                - cat_weight * x * m * tf.math.log(gen_x + 1e-8)
+            )
             loss = loss / (tf.reduce_sum(m) + 1e-8)
 
         else:
@@ -235,10 +267,12 @@ class GAIN(object):
         """
         x, m, h = self.para.return_placeholder()
         gen_model = self.return_generative_network()
+        self.gen_model = gen_model
         InputG = tf.concat(values=[x, m], axis=1)
         gen_xpre = gen_model(InputG)
         gen_x = gen_xpre * (1.0 - m) + x * m
         dis_model = self.return_discriminator_network()
+        self.dis_model = dis_model
         InputD = tf.concat(values=[gen_x, h], axis=1)
         gen_m = dis_model(InputD)
         d_loss = self.d_loss(m=m, gen_m=gen_m)
@@ -254,6 +288,104 @@ class GAIN(object):
 
         return G_solver, D_solver, gen_xpre, x, m, h
 
+    def return_compiled_network(self):
+        """
+        Defines the generative and discriminator networks with a single compiled training step.
+
+        Returns:
+            train_step: tf.function that runs one forward pass, computes both losses and
+                applies both optimizers.
+            generate: tf.function returning the output of the generative network.
+        """
+        gen_model = self.return_generative_network()
+        dis_model = self.return_discriminator_network()
+        self.gen_model, self.dis_model = gen_model, dis_model
+        G_solver = tf.compat.v1.train.AdamOptimizer()
+        D_solver = tf.compat.v1.train.AdamOptimizer()
+        spec = tf.TensorSpec(shape=[None, self.data.shape[1]], dtype=tf.float32)
+
+        @tf.function(input_signature=[spec, spec, spec], jit_compile=self.para.xla_jit)
+        def train_step(x, m, h):
+            with tf.GradientTape() as g_tape, tf.GradientTape() as d_tape:
+                gen_xpre = gen_model(tf.concat(values=[x, m], axis=1))
+                gen_x = gen_xpre * (1.0 - m) + x * m
+                gen_m = dis_model(tf.concat(values=[gen_x, h], axis=1))
+                d_loss = self.d_loss(m=m, gen_m=gen_m)
+                g_loss_p1 = self.g_loss(m=m, gen_m=gen_m)
+                g_loss_p2 = self.loss(gen_x=gen_xpre, x=x, m=m)
+                g_loss = g_loss_p1 + self.alpha * g_loss_p2
+            G_solver.apply_gradients(
+                zip(
+                    g_tape.gradient(g_loss, gen_model.trainable_weights),
+                    gen_model.trainable_weights,
+                )
+            )
+            D_solver.apply_gradients(
+                zip(
+                    d_tape.gradient(d_loss, dis_model.trainable_weights),
+                    dis_model.trainable_weights,
+                )
+            )
+
+        @tf.function(input_signature=[spec, spec])
+        def generate(x, m):
+            return gen_model(tf.concat(values=[x, m], axis=1))
+
+        return train_step, generate
+
+    def return_weights(self, sess=None):
+        """Current weights of the generative and discriminator networks"""
+        models = [self.gen_model, self.dis_model]
+        if sess is None:
+            return [model.get_weights() for model in models]
+        return [sess.run(model.weights) for model in models]
+
+    def load_weights(self, weights, sess=None):
+        """Load weights into the networks, returns False if their shapes do not match"""
+        models = [self.gen_model, self.dis_model]
+        for model, values in zip(models, weights):
+            if [tuple(w.shape) for w in model.weights] != [v.shape for v in values]:
+                return False
+        for model, values in zip(models, weights):
+            if sess is None:
+                model.set_weights(values)
+            else:
+                for variable, value in zip(model.weights, values):
+                    variable.load(value, sess)
+        return True
+
+    def return_epoch_to_run(self, sess=None):
+        """Epochs to train, after loading the initial checkpoint when one is given"""
+        if self.init_checkpoint is None:
+            return self.epoch
+        weights = self.ps.load_checkpoint(self.init_checkpoint)
+        if weights is not None and self.load_weights(weights, sess):
+            return self.checkpoint_epoch
+        print(f"Checkpoint {self.init_checkpoint} does not fit the data, retraining.")
+        return self.epoch
+
+    def start_early_stopping(self):
+        self.best_value, self.best_epoch, self.best_weights = None, 0, None
+        self.wait = 0
+
+    def update_early_stopping(self, epoch_index, con_loss, cat_accuracy, sess=None):
+        """Track the best epoch and its weights, returns True when training should stop"""
+        value = self.ps.return_monitor_value(con_loss, cat_accuracy)
+        if self.best_value is None or value < self.best_value - self.tolerance:
+            self.best_value = value
+            self.best_epoch = epoch_index + 1
+            self.best_weights = self.return_weights(sess)
+            self.wait = 0
+        else:
+            self.wait += 1
+        return self.patience is not None and self.wait >= self.patience
+
+    def finish_early_stopping(self):
+        """Save the weights of the best epoch and return that epoch"""
+        self.checkpoint_path = self.ps.save_checkpoint(self.best_weights)
+        self.best_weights = None
+        return self.best_epoch
+
     def return_hint_of_mask(self, train_m_batch):
         mask_hint = np.random.uniform(
             size=(train_m_batch.shape[0], self.mask.shape[1]), low=0.0, high=1.0
@@ -276,106 +408,271 @@ class GAIN(object):
             test_m,
         )
 
-    def train_process(self):
-        G_solver, D_solver, gen_x, x, m, h = self.return_defined_network_for_mode()
-        sess = tf.compat.v1.Session()
-        sess.run(tf.compat.v1.global_variables_initializer())
+    def return_batches(self):
+        return self.dsn.batch_generator(
+            train_data=self.data,
+            train_mask=self.mask,
+            batch_size=self.batch_size,
+            hint_fn=self.return_hint_of_mask,
+        )
+
+    def return_dataset(self):
+        """Streaming tf.data pipeline of shuffled batches, prefetched during training"""
+        spec = tf.TensorSpec(shape=[None, self.data.shape[1]], dtype=tf.float32)
+        dataset = tf.data.Dataset.from_generator(
+            self.return_batches, output_signature=(spec, spec, spec)
+        )
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    def train_epoch_compiled(self, train_step, dataset):
+        n_batches = 0
+        for train_d_batch, train_m_batch, train_h_batch in dataset:
+            train_step(train_d_batch, train_m_batch, train_h_batch)
+            n_batches += 1
+        return n_batches
 
-        for _ in tqdm(range(self.epoch)):
+    def return_imputed_chunks(self, run_generator):
+        """
+        Impute the cohort chunk by chunk: add noise, run the generator and keep the
+        observed values. Noise is drawn row after row, as for the whole cohort at once.
 
-            train_d, train_m = self.dsn.data_shuffle(
-                train_data=self.data.copy(), train_mask=self.mask.copy()
+        Args:
+            run_generator (function): Generator output of (noised data, mask) rows
+
+        Yields:
+            (int, np.ndarray): First row of the chunk and its imputed data
+        """
+        chunk_size = self.inference_chunk or self.data.shape[0]
+        for start in range(0, self.data.shape[0], chunk_size):
+            mask_chunk = self.mask[start : start + chunk_size]
+            data_noised = self.dsn._add_noise_(
+                train_data=self.data[start : start + chunk_size].copy(),
+                train_mask=mask_chunk,
             )
-            for iteration in range(int(train_d.shape[0] / self.batch_size)):
-
-                train_d_batch = train_d[
-                    iteration * self.batch_size : (iteration + 1) * self.batch_size
-                ]
-                train_m_batch = train_m[
-                    iteration * self.batch_size : (iteration + 1) * self.batch_size
-                ]
-                train_h_batch = self.return_hint_of_mask(train_m_batch=train_m_batch)
-
-                _ = sess.run(
-                    [G_solver],
-                    feed_dict={
-                        x: train_d_batch,
-                        m: train_m_batch,
-                        h: train_h_batch,
-                    },
-                )
-                _ = sess.run(
-                    [D_solver],
-                    feed_dict={
-                        x: train_d_batch,
-                        m: train_m_batch,
-                        h: train_h_batch,
-                    },
+            data_imputed = run_generator(data_noised, mask_chunk)
+            yield start, data_imputed * (1.0 - mask_chunk) + data_noised * mask_chunk
+
+    def return_imputed_draws(self, run_generator):
+        """
+        Draw `n_draws` imputations of the cohort chunk by chunk. The draws of a chunk
+        are stacked with independent noise and imputed by one generator call, so a
+        chunk holds n_draws x inference_chunk rows.
+
+        Args:
+            run_generator (function): Generator output of (noised data, mask) rows
+
+        Yields:
+            (int, np.ndarray): First row of the chunk and its imputed data, shape
+            (n_draws, rows, features)
+        """
+        chunk_size = self.inference_chunk or self.data.shape[0]
+        for start in range(0, self.data.shape[0], chunk_size):
+            mask_chunk = np.tile(
+                self.mask[start : start + chunk_size], (self.n_draws, 1)
+            )
+            data_noised = self.dsn._add_noise_(
+                train_data=np.tile(
+                    self.data[start : start + chunk_size], (self.n_draws, 1)
+                ),
+                train_mask=mask_chunk,
+            )
+            data_imputed = run_generator(data_noised, mask_chunk)
+            data_imputed = data_imputed * (1.0 - mask_chunk) + data_noised * mask_chunk
+            yield start, data_imputed.reshape(self.n_draws, -1, self.data.shape[1])
+
+    def return_timed_chunks(self, chunks, record):
+        """
+        Pass imputed chunks through, adding the time spent producing them (noise and
+        generator) to record["inference_time"]
+        """
+        record["inference_time"] = 0.0
+        chunks = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                record["inference_time"] += time.perf_counter() - start
+            yield chunk
+
+    def save_imputation(self, run_generator):
+        """
+        Impute the cohort with the trained generator and save it: all at once, in
+        chunks of inference_chunk rows, or as n_draws draws.
+
+        Args:
+            run_generator (function): Generator output of (noised data, mask) rows
+        """
+        if self.n_draws > 1:
+            chunks = self.return_imputed_draws(run_generator)
+            extra = {"draws": self.n_draws}
+
+            def save(chunks):
+                self.ps.save_draws_chunked(
+                    chunks,
+                    mask_df=self.mask_raw,
+                    n_draws=self.n_draws,
+                    pool=self.pool_draws,
                 )
 
-        data_noised = self.dsn._add_noise_(
-            train_data=self.data.copy(), train_mask=self.mask.copy()
+        elif self.inference_chunk:
+            chunks = self.return_imputed_chunks(run_generator)
+            extra = {}
+
+            def save(chunks):
+                self.ps.save_results_chunked(chunks, mask_df=self.mask_raw)
+
+        else:
+            with self.profiler.phase("inference"):
+                _, data_imputed = next(self.return_imputed_chunks(run_generator))
+
+            with self.profiler.phase("save_results"):
+                self.ps.save_results(imputed_data=data_imputed, mask_df=self.mask_raw)
+            return
+
+        # Inference and writing are interleaved chunk by chunk, so they share a phase
+        # and the time of each is accumulated over the chunks
+        with self.profiler.phase("inference_save_results", **extra) as record:
+            start = time.perf_counter()
+            save(self.return_timed_chunks(chunks, record))
+            record["save_results_time"] = (
+                time.perf_counter() - start - record["inference_time"]
+            )
+
+    def evaluate_imputation(self, run_generator):
+        """
+        Impute the sample-test cohort and score it against the original data.
+
+        Args:
+            run_generator (function): Generator output of (noised data, mask) rows
+
+        Returns:
+            con_loss, cat_accuracy
+        """
+        data_imputed = np.concatenate(
+            [chunk for _, chunk in self.return_imputed_chunks(run_generator)]
+        )
+        return self.model_estimate.model_test(
+            data=data_imputed,
+            mask=self.mask.copy(),
+            df_original=self.df_original,
         )
-        data_imputed = sess.run(gen_x, feed_dict={x: data_noised, m: self.mask})
-        data_imputed = data_imputed * (1.0 - self.mask) + data_noised * self.mask
 
-        self.ps.save_results(imputed_data=data_imputed, mask_df=self.mask_raw)
-        sess.close()
-        tf.keras.backend.clear_session()
+    def train_process_compiled(self):
+        with self.profiler.phase("build_graph"):
+            train_step, generate = self.return_compiled_network()
+            dataset = self.return_dataset()
+            epoch_to_run = self.return_epoch_to_run()
 
-    def train_process_sample(self):
-        G_solver, D_solver, gen_x, x, m, h = self.return_defined_network_for_mode()
-        sess = tf.compat.v1.Session()
-        sess.run(tf.compat.v1.global_variables_initializer())
+        for epoch_index in tqdm(range(epoch_to_run)):
+            with self.profiler.phase("epoch", epoch=epoch_index) as record:
+                record["batches"] = self.train_epoch_compiled(train_step, dataset)
 
-        con_list, cat_list = [], []
-        for _ in tqdm(range(self.epoch)):
+        self.save_imputation(
+            lambda data, mask: generate(np.float32(data), np.float32(mask)).numpy()
+        )
+        tf.keras.backend.clear_session()
 
-            train_d, train_m = self.dsn.data_shuffle(
-                train_data=self.data.copy(), train_mask=self.mask.copy()
-            )
-            for iteration in range(int(train_d.shape[0] / self.batch_size)):
-
-                train_d_batch = train_d[
-                    iteration * self.batch_size : (iteration + 1) * self.batch_size
-                ]
-                train_m_batch = train_m[
-                    iteration * self.batch_size : (iteration + 1) * self.batch_size
-                ]
-                train_h_batch = self.return_hint_of_mask(train_m_batch=train_m_batch)
-
-                _ = sess.run(
-                    [G_solver],
-                    feed_dict={
-                        x: train_d_batch,
-                        m: train_m_batch,
-                        h: train_h_batch,
-                    },
-                )
-                _ = sess.run(
-                    [D_solver],
-                    feed_dict={
-                        x: train_d_batch,
-                        m: train_m_batch,
-                        h: train_h_batch,
-                    },
+    def train_process_sample_compiled(self):
+        with self.profiler.phase("build_graph"):
+            train_step, generate = self.return_compiled_network()
+            dataset = self.return_dataset()
+
+        self.start_early_stopping()
+        for epoch_index in tqdm(range(self.epoch)):
+            with self.profiler.phase("epoch", epoch=epoch_index) as record:
+                record["batches"] = self.train_epoch_compiled(train_step, dataset)
+
+            with self.profiler.phase("evaluate", epoch=epoch_index):
+                con_loss, cat_accuracy = self.evaluate_imputation(
+                    lambda data, mask: generate(
+                        np.float32(data), np.float32(mask)
+                    ).numpy()
                 )
+            if self.update_early_stopping(epoch_index, con_loss, cat_accuracy):
+                break
 
-            data_noised = self.dsn._add_noise_(
-                train_data=self.data.copy(), train_mask=self.mask.copy()
+        index_re = self.finish_early_stopping()
+        tf.keras.backend.clear_session()
+
+        return index_re
+
+    def train_epoch_session(self, sess, G_solver, D_solver, x, m, h):
+        n_batches = 0
+        for (
+            train_d_batch,
+            train_m_batch,
+            train_h_batch,
+        ) in self.dsn.prefetch_batches(self.return_batches()):
+
+            _ = sess.run(
+                [G_solver],
+                feed_dict={
+                    x: train_d_batch,
+                    m: train_m_batch,
+                    h: train_h_batch,
+                },
             )
-            data_imputed = sess.run(gen_x, feed_dict={x: data_noised, m: self.mask})
-            data_imputed = data_imputed * (1.0 - self.mask) + data_noised * self.mask
-            con_loss, cat_accuracy = self.model_estimate.model_test(
-                data=data_imputed, mask=self.mask.copy(), df_original=self.df_original
+            _ = sess.run(
+                [D_solver],
+                feed_dict={
+                    x: train_d_batch,
+                    m: train_m_batch,
+                    h: train_h_batch,
+                },
             )
-            con_list.append(con_loss)
-            cat_list.append(cat_accuracy)
+            n_batches += 1
+        return n_batches
 
-        index_re = self.ps.select_best_index(
-            continuous_metrics=con_list, categorical_accuracies=cat_list
+    def train_process(self):
+        if self.para.engine == "tf_function":
+            return self.train_process_compiled()
+
+        with self.profiler.phase("build_graph"):
+            G_solver, D_solver, gen_x, x, m, h = self.return_defined_network_for_mode()
+            sess = tf.compat.v1.Session()
+            sess.run(tf.compat.v1.global_variables_initializer())
+            epoch_to_run = self.return_epoch_to_run(sess)
+
+        for epoch_index in tqdm(range(epoch_to_run)):
+            with self.profiler.phase("epoch", epoch=epoch_index) as record:
+                record["batches"] = self.train_epoch_session(
+                    sess, G_solver, D_solver, x, m, h
+                )
+
+        self.save_imputation(
+            lambda data, mask: sess.run(gen_x, feed_dict={x: data, m: mask})
         )
         sess.close()
         tf.keras.backend.clear_session()
 
+    def train_process_sample(self):
+        if self.para.engine == "tf_function":
+            return self.train_process_sample_compiled()
+
+        with self.profiler.phase("build_graph"):
+            G_solver, D_solver, gen_x, x, m, h = self.return_defined_network_for_mode()
+            sess = tf.compat.v1.Session()
+            sess.run(tf.compat.v1.global_variables_initializer())
+
+        self.start_early_stopping()
+        for epoch_index in tqdm(range(self.epoch)):
+            with self.profiler.phase("epoch", epoch=epoch_index) as record:
+                record["batches"] = self.train_epoch_session(
+                    sess, G_solver, D_solver, x, m, h
+                )
+
+            with self.profiler.phase("evaluate", epoch=epoch_index):
+                con_loss, cat_accuracy = self.evaluate_imputation(
+                    lambda data, mask: sess.run(gen_x, feed_dict={x: data, m: mask})
+                )
+            if self.update_early_stopping(epoch_index, con_loss, cat_accuracy, sess):
+                break
+
+        index_re = self.finish_early_stopping()
+        sess.close()
+        tf.keras.backend.clear_session()
+
         return index_re
@@ -6,27 +6,79 @@
 @Time        :   2025/02/21 01:02:40
 """
 from GAIN import GAIN
+from utils.run_profiler import Run_profiler
 import gc
 import numpy as np
 from pathlib import Path
 from tqdm import tqdm
 import time
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+import tensorflow as tf
 
 # conda init
 # source ~/.bashrc
 # conda activate tf115_env
 
 
+def init_worker(intra_op_threads, inter_op_threads):
+    """Cap the threads of a worker so parallel fits do not oversubscribe the CPU"""
+    os.environ["OMP_NUM_THREADS"] = str(intra_op_threads)
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def run_cell(cell):
+    """Fit GAIN on one (mechanism, ratio, index_file) cell and return its time"""
+    cell = dict(cell)
+    # Per-phase timing and memory of the cell, appended to the profile log
+    profiler = Run_profiler(
+        cell.pop("profile_file", None),
+        cohort=cell["cohort"],
+        miss_method=cell["miss_method"],
+        miss_ratio=cell["miss_ratio"],
+        index_file=cell["index_file"],
+        engine=cell.get("engine", "session"),
+    )
+    profiler.start()
+    # The phases recorded so far are logged even if the cell fails
+    try:
+        print("Model initialization...")
+        model = GAIN(**cell, profiler=profiler)
+        print("Start training...")
+        # Measure imputation time
+        start_time = time.time()
+        model.train_process()
+        end_time = time.time()
+    finally:
+        profiler.finish()
+    del model
+    gc.collect()
+    return (
+        cell["miss_method"],
+        cell["miss_ratio"],
+        cell["index_file"],
+        end_time - start_time,
+    )
+
+
 class experiments:
     def __init__(self, model_name):
         self.model_name = model_name
         self.base_path = Path("/home/siyi.sun/CMIE_Project/data_stored")
         # Output path for time recording
         self.output_file = Path("/home/siyi.sun/CMIE_Project/imputation_times_gain.csv")
+        # Wall/CPU time and peak memory of every phase and epoch, one JSON object per line
+        ## (set GAIN_CPROFILE=1 or GAIN_TRACEMALLOC=1 to also profile the runs)
+        self.profile_file = self.output_file.with_name("imputation_profile_gain.jsonl")
+        # Time of every cell, so a resumed sweep averages over all cells run so far
+        self.cell_times_file = self.output_file.with_name(
+            "imputation_times_gain_cells.csv"
+        )
         self.cohort = "C19"
         self.miss_methods = ["MCAR", "MAR", "MNAR"]
         self.miss_ratios = [10]
@@ -38,7 +90,45 @@ class experiments:
         self.num_sampletest = 1  # num of test defined in ../Rcode/sample_miss.R
         self.num_experiments = 5  # num of train defined in ../Rcode/sample_miss.R
         self.batch_size = 64  # batch-size
-        self.Epoch_sampletest = 100  # num of epoch during each sample test case
+        self.Epoch_sampletest = 100  # max num of epoch during each sample test case
+        ## Stop a sample test after `patience` epochs (None runs all epochs) without an
+        ## improvement of the monitored metric larger than `tolerance`
+        self.patience = 10
+        self.tolerance = 0.0
+
+        ## "retrain" trains each run from scratch for the selected num of epochs,
+        ## "reuse" imputes directly with the best sample-test checkpoint,
+        ## "warm_start" trains the best sample-test checkpoint for Epoch_warm_start more epochs
+        self.checkpoint_mode = "retrain"
+        self.Epoch_warm_start = 10
+        self.checkpoint_dict = {}
+
+        ## "session" runs the TF1 graph with two sess.run calls per batch,
+        ## "tf_function" runs one compiled TF2 step per batch (needs eager execution)
+        self.engine = "session"
+        self.xla_jit = False  # compile the tf_function step with XLA
+        ## "one_hot" encodes every categorical column with one-hot, "embedding" encodes
+        ## the high-cardinality ones (e.g. cat_HR, cat_STATE) with learned embeddings
+        self.mode = "one_hot"
+        self.output_format = (
+            "csv"  # format of the imputed datasets, "csv", "parquet" or "feather"
+        )
+
+        ## Rows imputed and written at a time after training, which bounds the peak
+        ## memory of the final step (None imputes the whole cohort at once)
+        self.inference_chunk = 100_000
+
+        ## Imputations drawn from each trained generator with independent noise, saved
+        ## pooled with mean/mode (pool_draws) or all of them to data_gain_store
+        self.n_draws = 1
+        self.pool_draws = True
+
+        ## Num of GAIN fits running in parallel processes (1 runs them in this process),
+        ## each capped at intra_op_threads (None splits the cores evenly) and
+        ## inter_op_threads
+        self.num_workers = 1
+        self.intra_op_threads = None
+        self.inter_op_threads = 1
 
     def run_model(self):
         print("Start running the model on sample...")
@@ -59,22 +149,44 @@ class experiments:
             epoch_case[miss_method] = {}
             for miss_ratio in tqdm(self.miss_ratios):
                 epoch_stop = []
+                best_sample = None
                 for index_file in tqdm(range(self.num_sampletest)):
-                    print("Model initialization...")
-                    model = GAIN(
-                        self.base_path,
-                        self.cohort,
-                        miss_method,
-                        miss_ratio,
-                        index_file,
-                        self.batch_size,
-                        self.Epoch_sampletest,
+                    profiler = Run_profiler(
+                        self.profile_file,
+                        cohort=self.cohort,
+                        miss_method=miss_method,
+                        miss_ratio=miss_ratio,
+                        index_file=index_file,
+                        engine=self.engine,
                         sampletest=True,
-                        index_pick=self.index_pick,
                     )
-                    print("Start training...")
-                    index_stop = model.train_process_sample()
+                    profiler.start()
+                    try:
+                        print("Model initialization...")
+                        model = GAIN(
+                            self.base_path,
+                            self.cohort,
+                            miss_method,
+                            miss_ratio,
+                            index_file,
+                            self.batch_size,
+                            self.Epoch_sampletest,
+                            sampletest=True,
+                            index_pick=self.index_pick,
+                            engine=self.engine,
+                            xla_jit=self.xla_jit,
+                            patience=self.patience,
+                            tolerance=self.tolerance,
+                            profiler=profiler,
+                            mode=self.mode,
+                        )
+                        print("Start training...")
+                        index_stop = model.train_process_sample()
+                    finally:
+                        profiler.finish()
                     epoch_stop.append(index_stop)
+                    if best_sample is None or model.best_value < best_sample[0]:
+                        best_sample = (model.best_value, model.checkpoint_path)
                     print(
                         f"{miss_method},{miss_ratio}, Sample test {index_file} finished."
                     )
@@ -82,50 +194,119 @@ class experiments:
                 epoch_case[miss_method][miss_ratio] = int(
                     np.around(np.mean(epoch_stop))
                 )
+                self.checkpoint_dict[(miss_method, miss_ratio)] = best_sample[1]
                 del epoch_stop
                 gc.collect()
         return epoch_case
 
+    def return_output_path(self, miss_method, miss_ratio, index_file):
+        # Same layout as Performance_store.return_save_path
+        if self.n_draws > 1 and not self.pool_draws:
+            # The last draw is written last
+            return (
+                self.base_path
+                / f"data_gain_store/{self.cohort}/{self.cohort}_all/{miss_method}/miss{miss_ratio}/{index_file}/{self.n_draws - 1}.{self.output_format}"
+            )
+        return (
+            self.base_path
+            / f"data_gain/{self.cohort}/{self.cohort}_all/{miss_method}/miss{miss_ratio}/{index_file}.{self.output_format}"
+        )
+
+    def save_time_records(self, miss_method, miss_ratio, index_file, imputation_time):
+        """Log the time of one cell and rewrite the average of every (mechanism, ratio)"""
+        keys = ["Dataset", "Mechanism", "MissingRatio"]
+        cell_df = pd.DataFrame(
+            [[self.cohort, miss_method, miss_ratio, index_file, imputation_time]],
+            columns=keys + ["IndexFile", "Time"],
+        )
+        if self.cell_times_file.exists():
+            cell_df = pd.concat(
+                [pd.read_csv(self.cell_times_file), cell_df], ignore_index=True
+            )
+        # A rerun cell replaces its earlier time
+        cell_df = cell_df.drop_duplicates(keys + ["IndexFile"], keep="last")
+        cell_df.to_csv(self.cell_times_file, index=False)
+
+        time_df = (
+            cell_df.groupby(keys, sort=False)["Time"]
+            .mean()
+            .rename("AvgTime")
+            .reset_index()
+        )
+        # Keep the records of sweeps that predate the per-cell log
+        if self.output_file.exists():
+            old_df = pd.read_csv(self.output_file)
+            keep = ~old_df.set_index(keys).index.isin(time_df.set_index(keys).index)
+            time_df = pd.concat([old_df[keep], time_df], ignore_index=True)
+        time_df.to_csv(self.output_file, index=False)
+
     def run_experiment(self, epoch_dict):
-        time_records = []
-        for miss_method in tqdm(self.miss_methods):
-            for miss_ratio in tqdm(self.miss_ratios):
-                imputation_times = []
-                for index_file in tqdm(range(self.num_experiments)):
-                    print("Model initialization...")
-                    model = GAIN(
-                        self.base_path,
-                        self.cohort,
-                        miss_method,
-                        miss_ratio,
-                        index_file,
-                        self.batch_size,
-                        epoch_dict[miss_method][miss_ratio],
-                        sampletest=False,
-                        index_pick=self.index_pick,
-                    )
-                    print("Start training...")
-                    # Measure imputation time
-                    start_time = time.time()
-                    model.train_process()
-                    end_time = time.time()
-                    imputation_time = end_time - start_time
-                    imputation_times.append(imputation_time)
-
-                # Compute average time
-                avg_time = sum(imputation_times) / self.num_experiments
-
-                # Store result
-                time_records.append([self.cohort, miss_method, miss_ratio, avg_time])
-
-                # Save results to CSV
-                time_df = pd.DataFrame(
-                    time_records,
-                    columns=["Dataset", "Mechanism", "MissingRatio", "AvgTime"],
+        cells = []
+        for miss_method in self.miss_methods:
+            for miss_ratio in self.miss_ratios:
+                init_checkpoint = (
+                    None
+                    if self.checkpoint_mode == "retrain"
+                    else self.checkpoint_dict.get((miss_method, miss_ratio))
                 )
-                time_df.to_csv(self.output_file, index=False)
-                print(f"{miss_method}, {miss_ratio} Imputation times recorded.")
-                gc.collect()
+                checkpoint_epoch = (
+                    self.Epoch_warm_start if self.checkpoint_mode == "warm_start" else 0
+                )
+                for index_file in range(self.num_experiments):
+                    if self.return_output_path(
+                        miss_method, miss_ratio, index_file
+                    ).exists():
+                        print(
+                            f"{miss_method}, {miss_ratio}, {index_file} exists, skipped."
+                        )
+                        continue
+                    cells.append(
+                        dict(
+                            base_path=self.base_path,
+                            cohort=self.cohort,
+                            miss_method=miss_method,
+                            miss_ratio=miss_ratio,
+                            index_file=index_file,
+                            batch_num=self.batch_size,
+                            epoch=epoch_dict[miss_method][miss_ratio],
+                            sampletest=False,
+                            index_pick=self.index_pick,
+                            engine=self.engine,
+                            xla_jit=self.xla_jit,
+                            init_checkpoint=init_checkpoint,
+                            checkpoint_epoch=checkpoint_epoch,
+                            output_format=self.output_format,
+                            inference_chunk=self.inference_chunk,
+                            n_draws=self.n_draws,
+                            pool_draws=self.pool_draws,
+                            mode=self.mode,
+                            profile_file=self.profile_file,
+                        )
+                    )
+
+        # Only this process writes the time records, as the results come back
+        def record(result):
+            self.save_time_records(*result)
+            print(f"{result[0]}, {result[1]} Imputation times recorded.")
+
+        if self.num_workers == 1:
+            for cell in tqdm(cells):
+                record(run_cell(cell))
+            return
+
+        intra_op_threads = self.intra_op_threads or max(
+            1, os.cpu_count() // self.num_workers
+        )
+        with ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            # TensorFlow is not fork-safe once initialized
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(intra_op_threads, self.inter_op_threads),
+        ) as executor:
+            futures = [executor.submit(run_cell, cell) for cell in cells]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                record(future.result())
 
 
 # Run the model
@@ -6,151 +6,202 @@
 @Time        :   2025/02/24 01:52:56
 """
 
+import re
 import pandas as pd
 import numpy as np
 from pathlib import Path
-import glob
+from concurrent.futures import ProcessPoolExecutor
+from utils.mask_store import load_mask
+from utils.process_data import load_encoded_cohort
+from utils.table_store import read_table, table_formats
 
+# Imputation outputs are read from data_{method}
+impute_methods = ["mice", "gain", "missforest"]
 
-def z_score_normalize(data, mean, std):
+# Ground truth of each cohort, loaded once per process
+_ground_truth = {}
+
+
+def load_ground_truth(base_path, cohort):
+    """
+    Load the full data of a cohort as typed arrays: continuous values with the inverse
+    of their standard deviation, and categorical codes with their categories.
     """
-    Apply z-score normalization using pre-computed mean and standard deviation
+    if (base_path, cohort) not in _ground_truth:
+        columns = load_encoded_cohort(base_path, cohort)
+        cont = [column for column in columns if column[0].startswith("con_")]
+        cat = [column for column in columns if column[0].startswith("cat_")]
+
+        cont_values = (
+            np.stack([column[2] for column in cont], axis=1)
+            if cont
+            else np.zeros((0, 0))
+        )
+        # Same standard deviation as pandas (ddof=1); constant columns give zero error
+        cont_stds = np.nanstd(cont_values, axis=0, ddof=1)
+        inv_stds = np.divide(
+            1.0, cont_stds, out=np.zeros_like(cont_stds), where=cont_stds != 0
+        )
+
+        _ground_truth[(base_path, cohort)] = {
+            "cont_cols": [column[0] for column in cont],
+            "cont_values": cont_values,
+            "cont_inv_stds": inv_stds,
+            "cat_cols": [column[0] for column in cat],
+            "cat_codes": np.stack([column[2] for column in cat], axis=1)
+            if cat
+            else np.zeros((0, 0), dtype=np.int32),
+            "cat_categories": [column[3] for column in cat],
+        }
+    return _ground_truth[(base_path, cohort)]
+
+
+def discover_imputed_files(base_path):
+    """
+    Find every imputed dataset data_{method}/{cohort}/{cohort}_all/{mechanism}/miss{ratio}/{sample}
+    stored as CSV, Parquet or Feather. A dataset stored in several formats is listed once.
+
+    Returns:
+        list: (method, cohort, mechanism, ratio, sample) of each file
     """
-    if std == 0:
-        return np.zeros_like(data)
-    return (data - mean) / std
+    pattern = re.compile(
+        r"data_(?P<method>\w+)/(?P<cohort>\w+)/(?P=cohort)_all/(?P<mechanism>\w+)/miss(?P<ratio>\d+)/(?P<sample>\d+)\.(?:"
+        + "|".join(table_formats)
+        + ")"
+    )
+    files = set()
+    for method in impute_methods:
+        for path in (base_path / f"data_{method}").glob("*/*_all/*/miss*/*.*"):
+            match = pattern.fullmatch(path.relative_to(base_path).as_posix())
+            if match and match["method"] == method:
+                files.add(
+                    (
+                        method,
+                        match["cohort"],
+                        match["mechanism"],
+                        int(match["ratio"]),
+                        int(match["sample"]),
+                    )
+                )
+    return sorted(files)
 
 
-def calculate_imputation_metrics(base_path):
+def calculate_file_metrics(base_path, method, cohort, miss_method, miss_ratio, sample):
+    """
+    RMSE of the z-scored continuous values and accuracy of the categorical values over
+    the entries that were missing in one imputed dataset.
+    """
+    truth = load_ground_truth(base_path, cohort)
+    cont_cols, cat_cols = truth["cont_cols"], truth["cat_cols"]
+
+    mask, mask_columns = load_mask(base_path, cohort, miss_method, miss_ratio, sample)
+    position = {col: i for i, col in enumerate(mask_columns)}
+
+    imputed_path = (
+        base_path
+        / f"data_{method}/{cohort}/{cohort}_all/{miss_method}/miss{miss_ratio}/{sample}"
+    )
+    # Only the con_/cat_ columns are read, straight from the column chunks for Parquet
+    imputed_data = read_table(imputed_path, columns=cont_cols + cat_cols)
+
+    cont_rmse = np.nan
+    if cont_cols:
+        cont_mask = mask[:, [position[col] for col in cont_cols]]
+        total_missing = cont_mask.sum()
+        if total_missing > 0:
+            # z-scoring both sides with the full data's mean and std
+            errors = (
+                truth["cont_values"] - imputed_data[cont_cols].to_numpy(np.float64)
+            ) * truth["cont_inv_stds"]
+            cont_rmse = np.sqrt(np.nansum(errors[cont_mask] ** 2) / total_missing)
+
+    cat_acc = np.nan
+    if cat_cols:
+        cat_mask = mask[:, [position[col] for col in cat_cols]]
+        total_missing = cat_mask.sum()
+        if total_missing > 0:
+            imputed_codes = np.stack(
+                [
+                    pd.Index(categories).get_indexer(
+                        imputed_data[col].to_numpy(dtype=object)
+                    )
+                    for col, categories in zip(cat_cols, truth["cat_categories"])
+                ],
+                axis=1,
+            )
+            correct = (imputed_codes == truth["cat_codes"]) & (truth["cat_codes"] >= 0)
+            cat_acc = np.sum(correct & cat_mask) / total_missing
+
+    return method, cohort, miss_method, miss_ratio, sample, cont_rmse, cat_acc
+
+
+def calculate_imputation_metrics(base_path, n_workers=None):
     """
     Calculate RMSE and accuracy metrics for imputed datasets across different scenarios.
     The imputed datasets only contain the previously missing values.
 
     Args:
         base_path (Path): Base path containing all the data directories
+        n_workers (int): Num of processes evaluating files in parallel (default: all cores)
 
     Returns:
         pd.DataFrame: Results table with metrics for each scenario
     """
-    cohorts = ["C19"]
-    missing_methods = ["MCAR", "MAR", "MNAR"]
-    missing_ratios = [10, 20, 30, 40, 50]
-    sample_time = 5
-    impute_methods = ["mice"]
-
+    base_path = Path(base_path)
+    files = discover_imputed_files(base_path)
+
+    file_metrics = []
+    if files:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            file_metrics = list(
+                executor.map(
+                    calculate_file_metrics,
+                    [base_path] * len(files),
+                    *zip(*files),
+                    chunksize=4,
+                )
+            )
+
+    file_df = pd.DataFrame(
+        file_metrics,
+        columns=[
+            "impute_method",
+            "cohort",
+            "missing_mechanism",
+            "missing_ratio",
+            "sample",
+            "continuous_rmse",
+            "categorical_accuracy",
+        ],
+    )
+
+    # Calculate mean and variance of metrics over the samples of each scenario
     results = []
-
-    for method in impute_methods:
-        for cohort in cohorts:
-            # Load full dataset
-            full_data_path = base_path / f"Completed_data/{cohort}/{cohort}_all.csv"
-            full_data = pd.read_csv(full_data_path)
-
-            # Get continuous and categorical columns
-            cont_cols = [col for col in full_data.columns if col.startswith("con_")]
-            cat_cols = [col for col in full_data.columns if col.startswith("cat_")]
-
-            # Calculate mean and standard deviation for each continuous column in full dataset
-            cont_means = {col: full_data[col].mean() for col in cont_cols}
-            cont_stds = {col: full_data[col].std() for col in cont_cols}
-
-            for miss_method in missing_methods:
-                for miss_ratio in missing_ratios:
-                    cont_rmse_list = []
-                    cat_acc_list = []
-
-                    # Process each sample for each scenario
-                    for sample_idx in range(sample_time):
-                        # Load missing mask
-                        mask_path = (
-                            Path(base_path)
-                            / f"data_miss_mask/{cohort}/{cohort}_all/{miss_method}/miss{miss_ratio}/{sample_idx}.csv"
-                        )
-                        mask_data = pd.read_csv(mask_path)
-
-                        # Load imputed data
-                        imputed_path = (
-                            Path(base_path)
-                            / f"data_mice/{cohort}/{cohort}_all/{miss_method}/miss{miss_ratio}/{sample_idx}.csv"
-                        )
-                        imputed_data = pd.read_csv(imputed_path)
-
-                        # Calculate RMSE for continuous variables
-                        if cont_cols:
-                            cont_rmse = 0
-                            total_missing = 0
-
-                            for col in cont_cols:
-                                # Get indices where values were missing
-                                missing_idx = mask_data[col] == 1
-                                n_missing = missing_idx.sum()
-
-                                if n_missing > 0:
-                                    # Normalize both full and imputed data using full data's min-max
-                                    full_normalized = z_score_normalize(
-                                        full_data.loc[missing_idx, col],
-                                        cont_means[col],
-                                        cont_stds[col],
-                                    )
-                                    imputed_normalized = z_score_normalize(
-                                        imputed_data.loc[missing_idx, col],
-                                        cont_means[col],
-                                        cont_stds[col],
-                                    )
-                                    # Calculate squared errors using normalized values
-                                    squared_errors = (
-                                        full_normalized - imputed_normalized
-                                    ) ** 2
-                                    cont_rmse += squared_errors.sum()
-                                    total_missing += n_missing
-
-                            if total_missing > 0:
-                                cont_rmse = np.sqrt(cont_rmse / total_missing)
-                                cont_rmse_list.append(cont_rmse)
-
-                        # Calculate accuracy for categorical variables
-                        if cat_cols:
-                            cat_acc = 0
-                            total_missing = 0
-
-                            for col in cat_cols:
-                                missing_idx = mask_data[col] == 1
-                                n_missing = missing_idx.sum()
-
-                                if n_missing > 0:
-                                    # Calculate accuracy for missing values
-                                    correct = (
-                                        full_data.loc[missing_idx, col]
-                                        == imputed_data.loc[missing_idx, col]
-                                    ).sum()
-                                    cat_acc += correct
-                                    total_missing += n_missing
-
-                            if total_missing > 0:
-                                cat_acc = cat_acc / total_missing
-                                cat_acc_list.append(cat_acc)
-
-                    # Calculate mean and variance of metrics
-                    cont_rmse_mean = (
-                        np.mean(cont_rmse_list) if cont_rmse_list else np.nan
-                    )
-                    cont_rmse_var = np.var(cont_rmse_list) if cont_rmse_list else np.nan
-                    cat_acc_mean = np.mean(cat_acc_list) if cat_acc_list else np.nan
-                    cat_acc_var = np.var(cat_acc_list) if cat_acc_list else np.nan
-
-                    # Add results to list
-                    results.append(
-                        {
-                            "impute_method": method,
-                            "cohort": cohort,
-                            "missing_mechanism": miss_method,
-                            "missing_ratio": miss_ratio,
-                            "mean_continuous_rmse": cont_rmse_mean,
-                            "var_continuous_rmse": cont_rmse_var,
-                            "mean_categorical_accuracy": cat_acc_mean,
-                            "var_categorical_accuracy": cat_acc_var,
-                        }
-                    )
+    for (method, cohort, miss_method, miss_ratio), group in file_df.groupby(
+        ["impute_method", "cohort", "missing_mechanism", "missing_ratio"], sort=True
+    ):
+        cont_rmse_list = group["continuous_rmse"].dropna().to_numpy()
+        cat_acc_list = group["categorical_accuracy"].dropna().to_numpy()
+        results.append(
+            {
+                "impute_method": method,
+                "cohort": cohort,
+                "missing_mechanism": miss_method,
+                "missing_ratio": miss_ratio,
+                "mean_continuous_rmse": np.mean(cont_rmse_list)
+                if len(cont_rmse_list)
+                else np.nan,
+                "var_continuous_rmse": np.var(cont_rmse_list)
+                if len(cont_rmse_list)
+                else np.nan,
+                "mean_categorical_accuracy": np.mean(cat_acc_list)
+                if len(cat_acc_list)
+                else np.nan,
+                "var_categorical_accuracy": np.var(cat_acc_list)
+                if len(cat_acc_list)
+                else np.nan,
+            }
+        )
 
     # Convert results to DataFrame
     results_df = pd.DataFrame(results)
@@ -158,7 +209,8 @@ def calculate_imputation_metrics(base_path):
 
 
 # Example usage:
-base_path = Path("/home/siyi.sun/CMIE_Project/data_stored")
-results = calculate_imputation_metrics(base_path)
-output_path = "/home/siyi.sun/CMIE_Project/imputation_metrics_results.csv"
-results.to_csv(output_path, index=False)
+if __name__ == "__main__":
+    base_path = Path("/home/siyi.sun/CMIE_Project/data_stored")
+    results = calculate_imputation_metrics(base_path)
+    output_path = "/home/siyi.sun/CMIE_Project/imputation_metrics_results.csv"
+    results.to_csv(output_path, index=False)
@@ -0,0 +1,510 @@
+#!/home/siyi.sun/miniconda3/bin python3
+# -*- coding: UTF-8 -*-
+"""
+@Description :   Time the imputation pipeline on a synthetic cohort and compare to a baseline
+@Author      :   siyi.sun
+@Time        :   2025/03/20 17:31:52
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import platform
+import tempfile
+import tracemalloc
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from benchmark.synthetic_cohort import generate_cohort
+from utils.process_data import processed_data
+from utils.run_profiler import Run_profiler
+from utils.table_store import table_path, write_table
+
+# Benchmarks in the order they run; the metrics read the outputs of the earlier ones
+benchmark_names = [
+    "processed_data",
+    "gain_train_process",
+    "model_test",
+    "save_results",
+    "combine_mice_imputations",
+    "calculate_imputation_metrics",
+]
+# Settings a baseline must share with a run to be compared
+comparable_keys = [
+    "rows",
+    "miss_method",
+    "miss_ratio",
+    "epochs",
+    "batch_size",
+    "engine",
+    "output_format",
+    "n_imputations",
+    "workers",
+]
+
+
+def return_random_imputation(data, seed=0):
+    """Encoded data with its missing entries drawn at random, as a generator output"""
+    rng = np.random.default_rng(seed)
+    missing = np.isnan(data)
+    imputed = data.copy()
+    imputed[missing] = rng.random(int(missing.sum()))
+    return imputed
+
+
+def load_processed(config):
+    return processed_data(
+        config["base_path"],
+        config["cohort"],
+        config["miss_method"],
+        config["miss_ratio"],
+        0,
+    )
+
+
+def return_performance_store(config, processed):
+    from utils.Performance_store import Performance_store
+
+    (_, column_name, column_location, label_reverse, _, _, label_ori, _) = processed
+    return Performance_store(
+        config["base_path"],
+        config["cohort"],
+        config["miss_method"],
+        config["miss_ratio"],
+        0,
+        label_reverse,
+        label_ori,
+        column_location,
+        column_name,
+        name="GAIN",
+        output_format=config["output_format"],
+    )
+
+
+def write_mice_imputations(config, processed, seed=0):
+    """
+    Imputations of the MICE store for combine_mice_imputations: the full data with the
+    missing entries replaced by values drawn from the observed ones of each column.
+    """
+    rng = np.random.default_rng(seed)
+    df_full, df_mask = processed[4], processed[7]
+    folder = (
+        config["base_path"]
+        / f"data_mice_store/{config['cohort']}/{config['cohort']}_all/{config['miss_method']}/miss{config['miss_ratio']}/0"
+    )
+    for i in range(config["n_imputations"]):
+        df = df_full.copy()
+        for col in df.columns:
+            missing = df_mask[col].to_numpy()
+            if missing.any():
+                df.loc[missing, col] = rng.choice(
+                    df_full.loc[~missing, col].to_numpy(), int(missing.sum())
+                )
+        write_table(df, folder / f"{i}", config["output_format"])
+
+
+def run_phases(profiler, name, items, repeats, call, prepare=None):
+    """
+    Time `repeats` calls of a benchmark, then trace one more call with tracemalloc for
+    its peak memory. Tracing slows the call down, so it is kept out of the timed runs.
+
+    Args:
+        profiler (Run_profiler): Profiler recording the phases
+        name (str): Name of the benchmark, the phase of the traced call is {name}_memory
+        items (int): Num of rows processed by one call, for the throughput
+        repeats (int): Num of timed calls
+        call (callable): The call to measure
+        prepare (callable): If given, run before every call outside of the phase (e.g.
+            building a model), and its result is passed to `call`
+    """
+
+    def run(phase_name):
+        args = () if prepare is None else (prepare(),)
+        with profiler.phase(phase_name, items=items):
+            call(*args)
+
+    for _ in range(repeats):
+        run(name)
+
+    profiler.use_tracemalloc = True
+    tracemalloc.start()
+    try:
+        run(f"{name}_memory")
+    finally:
+        tracemalloc.stop()
+        profiler.use_tracemalloc = False
+
+
+def run_benchmark(name, config):
+    """
+    Run one benchmark `repeats` times, each inside a profiler phase, plus one call
+    traced for its memory. Runs in its own process, apart from the other benchmarks.
+
+    Returns:
+        dict: Best wall time, its CPU time and throughput, and the peak memory of a call
+    """
+    profiler = Run_profiler(benchmark=name)
+    profiler.start()
+    n_rows = config["rows"]
+    repeats = config["repeats"]
+
+    if name == "processed_data":
+        # The first call builds the encoded cache of the cohort
+        load_processed(config)
+        run_phases(profiler, name, n_rows, repeats, lambda: load_processed(config))
+
+    elif name == "gain_train_process":
+        from GAIN import GAIN
+
+        def prepare():
+            model = GAIN(
+                config["base_path"],
+                config["cohort"],
+                config["miss_method"],
+                config["miss_ratio"],
+                0,
+                config["batch_size"],
+                config["epochs"],
+                engine=config["engine"],
+                output_format=config["output_format"],
+            )
+            return model
+
+        run_phases(
+            profiler,
+            name,
+            n_rows * config["epochs"],
+            repeats,
+            lambda model: model.train_process(),
+            prepare=prepare,
+        )
+
+    elif name == "model_test":
+        from utils.Model_test import Model_test
+
+        processed = load_processed(config)
+        data, column_name, column_location, label_reverse = processed[:4]
+        df_original, label_ori = processed[4], processed[6]
+        model_estimate = Model_test(
+            label_reverse, label_ori, column_location, column_name
+        )
+        imputed = return_random_imputation(data)
+        mask = 1.0 - np.isnan(data)
+        # The first call encodes the ground truth once, as in the first epoch
+        model_estimate.model_test(data=imputed, mask=mask, df_original=df_original)
+        run_phases(
+            profiler,
+            name,
+            n_rows,
+            repeats,
+            lambda: model_estimate.model_test(
+                data=imputed, mask=mask, df_original=df_original
+            ),
+        )
+
+    elif name == "save_results":
+        processed = load_processed(config)
+        ps = return_performance_store(config, processed)
+        imputed = return_random_imputation(processed[0])
+        run_phases(
+            profiler,
+            name,
+            n_rows,
+            repeats,
+            lambda: ps.save_results(imputed_data=imputed, mask_df=processed[7]),
+        )
+
+    elif name == "combine_mice_imputations":
+        from mice_combine import combine_mice_imputations
+
+        write_mice_imputations(config, load_processed(config))
+        run_phases(
+            profiler,
+            name,
+            n_rows * config["n_imputations"],
+            repeats,
+            lambda: combine_mice_imputations(
+                config["cohort"],
+                config["miss_method"],
+                config["miss_ratio"],
+                0,
+                n_imputations=config["n_imputations"],
+                base_path=config["base_path"],
+                output_format=config["output_format"],
+            ),
+        )
+
+    elif name == "calculate_imputation_metrics":
+        from Imputation_metrics_calculator import (
+            calculate_imputation_metrics,
+            discover_imputed_files,
+        )
+
+        # Imputed datasets of save_results and combine_mice_imputations
+        cohort_folder = f"{config['cohort']}/{config['cohort']}_all/{config['miss_method']}/miss{config['miss_ratio']}/0"
+        if not table_path(config["base_path"] / f"data_gain/{cohort_folder}").exists():
+            processed = load_processed(config)
+            return_performance_store(config, processed).save_results(
+                imputed_data=return_random_imputation(processed[0]),
+                mask_df=processed[7],
+            )
+        n_files = len(discover_imputed_files(config["base_path"]))
+        run_phases(
+            profiler,
+            name,
+            n_rows * n_files,
+            repeats,
+            lambda: calculate_imputation_metrics(
+                config["base_path"], n_workers=config["workers"]
+            ),
+        )
+
+    else:
+        raise ValueError(f"Unknown benchmark: {name}")
+
+    profiler.finish()
+    timed = [record for record in profiler.records if record["phase"] == name]
+    traced = [record for record in profiler.records if record["phase"] != name][0]
+    best = min(timed, key=lambda record: record["wall_time"])
+    return {
+        "wall_time": best["wall_time"],
+        "cpu_time": best["cpu_time"],
+        "throughput": best["items"] / best["wall_time"],
+        # Peak Python/NumPy heap of one call, without the setup and imports of the
+        # process. TensorFlow's own allocator and worker processes are not traced.
+        "peak_memory_mb": traced["python_heap_peak_mb"],
+        # Lifetime peak RSS of the process and of its workers, for reference only
+        "peak_rss_mb": max(
+            record["lifetime_peak_rss_mb"] for record in profiler.records
+        ),
+        "workers_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        / 1024.0,
+        "repeats": len(timed),
+    }
+
+
+def run_benchmarks(config, names):
+    """Run each benchmark in a fresh process and collect the results"""
+    results = {}
+    for name in names:
+        print(f"Running {name}...")
+        # A fresh process per benchmark keeps the peak RSS of the others out
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            results[name] = executor.submit(run_benchmark, name, config).result()
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance, min_time, min_memory):
+    """
+    Compare every benchmark to the baseline. A wall time or peak memory more than
+    `tolerance` (relative) above the baseline is a regression, when it is also more
+    than `min_time` seconds or `min_memory` MB above it, so that the noise of
+    millisecond-scale benchmarks is not reported.
+
+    Returns:
+        pd.DataFrame: One row per benchmark with the ratios to the baseline
+    """
+    rows = []
+    for name, result in results["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            rows.append({"benchmark": name, "status": "new"})
+            continue
+        time_ratio = result["wall_time"] / base["wall_time"]
+        memory_ratio = result["peak_memory_mb"] / max(base["peak_memory_mb"], 1e-9)
+        slower = (
+            time_ratio > 1.0 + tolerance
+            and result["wall_time"] - base["wall_time"] > min_time
+        )
+        larger = (
+            memory_ratio > 1.0 + tolerance
+            and result["peak_memory_mb"] - base["peak_memory_mb"] > min_memory
+        )
+        rows.append(
+            {
+                "benchmark": name,
+                "wall_time": result["wall_time"],
+                "baseline_wall_time": base["wall_time"],
+                "time_ratio": time_ratio,
+                "peak_memory_mb": result["peak_memory_mb"],
+                "baseline_peak_memory_mb": base["peak_memory_mb"],
+                "memory_ratio": memory_ratio,
+                "status": "regression" if slower or larger else "ok",
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def return_environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def main(args):
+    base_path = Path(args.base_path or tempfile.mkdtemp(prefix="cmie_benchmark_"))
+    config = {
+        "base_path": base_path,
+        "cohort": args.cohort,
+        "rows": args.rows,
+        "miss_method": args.miss_method,
+        "miss_ratio": args.miss_ratio,
+        "epochs": args.epochs,
+        "batch_size": args.batch_size,
+        "engine": args.engine,
+        "output_format": args.output_format,
+        "n_imputations": args.n_imputations,
+        "workers": args.workers,
+        "repeats": args.repeats,
+    }
+
+    try:
+        full_path = table_path(
+            base_path / f"Completed_data/{args.cohort}/{args.cohort}_all"
+        )
+        if args.regenerate or not full_path.exists():
+            print(f"Generating a synthetic {args.cohort} of {args.rows} rows...")
+            generate_cohort(
+                base_path,
+                cohort=args.cohort,
+                n_rows=args.rows,
+                miss_methods=[args.miss_method],
+                miss_ratios=[args.miss_ratio],
+                seed=args.seed,
+            )
+        results = {
+            "config": {key: config[key] for key in comparable_keys},
+            "environment": return_environment(),
+            "benchmarks": run_benchmarks(config, args.benchmarks),
+        }
+    finally:
+        if args.base_path is None:
+            shutil.rmtree(base_path, ignore_errors=True)
+
+    summary = pd.DataFrame(results["benchmarks"]).T
+    print(
+        summary[["wall_time", "cpu_time", "throughput", "peak_memory_mb"]].to_string()
+    )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not Path(args.baseline).exists():
+        print(f"No baseline at {args.baseline}, run with --save_baseline to store one.")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    different = {
+        key: (baseline["config"].get(key), results["config"][key])
+        for key in comparable_keys
+        if baseline["config"].get(key) != results["config"][key]
+    }
+    if different:
+        print(f"The baseline was run with other settings, not compared: {different}")
+        return 0
+
+    comparison = compare_to_baseline(
+        results, baseline, args.tolerance, args.min_time, args.min_memory
+    )
+    print(comparison.to_string(index=False))
+    # A non-zero exit code lets CI fail on regressions
+    return int((comparison["status"] == "regression").any())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="argparse")
+    parser.add_argument(
+        "--base_path",
+        type=str,
+        default=None,
+        help="Folder of the synthetic data_stored tree, kept and reused (default: a temporary folder).",
+    )
+    parser.add_argument("--cohort", type=str, default="C19")
+    parser.add_argument("--rows", type=int, default=20_000, help="Num of rows.")
+    parser.add_argument("--miss_method", type=str, default="MCAR")
+    parser.add_argument("--miss_ratio", type=int, default=20)
+    parser.add_argument(
+        "--epochs", type=int, default=2, help="Num of GAIN epochs trained."
+    )
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument(
+        "--engine", type=str, default="session", choices=["session", "tf_function"]
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="csv",
+        choices=["csv", "parquet", "feather"],
+    )
+    parser.add_argument(
+        "--n_imputations", type=int, default=5, help="Num of MICE imputations pooled."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Num of processes of the metrics."
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=7,
+        help="Timed runs of each benchmark, the best is kept.",
+    )
+    parser.add_argument(
+        "--benchmarks", nargs="+", default=benchmark_names, choices=benchmark_names
+    )
+    parser.add_argument("--seed", type=int, default=2025)
+    parser.add_argument(
+        "--regenerate",
+        action="store_true",
+        help="Regenerate the synthetic cohort even if base_path already holds one.",
+    )
+    parser.add_argument("--output", "-o", type=str, default="benchmark_results.json")
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=str(Path(__file__).resolve().parent / "baseline.json"),
+        help="The baseline JSON to compare to, or to save with --save_baseline.",
+    )
+    parser.add_argument(
+        "--save_baseline",
+        action="store_true",
+        help="Store the results as the new baseline instead of comparing.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown or memory growth reported as a regression.",
+    )
+    parser.add_argument(
+        "--min_time",
+        type=float,
+        default=0.05,
+        help="Slowdown in seconds below which no time regression is reported.",
+    )
+    parser.add_argument(
+        "--min_memory",
+        type=float,
+        default=16.0,
+        help="Memory growth in MB below which no memory regression is reported.",
+    )
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,211 @@
+#!/home/siyi.sun/miniconda3/bin python3
+# -*- coding: UTF-8 -*-
+"""
+@Description :   Synthetic cohorts with the schema of Completed_data/C19/C19_all
+@Author      :   siyi.sun
+@Time        :   2025/03/20 15:08:36
+"""
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from generate_miss_masks import generate_store
+from utils.mask_store import mask_store_path
+from utils.table_store import write_table
+
+# Categories of the C19 columns; the larger ones are generated by name and count
+religions = [
+    "Hindu",
+    "Muslim",
+    "Christian",
+    "Sikh",
+    "Buddhist",
+    "Jain",
+    "Others",
+    "Not Stated",
+]
+places_of_work = [
+    "Not Applicable",
+    "Home",
+    "Office",
+    "Factory",
+    "Field",
+    "Shop",
+    "Mobile",
+    "Others",
+]
+# 1-based positions of the columns that are never missing (WAVE_NO, STATE, HR, REGION_TYPE, GENDER)
+fixed_columns = [1, 2, 3, 4, 7]
+
+
+def return_income(rng, level, n_rows, zero_rate):
+    """Log-normal monthly incomes around `level`, rounded to rupees, with some zeros"""
+    income = np.round(level * rng.lognormal(0.0, 0.6, n_rows), 0)
+    income[rng.random(n_rows) < zero_rate] = 0.0
+    return income
+
+
+def generate_cohort_frame(n_rows, n_states=28, n_hr=102, seed=2025):
+    """
+    Full cohort with the columns, types and rough cardinalities of C19_all: member rows
+    of households observed in the three waves of 2019. Values are related the usual way
+    (HR inside a state, incomes by state and region, health by age), so that imputation
+    has something to learn.
+
+    Args:
+        n_rows (int): Num of rows
+        n_states (int): Num of categories of cat_STATE
+        n_hr (int): Num of homogeneous regions, cat_HR, nested in the states
+        seed (int): Seed of the generator
+
+    Returns:
+        pd.DataFrame: Synthetic cohort
+    """
+    rng = np.random.default_rng(seed)
+    # Every homogeneous region belongs to one state, and is mostly urban or rural
+    hr_state = np.arange(n_hr) % n_states
+    hr_urban = rng.random(n_hr)
+    hr = rng.integers(0, n_hr, n_rows)
+    state = hr_state[hr]
+    urban = rng.random(n_rows) < hr_urban[hr]
+    age = np.clip(np.round(rng.gamma(3.0, 10.0, n_rows)), 0, 99)
+    adult = age >= 15
+
+    # Income level of the household by state and region; members earn from 15 on
+    state_level = rng.uniform(8_000, 30_000, n_states)
+    hh_level = state_level[state] * np.where(urban, 1.4, 1.0)
+    data = {
+        "con_WAVE_NO": rng.integers(16, 19, n_rows).astype(np.float64),
+        "cat_STATE": np.array([f"STATE_{i:02d}" for i in range(n_states)])[state],
+        "cat_HR": np.array([f"HR_{i:03d}" for i in range(n_hr)])[hr],
+        "cat_REGION_TYPE": np.where(urban, "URBAN", "RURAL"),
+        "cat_MEM_STATUS": np.where(
+            rng.random(n_rows) < 0.05, "Immigrated", "Member of the household"
+        ),
+        "con_AGE_YRS": age,
+        "cat_GENDER": np.where(rng.random(n_rows) < 0.5, "M", "F"),
+        "cat_RELIGION": rng.choice(
+            religions, n_rows, p=[0.78, 0.12, 0.03, 0.02, 0.01, 0.01, 0.02, 0.01]
+        ),
+        "cat_PLACE_OF_WORK": np.where(
+            adult, rng.choice(places_of_work, n_rows), "Not Applicable"
+        ),
+        "con_TS_ON_WORK_FOR_EMPLOYER": np.where(
+            adult, np.round(rng.gamma(2.0, 120.0, n_rows)), 0.0
+        ),
+        "con_TS_ON_TRAVEL": np.round(rng.gamma(1.5, 20.0, n_rows)),
+        "con_TS_ON_OUTDOOR_SPORTS": np.round(rng.exponential(15.0, n_rows)),
+        "cat_IS_HOSPITALISED": (rng.random(n_rows) < 0.01 + age / 3000).astype(int),
+        "cat_HAS_BANK_AC": (rng.random(n_rows) < np.where(adult, 0.85, 0.2)).astype(
+            int
+        ),
+        "cat_HAS_MOBILE": (rng.random(n_rows) < np.where(adult, 0.9, 0.1)).astype(int),
+        # Imbalanced target of the downstream task
+        "cat_IS_HEALTHY": (rng.random(n_rows) > 0.03 + age / 400).astype(int),
+    }
+    for month in range(1, 5):
+        data[f"con_TOT_INC_{month}"] = return_income(rng, hh_level, n_rows, 0.02)
+    for month in range(1, 5):
+        data[f"con_INC_OF_HH_FRM_ALL_SRCS_{month}"] = data[f"con_TOT_INC_{month}"]
+    for month in range(1, 5):
+        data[f"con_INC_OF_MEM_FRM_ALL_SRCS_{month}"] = np.where(
+            adult, return_income(rng, hh_level / 3, n_rows, 0.4), 0.0
+        )
+    return pd.DataFrame(data)
+
+
+def generate_cohort(
+    base_path,
+    cohort="C19",
+    n_rows=10_000,
+    miss_methods=("MCAR",),
+    miss_ratios=(20,),
+    n_samples=1,
+    n_test_samples=1,
+    file_format="csv",
+    seed=2025,
+):
+    """
+    Write a synthetic cohort to Completed_data/{cohort}/{cohort}_all and its missing
+    masks to the mask store, in the layout of data_stored.
+
+    Args:
+        base_path (Path): Root of the synthetic data_stored tree
+        cohort (str): Cohort identifier
+        n_rows (int): Num of rows
+        miss_methods (list): Missing mechanisms of the masks
+        miss_ratios (list): Missing ratios (%) of the masks
+        n_samples (int): Num of masks for training
+        n_test_samples (int): Num of masks for the sample test
+        file_format (str): Format of the full data, "csv", "parquet" or "feather"
+        seed (int): Seed of the data and of the masks
+
+    Returns:
+        Path: Path of the full data
+    """
+    base_path = Path(base_path)
+    full_path = write_table(
+        generate_cohort_frame(n_rows, seed=seed),
+        base_path / f"Completed_data/{cohort}/{cohort}_all",
+        file_format,
+    )
+    for sampletest, samples in [(False, n_samples), (True, n_test_samples)]:
+        for miss_method in miss_methods:
+            for miss_ratio in miss_ratios:
+                generate_store(
+                    {
+                        "base_path": base_path,
+                        "cohort": cohort,
+                        "miss_method": miss_method,
+                        "miss_ratio": miss_ratio,
+                        "sampletest": sampletest,
+                        "n_samples": samples,
+                        "save_path": mask_store_path(
+                            base_path, cohort, miss_method, miss_ratio, sampletest
+                        ),
+                        "exclude_cols": fixed_columns,
+                        "seed": seed,
+                    }
+                )
+    return full_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="argparse")
+    parser.add_argument(
+        "--base_path",
+        type=str,
+        required=True,
+        help="The folder of the synthetic data_stored tree.",
+    )
+    parser.add_argument("--cohort", type=str, default="C19")
+    parser.add_argument("--rows", type=int, default=10_000, help="Num of rows.")
+    parser.add_argument("--methods", nargs="+", default=["MCAR", "MAR", "MNAR"])
+    parser.add_argument("--ratios", nargs="+", type=int, default=[10, 20, 30, 40, 50])
+    parser.add_argument(
+        "--samples", type=int, default=5, help="Num of masks for training."
+    )
+    parser.add_argument(
+        "--test_samples", type=int, default=1, help="Num of masks for the sample test."
+    )
+    parser.add_argument(
+        "--format", type=str, default="csv", choices=["csv", "parquet", "feather"]
+    )
+    parser.add_argument("--seed", type=int, default=2025)
+    args = parser.parse_args()
+    print(
+        generate_cohort(
+            args.base_path,
+            cohort=args.cohort,
+            n_rows=args.rows,
+            miss_methods=args.methods,
+            miss_ratios=args.ratios,
+            n_samples=args.samples,
+            n_test_samples=args.test_samples,
+            file_format=args.format,
+            seed=args.seed,
+        )
+    )
@@ -0,0 +1,250 @@
+#!/home/siyi.sun/miniconda3/bin python3
+# -*- coding: UTF-8 -*-
+"""
+@Description :   Generate MCAR/MAR/MNAR missing masks straight into the mask store
+@Author      :   siyi.sun
+@Time        :   2025/03/10 11:42:18
+"""
+
+import os
+import zlib
+import argparse
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from utils.mask_store import create_mask_store, mask_store_path, write_mask
+from utils.process_data import load_encoded_cohort
+
+miss_mechanisms = ["MCAR", "MAR", "MNAR"]
+
+
+def return_cell_rng(seed, cohort, miss_method, miss_ratio, sampletest, index_file):
+    """
+    Independent, reproducible RNG stream of one mask. The stream only depends on the
+    seed and the cell, so any mask can be regenerated alone, in any order.
+    """
+    spawn_key = (
+        zlib.crc32(cohort.encode()),
+        miss_mechanisms.index(miss_method),
+        int(miss_ratio),
+        int(sampletest),
+        int(index_file),
+    )
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=spawn_key))
+
+
+def load_numeric_cohort(base_path, cohort):
+    """
+    Full cohort as a float matrix for the logistic models: continuous values as they
+    are and categorical columns as their integer codes, like data.matrix in R. Each
+    column is standardized and missing entries are set to 0 (the column mean).
+
+    Returns:
+        data (np.ndarray), column_name (list)
+    """
+    columns = load_encoded_cohort(base_path, cohort)
+    data = np.empty((len(columns[0][2]), len(columns)), dtype=np.float64)
+    for j, (_, kind, values, _) in enumerate(columns):
+        data[:, j] = np.where(values < 0, np.nan, values) if kind == "cat" else values
+
+    mean = np.nanmean(data, axis=0)
+    std = np.nanstd(data, axis=0)
+    data = (data - mean) / np.where(std > 0, std, 1.0)
+    data[np.isnan(data)] = 0.0
+    return data, [column[0] for column in columns]
+
+
+def pick_coeffs(data, idxs_obs, idxs_nas, rng):
+    """
+    Random weights of the logistic model of every amputed column, scaled so that each
+    linear predictor has unit standard deviation.
+    """
+    coeffs = rng.standard_normal((len(idxs_obs), len(idxs_nas)))
+    scale = np.std(data[:, idxs_obs] @ coeffs, axis=0)
+    return coeffs / np.where(scale > 0, scale, 1.0)
+
+
+def fit_intercepts(logits, p, n_iter=60):
+    """
+    Intercept of every column such that mean(sigmoid(logits + intercept)) = p.
+    All the columns are solved together by bisection, the mean is monotone in the intercept.
+    """
+    low = np.full(logits.shape[1], -50.0)
+    high = np.full(logits.shape[1], 50.0)
+    for _ in range(n_iter):
+        mid = (low + high) / 2.0
+        too_high = np.mean(1.0 / (1.0 + np.exp(-(logits + mid))), axis=0) > p
+        high = np.where(too_high, mid, high)
+        low = np.where(too_high, low, mid)
+    return (low + high) / 2.0
+
+
+def logistic_mask(data, idxs_obs, idxs_nas, p, rng):
+    """Bernoulli draws of the amputed columns with logistic probabilities given idxs_obs"""
+    coeffs = pick_coeffs(data, idxs_obs, idxs_nas, rng)
+    logits = data[:, idxs_obs] @ coeffs
+    intercepts = fit_intercepts(logits, p)
+    ps = 1.0 / (1.0 + np.exp(-(logits + intercepts)))
+    return rng.random(ps.shape) < ps
+
+
+def produce_mask(data, miss_method, p, included, rng, p_obs=0.3):
+    """
+    Missing mask (True for missing) of one amputation, following produce_NA.
+
+    - MCAR: every included entry is missing with probability p.
+    - MAR: a random fraction p_obs of the included columns stays fully observed and
+      drives a logistic model giving the missing probability of the other columns.
+    - MNAR: a random fraction p_obs of the included columns drives the logistic model
+      of the other columns and is then itself masked completely at random, so the
+      missingness depends on values that may be missing.
+
+    Args:
+        data (np.ndarray): Standardized numeric data, shape (rows, columns)
+        miss_method (str): "MCAR", "MAR" or "MNAR"
+        p (float): Missing proportion of the amputed columns
+        included (np.ndarray): Indices of the columns that can be missing
+        rng (np.random.Generator): RNG stream of this mask
+        p_obs (float): Fraction of the included columns used as covariates (MAR/MNAR)
+
+    Returns:
+        np.ndarray: Boolean mask, shape (rows, columns)
+    """
+    n_rows, n_cols = data.shape
+    mask = np.zeros((n_rows, n_cols), dtype=bool)
+
+    if miss_method == "MCAR":
+        mask[:, included] = rng.random((n_rows, len(included))) < p
+        return mask
+
+    n_obs = min(max(int(p_obs * len(included)), 1), len(included) - 1)
+    perm = rng.permutation(included)
+    idxs_obs, idxs_nas = np.sort(perm[:n_obs]), np.sort(perm[n_obs:])
+    mask[:, idxs_nas] = logistic_mask(data, idxs_obs, idxs_nas, p, rng)
+
+    if miss_method == "MNAR":
+        mask[:, idxs_obs] = rng.random((n_rows, n_obs)) < p
+    elif miss_method != "MAR":
+        raise ValueError(f"Unknown missing mechanism: {miss_method}")
+    return mask
+
+
+def generate_store(cell):
+    """
+    Generate all the masks of one (cohort, mechanism, ratio, sampletest) store.
+
+    Returns:
+        tuple: (cohort, miss_method, miss_ratio, sampletest, observed missing rate)
+    """
+    base_path = cell["base_path"]
+    data, column_name = load_numeric_cohort(base_path, cell["cohort"])
+    excluded = [i - 1 for i in cell["exclude_cols"]]
+    included = np.array([j for j in range(len(column_name)) if j not in excluded])
+
+    # Fill a temporary store so an interrupted run never leaves a partial one behind
+    save_path = cell["save_path"]
+    tmp_path = save_path.with_name(f"{save_path.stem}.{os.getpid()}.tmp.npy")
+    store = create_mask_store(tmp_path, column_name, data.shape[0], cell["n_samples"])
+    miss_rate = []
+    for index_file in range(cell["n_samples"]):
+        rng = return_cell_rng(
+            cell["seed"],
+            cell["cohort"],
+            cell["miss_method"],
+            cell["miss_ratio"],
+            cell["sampletest"],
+            index_file,
+        )
+        mask = produce_mask(
+            data, cell["miss_method"], cell["miss_ratio"] / 100, included, rng
+        )
+        write_mask(store, index_file, mask)
+        miss_rate.append(mask[:, included].mean())
+    store.flush()
+    del store
+    os.replace(tmp_path.with_suffix(".json"), save_path.with_suffix(".json"))
+    os.replace(tmp_path, save_path)
+
+    return (
+        cell["cohort"],
+        cell["miss_method"],
+        cell["miss_ratio"],
+        cell["sampletest"],
+        float(np.mean(miss_rate)),
+    )
+
+
+def generate_masks(args):
+    """Generate the masks of the whole grid, one store per worker task"""
+    base_path = Path(args.base_path)
+    cells = []
+    for cohort in args.cohorts:
+        # Build the encoded cache once before the workers read it
+        load_encoded_cohort(base_path, cohort)
+        for sampletest, n_samples in [(False, args.samples), (True, args.test_samples)]:
+            for miss_method in args.methods:
+                for miss_ratio in args.ratios:
+                    save_path = mask_store_path(
+                        base_path, cohort, miss_method, miss_ratio, sampletest
+                    )
+                    if save_path.exists() and not args.overwrite:
+                        print(f"File already exists: {save_path}")
+                        continue
+                    cells.append(
+                        {
+                            "base_path": base_path,
+                            "cohort": cohort,
+                            "miss_method": miss_method,
+                            "miss_ratio": miss_ratio,
+                            "sampletest": sampletest,
+                            "n_samples": n_samples,
+                            "save_path": save_path,
+                            "exclude_cols": args.exclude_cols,
+                            "seed": args.seed,
+                        }
+                    )
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(generate_store, cell) for cell in cells]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            cohort, miss_method, miss_ratio, sampletest, rate = future.result()
+            print(
+                f"Generated {cohort} {miss_method} miss{miss_ratio}"
+                f"{' (sample test)' if sampletest else ''}: missing rate {rate:.3f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="argparse")
+    parser.add_argument(
+        "--base_path",
+        type=str,
+        default="/home/siyi.sun/CMIE_Project/data_stored",
+        help="The folder holding Completed_data and the mask trees.",
+    )
+    parser.add_argument("--cohorts", nargs="+", default=["C19"])
+    parser.add_argument("--methods", nargs="+", default=miss_mechanisms)
+    parser.add_argument("--ratios", nargs="+", type=int, default=[10, 20, 30, 40, 50])
+    parser.add_argument(
+        "--samples", type=int, default=5, help="Num of masks for training."
+    )
+    parser.add_argument(
+        "--test_samples", type=int, default=1, help="Num of masks for the sample test."
+    )
+    parser.add_argument(
+        "--exclude_cols",
+        nargs="+",
+        type=int,
+        default=[1, 2, 3, 4, 7],
+        help="1-based positions of the columns that are never missing.",
+    )
+    parser.add_argument("--seed", type=int, default=2025)
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Num of stores generated in parallel."
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="Regenerate the existing stores."
+    )
+    args = parser.parse_args()
+    generate_masks(args)
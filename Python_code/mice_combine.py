@@ -10,13 +10,52 @@
 import pandas as pd
 import numpy as np
 from pathlib import Path
-from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 import gc
+from utils.mask_store import load_mask_frame
+from utils.table_store import read_table, write_table
+
+
+def pool_categorical_mode(values):
+    """
+    Most common value of each row across the imputations.
+
+    Args:
+        values (np.ndarray): Values of one column, shape (n_imputations, n_rows)
+
+    Returns:
+        np.ndarray: Mode of each row. Ties go to the value seen first, in the order
+        of the imputations, as with Counter.most_common.
+    """
+    n_imputations, n_rows = values.shape
+    codes, uniques = pd.factorize(values.ravel())
+    codes = codes.reshape(n_imputations, n_rows)
+
+    # Votes for the value of each imputation: O(m^2) comparisons of code arrays,
+    # which keeps memory at O(m * rows) whatever the number of categories
+    votes = np.zeros((n_imputations, n_rows), dtype=np.int64)
+    for i in range(n_imputations):
+        votes += codes == codes[i]
+    votes[codes < 0] = -1
+
+    # argmax takes the first imputation among ties
+    mode_codes = codes[np.argmax(votes, axis=0), np.arange(n_rows)]
+    lookup = np.append(np.asarray(uniques, dtype=object), np.nan)
+    # codes of -1 pick the trailing NaN
+    return lookup[mode_codes]
 
 
 def combine_mice_imputations(
-    cohort, miss_method, miss_ratio, index_file, n_imputations=5
+    cohort,
+    miss_method,
+    miss_ratio,
+    index_file,
+    n_imputations=5,
+    rubin_variance=False,
+    base_path=Path("/home/siyi.sun/CMIE_Project/data_stored"),
+    output_format="csv",
+    return_path=False,
 ):
     """
     Combine multiple MICE-imputed datasets with specific handling for continuous and categorical variables.
@@ -27,15 +66,21 @@ def combine_mice_imputations(
         miss_ratio (str): Missing ratio identifier
         index_file (str): Index file identifier
         n_imputations (int): Number of imputations to combine (default=5)
+        rubin_variance (bool): Whether to also save the variance of the pooled continuous
+            values, {index_file}_variance. Each imputed value is a point estimate
+            without within-imputation variance, so Rubin's total variance reduces to
+            (1 + 1/m) times the between-imputation variance.
+        base_path (Path): Base path containing all the data directories
+        output_format (str): Format of the combined dataset, "csv", "parquet" or "feather"
+        return_path (bool): Whether to return the path of the combined dataset instead
+            of the dataset, so a pool worker does not pickle the frame back
 
     Returns:
-        pd.DataFrame: Combined dataset with imputed values
+        pd.DataFrame or Path: Combined dataset with imputed values, or its path
     """
     # Define paths
-    base_path = Path("/home/siyi.sun/CMIE_Project/data_stored")
     input_pattern = f"data_mice_store/{cohort}/{cohort}_all/{miss_method}/miss{miss_ratio}/{index_file}"
     output_pattern = f"data_mice/{cohort}/{cohort}_all/{miss_method}/miss{miss_ratio}"
-    mask_path = f"data_miss_mask/{cohort}/{cohort}_all/{miss_method}/miss{miss_ratio}/{index_file}.csv"
 
     # Create all necessary directories in the output path
     output_dir = base_path / output_pattern
@@ -44,59 +89,80 @@ def combine_mice_imputations(
     # Read all imputed datasets
     imputed_dfs = []
     for i in range(n_imputations):
-        file_path = base_path / input_pattern / f"{i}.csv"
-        df = pd.read_csv(file_path)
+        # Each imputation is read from whichever format it is stored in
+        df = read_table(base_path / input_pattern / f"{i}")
         imputed_dfs.append(df)
 
     # Read the mask
-    mask_df = pd.read_csv(base_path / mask_path)
-    mask_df = mask_df.astype(bool)
+    mask_df = load_mask_frame(base_path, cohort, miss_method, miss_ratio, index_file)
+
+    columns = imputed_dfs[0].columns
+    con_cols = [column for column in columns if column.startswith("con_")]
+    cat_cols = [column for column in columns if column.startswith("cat_")]
+
+    combined = {}
+    # Continuous variables: mean across all imputations in one reduction
+    if con_cols:
+        con_values = np.stack(
+            [df[con_cols].to_numpy(dtype=np.float64) for df in imputed_dfs]
+        )
+        con_mean = con_values.mean(axis=0)
+        combined.update(zip(con_cols, con_mean.T))
+
+    # Categorical variables: most common value for each position
+    for column in cat_cols:
+        combined[column] = pool_categorical_mode(
+            np.stack([df[column].to_numpy(dtype=object) for df in imputed_dfs])
+        )
+
+    # Other columns (copy from first imputation)
+    for column in columns:
+        if column not in combined:
+            combined[column] = imputed_dfs[0][column].to_numpy()
 
-    # Initialize the combined DataFrame with the structure of the first imputed dataset
     combined_df = pd.DataFrame(
-        index=imputed_dfs[0].index, columns=imputed_dfs[0].columns
+        {column: combined[column] for column in columns}, index=imputed_dfs[0].index
     )
 
-    # Process each column
-    for column in combined_df.columns:
-        if column.startswith("con_"):  # Continuous variables
-            # Calculate mean across all imputations
-            column_values = np.mean([df[column].values for df in imputed_dfs], axis=0)
-
-        elif column.startswith("cat_"):  # Categorical variables
-            # Get most common value for each position
-            column_values = []
-            for pos in range(len(combined_df)):
-                values = [df[column].iloc[pos] for df in imputed_dfs]
-                most_common = Counter(values).most_common(1)[0][0]
-                column_values.append(most_common)
-
-        else:  # Other columns (copy from first imputation)
-            column_values = imputed_dfs[0][column].values
-
-        combined_df[column] = column_values
-
     # Save the combined dataset
-    output_file = output_dir / f"{index_file}.csv"
     combined_df = combined_df.mask(~mask_df, 0)
-    combined_df.to_csv(output_file, index=False)
-
-    return combined_df
-
-
-cohorts = ["C19"]
-miss_ratios = [10, 20, 30, 40, 50]
-miss_methods = ["MNAR"]
-Sampletime = 5
-for cohort in cohorts:
-    for miss_method in miss_methods:
-        for miss_ratio in tqdm(miss_ratios):
-            for index_file in tqdm(range(Sampletime)):
-                combined_df = combine_mice_imputations(
-                    cohort=cohort,
-                    miss_method=miss_method,
-                    miss_ratio=miss_ratio,
-                    index_file=index_file,
-                )
-
-gc.collect()
+    output_path = write_table(combined_df, output_dir / f"{index_file}", output_format)
+
+    if rubin_variance and con_cols:
+        ddof = 1 if n_imputations > 1 else 0
+        total_variance = (1.0 + 1.0 / n_imputations) * con_values.var(axis=0, ddof=ddof)
+        variance_df = pd.DataFrame(
+            total_variance, columns=con_cols, index=combined_df.index
+        )
+        variance_df = variance_df.mask(~mask_df[con_cols], 0)
+        write_table(variance_df, output_dir / f"{index_file}_variance", output_format)
+
+    return output_path if return_path else combined_df
+
+
+if __name__ == "__main__":
+    cohorts = ["C19"]
+    miss_ratios = [10, 20, 30, 40, 50]
+    miss_methods = ["MNAR"]
+    Sampletime = 5
+    n_workers = 5  # num of files combined in parallel
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(
+                combine_mice_imputations,
+                cohort=cohort,
+                miss_method=miss_method,
+                miss_ratio=miss_ratio,
+                index_file=index_file,
+                return_path=True,
+            )
+            for cohort in cohorts
+            for miss_method in miss_methods
+            for miss_ratio in miss_ratios
+            for index_file in range(Sampletime)
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
+
+    gc.collect()
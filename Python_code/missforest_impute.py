@@ -8,10 +8,15 @@
 
 import pandas as pd
 import time
+import argparse
+import resource
+import multiprocessing
 from pathlib import Path
 from missforest import MissForest
+from lightgbm import LGBMClassifier, LGBMRegressor
 import numpy as np
 from tqdm import tqdm
+from utils.mask_store import load_mask_frame
 
 
 def round_imputed_values(df):
@@ -25,68 +30,147 @@ def round_imputed_values(df):
     return df
 
 
-# Define cohorts, missing methods, and ratios
-cohorts = ["C19"]
-missing_methods = ["MCAR", "MAR", "MNAR"]
-missing_ratios = [10, 20, 30, 40, 50]
-SampleTime = 5
-base_path = Path("/home/siyi.sun/CMIE_Project/data_stored")
-missforest_path = "data_missforest/"
+def impute_cell(cell):
+    """
+    Run MissForest on one (cohort, mechanism, ratio, sample) cell and save the result.
+    Each cell runs in a fresh worker process, so the peak RSS is the one of this cell.
 
-# Output path for time recording
-output_file = Path("/home/siyi.sun/CMIE_Project/imputation_times_missforest.csv")
-time_records = []
+    Returns:
+        dict: Time record of the cell
+    """
+    base_path = cell["base_path"]
+    cohort = cell["cohort"]
+    miss_method = cell["miss_method"]
+    miss_ratio = cell["miss_ratio"]
+    index_file = cell["index_file"]
 
-for cohort in cohorts:
     full_path = base_path / f"Completed_data/{cohort}/{cohort}_all.csv"
     full_data = pd.read_csv(full_path, header=0)
-
-    for miss_method in tqdm(missing_methods):
-        for miss_ratio in tqdm(missing_ratios):
-            save_dir = (
-                f"data_missforest/{cohort}/{cohort}_all/{miss_method}/miss{miss_ratio}"
+    mask_n = load_mask_frame(base_path, cohort, miss_method, miss_ratio, index_file)
+    miss_data = full_data.mask(mask_n)
+
+    # Measure imputation time
+    start_time = time.time()
+
+    # The default LightGBM estimators of MissForest, limited to n_jobs threads
+    mf = MissForest(
+        clf=LGBMClassifier(n_jobs=cell["n_jobs"]),
+        rgr=LGBMRegressor(n_jobs=cell["n_jobs"]),
+        max_iter=cell["max_iter"],
+    )
+    imputed_data = mf.fit_transform(
+        x=miss_data,
+        categorical=[c for c in miss_data.columns if c.startswith("cat_")],
+    )
+
+    end_time = time.time()
+
+    # Save imputed data
+    imputed_data = round_imputed_values(imputed_data.mask(~mask_n))
+    imputed_data.to_csv(cell["save_path"], index=False)
+
+    return {
+        "Dataset": cohort,
+        "Mechanism": miss_method,
+        "MissingRatio": miss_ratio,
+        "Sample": index_file,
+        "Time": end_time - start_time,
+        # ru_maxrss is in kilobytes on Linux
+        "PeakRSS_MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def run_missforest(args):
+    """Impute every missing cell of the sweep on a process pool, skipping finished cells"""
+    base_path = Path(args.base_path)
+    output_file = Path(args.output_file)
+    cell_file = output_file.with_name(output_file.stem + "_cells.csv")
+
+    cells = []
+    for cohort in args.cohorts:
+        for miss_method in args.methods:
+            for miss_ratio in args.ratios:
+                save_dir = f"data_missforest/{cohort}/{cohort}_all/{miss_method}/miss{miss_ratio}"
+                output_dir = base_path / save_dir
+                output_dir.mkdir(parents=True, exist_ok=True)
+
+                for index_file in range(args.samples):
+                    save_path = output_dir / f"{index_file}.csv"
+                    if save_path.exists():
+                        print(
+                            f"{miss_method}, {miss_ratio}, {index_file} exists, skipped."
+                        )
+                        continue
+                    cells.append(
+                        {
+                            "base_path": base_path,
+                            "cohort": cohort,
+                            "miss_method": miss_method,
+                            "miss_ratio": miss_ratio,
+                            "index_file": index_file,
+                            "save_path": save_path,
+                            "n_jobs": args.n_jobs,
+                            "max_iter": args.max_iter,
+                        }
+                    )
+
+    # Records of earlier runs are kept, so the averages cover resumed sweeps too
+    cell_records = pd.read_csv(cell_file) if cell_file.exists() else pd.DataFrame()
+
+    with multiprocessing.Pool(processes=args.workers, maxtasksperchild=1) as pool:
+        for record in tqdm(pool.imap_unordered(impute_cell, cells), total=len(cells)):
+            cell_records = pd.concat(
+                [cell_records, pd.DataFrame([record])], ignore_index=True
             )
-            output_dir = base_path / save_dir
-            output_dir.mkdir(parents=True, exist_ok=True)
-
-            imputation_times = []  # Store times for averaging
-
-            for index_file in tqdm(range(SampleTime)):
-                mask_path = (
-                    base_path
-                    / f"data_miss_mask/{cohort}/{cohort}_all/{miss_method}/miss{miss_ratio}/{index_file}.csv"
-                )
-                mask_n = pd.read_csv(mask_path, header=0).astype(bool)
-                miss_data = full_data.mask(mask_n)
-
-                # Measure imputation time
-                start_time = time.time()
-
-                mf = MissForest(max_iter=20)
-                imputed_data = mf.fit_transform(
-                    x=miss_data,
-                    categorical=[c for c in miss_data.columns if c.startswith("cat_")],
-                )
-
-                end_time = time.time()
-                imputation_time = end_time - start_time
-                imputation_times.append(imputation_time)
-
-                # Save imputed data
-                save_path = output_dir / f"{index_file}.csv"
-                imputed_data = round_imputed_values(imputed_data.mask(~mask_n))
-                imputed_data.to_csv(save_path, index=False)
-
-            # Compute average time
-            avg_time = sum(imputation_times) / SampleTime
-
-            # Store result
-            time_records.append([cohort, miss_method, miss_ratio, avg_time])
-
-            # Save results to CSV
-            time_df = pd.DataFrame(
-                time_records,
-                columns=["Dataset", "Mechanism", "MissingRatio", "AvgTime"],
+            cell_records.to_csv(cell_file, index=False)
+
+            # Average time of each (cohort, mechanism, ratio)
+            time_df = (
+                cell_records.groupby(["Dataset", "Mechanism", "MissingRatio"])["Time"]
+                .mean()
+                .reset_index()
+                .rename(columns={"Time": "AvgTime"})
             )
             time_df.to_csv(output_file, index=False)
-            print(f"{miss_method}, {miss_ratio} Imputation times recorded.")
+            print(
+                f"{record['Mechanism']}, {record['MissingRatio']}, {record['Sample']} Imputation time recorded."
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="argparse")
+    parser.add_argument(
+        "--base_path",
+        type=str,
+        default="/home/siyi.sun/CMIE_Project/data_stored",
+        help="The data_stored folder.",
+    )
+    parser.add_argument(
+        "--output_file",
+        type=str,
+        default="/home/siyi.sun/CMIE_Project/imputation_times_missforest.csv",
+        help="Output path for time recording.",
+    )
+    parser.add_argument("--cohorts", type=str, nargs="+", default=["C19"])
+    parser.add_argument(
+        "--methods", type=str, nargs="+", default=["MCAR", "MAR", "MNAR"]
+    )
+    parser.add_argument("--ratios", type=int, nargs="+", default=[10, 20, 30, 40, 50])
+    parser.add_argument(
+        "--samples", type=int, default=5, help="Num of samples per missing ratio."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Num of cells imputed in parallel."
+    )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=None,
+        help="Num of threads of the estimators in each worker (default: cores / workers).",
+    )
+    parser.add_argument("--max_iter", type=int, default=20)
+    args = parser.parse_args()
+    if args.n_jobs is None:
+        args.n_jobs = max(1, multiprocessing.cpu_count() // args.workers)
+
+    run_missforest(args)
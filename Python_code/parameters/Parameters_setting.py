@@ -3,7 +3,9 @@ import tensorflow as tf
 
 
 class parameters_setting:
-    def __init__(self, model_name, data_shape, epoch=100):
+    def __init__(
+        self, model_name, data_shape, epoch=100, engine="session", xla_jit=False
+    ):
         """
         Common parameters for all deep learning models
         """
@@ -11,7 +13,11 @@ class parameters_setting:
         self.data_shape = data_shape  # Input data shape
         self.cross_validation = None  # Whether to do the cross-validation or not
         self.epoch = epoch  # Num of epochs
-        tf.compat.v1.disable_eager_execution()
+        # "session": TF1 graph with sess.run, "tf_function": compiled TF2 training step
+        self.engine = engine
+        self.xla_jit = xla_jit  # Whether to compile the tf_function step with XLA
+        if self.engine == "session":
+            tf.compat.v1.disable_eager_execution()
 
     def return_parameters(self):
         return self.return_gain_parameters()
@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+from utils.process_data import nearest_embedding, segment_argmax
 
 
 class Model_test:
@@ -11,6 +12,8 @@ class Model_test:
         self.label_ori = label_ori
         self.column_location = column_location
         self.column_name = column_name
+        self.context = None
+        self.context_source = None
 
     def return_accuary_for_con_cat(
         self, index, generate_i, mask_i, list_original_label
@@ -20,8 +23,6 @@ class Model_test:
             min_ = self.label_reverse[index][1][1]
             max_ori = self.label_ori[index][1][0]
             min_ori = self.label_ori[index][1][1]
-            if self.mode == "embedding":
-                generate_i = (generate_i + 1.0) / 2.0
             generate_i_re = generate_i * (max_ - min_) + min_
             generate_i_ori = (generate_i_re - min_ori) / (max_ori - min_ori)
             label_i_ori = np.array(list_original_label, np.float32).reshape(
@@ -40,7 +41,11 @@ class Model_test:
 
         else:
             dictionary = self.label_reverse[index][1][1]
-            generate_i_argmax = list(np.argmax(generate_i, axis=1))
+            if self.label_reverse[index][0] == "emb":
+                embedding = self.label_reverse[index][1][2]
+                generate_i_argmax = list(nearest_embedding(generate_i, embedding))
+            else:
+                generate_i_argmax = list(np.argmax(generate_i, axis=1))
             mask_i_argmax = mask_i[:, 0]
             label_i_argmax = list_original_label
             result = np.array(
@@ -93,39 +98,117 @@ class Model_test:
         df_miss = pd.concat(df_miss_list)
         return data, mask, df_full, df_miss
 
-    def model_test(self, data=None, mask=None, df_original=None):
-        result = []
+    def build_test_context(self, df_original):
+        """
+        Encode the ground truth once so every epoch is evaluated with a few array ops.
+        Continuous labels are min-max scaled with the full data range, and the generated
+        values get a per-column affine map to the same scale. Categorical labels become
+        their index in the one-hot block of the imputed data (-1 if never observed);
+        embedded columns keep their block and category embeddings for a nearest lookup.
+        """
+        boundaries = [0] + list(self.column_location)
+        con_pos, con_scale, con_shift, con_label = [], [], [], []
+        cat_start, cat_width, cat_label = [], [], []
+        emb_start, emb_end, emb_embedding, emb_label = [], [], [], []
 
         for index, i in enumerate(self.column_name):
-            if index == 0:
-                generate_i = data[:, 0 : self.column_location[index]]
-                mask_i = mask[:, 0 : self.column_location[index]]
-                list_original_label = df_original[i].to_list()
-                re = self.return_accuary_for_con_cat(
-                    index=index,
-                    generate_i=generate_i,
-                    mask_i=mask_i,
-                    list_original_label=list_original_label,
-                )
-                result.append(re)
+            start, end = boundaries[index], boundaries[index + 1]
+            if self.label_reverse[index][0] == "con":
+                max_ = self.label_reverse[index][1][0]
+                min_ = self.label_reverse[index][1][1]
+                max_ori = self.label_ori[index][1][0]
+                min_ori = self.label_ori[index][1][1]
+                label_i_ori = df_original[i].to_numpy(dtype=np.float64)
+                if max_ori != min_ori:
+                    scale = (max_ - min_) / (max_ori - min_ori)
+                    shift = (min_ - min_ori) / (max_ori - min_ori)
+                    label_i_ori = (label_i_ori - min_ori) / (max_ori - min_ori)
+                else:
+                    scale, shift = 0.0, 0.0
+                    label_i_ori = label_i_ori * 0.0
+                con_pos.append(start)
+                con_scale.append(scale)
+                con_shift.append(shift)
+                con_label.append(label_i_ori)
+            elif self.label_reverse[index][0] == "emb":
+                value_to_index = self.label_reverse[index][1][0]
+                label_i = df_original[i].map(value_to_index)
+                emb_start.append(start)
+                emb_end.append(end)
+                emb_embedding.append(self.label_reverse[index][1][2])
+                emb_label.append(label_i.fillna(-1).to_numpy(dtype=np.int64))
+            elif end > start:
+                value_to_index = self.label_reverse[index][1][0]
+                label_i = df_original[i].map(value_to_index)
+                cat_start.append(start)
+                cat_width.append(end - start)
+                cat_label.append(label_i.fillna(-1).to_numpy(dtype=np.int64))
+
+        n_rows = len(df_original)
+        cat_start = np.array(cat_start, dtype=np.int64)
+        cat_width = np.array(cat_width, dtype=np.int64)
+        self.context = {
+            "con_pos": np.array(con_pos, dtype=np.int64),
+            "con_scale": np.array(con_scale, dtype=np.float64),
+            "con_shift": np.array(con_shift, dtype=np.float64),
+            "con_label": np.stack(con_label, axis=1)
+            if con_label
+            else np.zeros((n_rows, 0)),
+            "cat_pos": np.concatenate(
+                [np.arange(s, s + w) for s, w in zip(cat_start, cat_width)]
+            ).astype(np.int64)
+            if len(cat_start)
+            else np.zeros(0, dtype=np.int64),
+            # segment starts inside the gathered categorical block
+            "cat_offset": np.cumsum(cat_width) - cat_width,
+            "cat_start": cat_start,
+            "cat_width": cat_width,
+            "cat_label": np.stack(cat_label, axis=1)
+            if cat_label
+            else np.zeros((n_rows, 0), dtype=np.int64),
+            "emb_start": emb_start,
+            "emb_end": emb_end,
+            "emb_embedding": emb_embedding,
+            "emb_label": emb_label,
+        }
+        self.context_source = df_original
 
-            else:
-                generate_i = data[
-                    :, self.column_location[index - 1] : self.column_location[index]
-                ]
-                mask_i = mask[
-                    :, self.column_location[index - 1] : self.column_location[index]
-                ]
-                list_original_label = df_original[i].to_list()
-                re = self.return_accuary_for_con_cat(
-                    index=index,
-                    generate_i=generate_i,
-                    mask_i=mask_i,
-                    list_original_label=list_original_label,
-                )
-                result.append(re)
-
-        con_loss, cat_accuray = self.return_con_loss_cat_accuary_test_result(
-            result=result
+    def model_test(self, data=None, mask=None, df_original=None):
+        if self.context is None or self.context_source is not df_original:
+            self.build_test_context(df_original)
+        ctx = self.context
+
+        # Continuous: squared error on the full-data scale over the missing entries
+        generate_con = data[:, ctx["con_pos"]].astype(np.float64)
+        generate_con = generate_con * ctx["con_scale"] + ctx["con_shift"]
+        miss_con = 1.0 - mask[:, ctx["con_pos"]]
+        con_loss = np.sum(((generate_con - ctx["con_label"]) ** 2) * miss_con)
+        con_mask_sum = np.sum(miss_con)
+
+        # Categorical: first argmax of every one-hot segment compared to the label index
+        cat_accuary, cat_mask_sum = 0.0, 0.0
+        if len(ctx["cat_start"]):
+            generate_argmax = segment_argmax(
+                data[:, ctx["cat_pos"]], ctx["cat_offset"], ctx["cat_width"]
+            )
+            miss_cat = 1.0 - mask[:, ctx["cat_start"]]
+            cat_accuary = np.sum((generate_argmax == ctx["cat_label"]) * miss_cat)
+            cat_mask_sum = np.sum(miss_cat)
+
+        # Embedded categorical: nearest category embedding compared to the label index
+        for start, end, embedding, label in zip(
+            ctx["emb_start"], ctx["emb_end"], ctx["emb_embedding"], ctx["emb_label"]
+        ):
+            generate_index = nearest_embedding(data[:, start:end], embedding)
+            miss_emb = 1.0 - mask[:, start]
+            cat_accuary = cat_accuary + np.sum((generate_index == label) * miss_emb)
+            cat_mask_sum = cat_mask_sum + np.sum(miss_emb)
+
+        if con_mask_sum == 0:
+            con_mask_sum = con_mask_sum + 1
+        if cat_mask_sum == 0:
+            cat_mask_sum = cat_mask_sum + 1
+
+        return float(np.sqrt(con_loss / con_mask_sum)), float(
+            cat_accuary / cat_mask_sum
         )
-        return con_loss, cat_accuray
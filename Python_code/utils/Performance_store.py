@@ -6,9 +6,12 @@
 @Time        :   2025/02/21 01:01:37
 """
 
+import json
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from utils.process_data import nearest_embedding, segment_argmax
+from utils.table_store import Table_appender
 
 
 class Performance_store:
@@ -26,6 +29,7 @@ class Performance_store:
         name: str,
         mode: str = "one_hot",
         index_pick: str = "continuous_first",
+        output_format: str = "csv",  # "csv", "parquet" or "feather"
     ):
         """Initialize the Performance_store object"""
         self.base_path = base_path
@@ -40,62 +44,337 @@ class Performance_store:
         self.column_name = column_name
         self.name = name
         self.index_pick = index_pick
+        self.output_format = output_format
+        self.decoder = None
 
-    def decode_column(self, index, values):
-        """Convert encoded values back to their original form"""
-        if self.label_reverse[index][0] == "con":
-            # Handle continuous values
-            max_val, min_val = self.label_reverse[index][1]
-            # Rescale to original range
-            original_values = np.round(values * (max_val - min_val) + min_val, 1)
-            return original_values.flatten().tolist()
-        else:
-            # Handle categorical values
-            dictionary = self.label_reverse[index][1][1]
-            # Convert one-hot encoded values back to categories
-            indices = np.argmax(values, axis=1)
-            return [dictionary[idx] for idx in indices]
+    def build_decoder(self):
+        """Precompute the positions, ranges and lookup arrays used to decode all columns at once"""
+        boundaries = [0] + list(self.column_location)
+        con_index, con_pos, con_max, con_min = [], [], [], []
+        cat_index, cat_start, cat_width, cat_lookup = [], [], [], []
+        emb_index, emb_start, emb_end, emb_embedding, emb_lookup = [], [], [], [], []
+
+        for i in range(len(self.column_name)):
+            start, end = boundaries[i], boundaries[i + 1]
+            if self.label_reverse[i][0] == "con":
+                max_val, min_val = self.label_reverse[i][1]
+                con_index.append(i)
+                con_pos.append(start)
+                con_max.append(max_val)
+                con_min.append(min_val)
+            elif self.label_reverse[i][0] == "emb":
+                dictionary = self.label_reverse[i][1][1]
+                emb_index.append(i)
+                emb_start.append(start)
+                emb_end.append(end)
+                emb_embedding.append(self.label_reverse[i][1][2])
+                emb_lookup.append(
+                    pd.Series(
+                        [dictionary[idx] for idx in range(len(dictionary))]
+                    ).to_numpy()
+                )
+            elif end > start:
+                dictionary = self.label_reverse[i][1][1]
+                cat_index.append(i)
+                cat_start.append(start)
+                cat_width.append(end - start)
+                # Let pandas infer the dtype, as it did for the list of categories
+                cat_lookup.append(
+                    pd.Series(
+                        [dictionary[idx] for idx in range(end - start)]
+                    ).to_numpy()
+                )
+
+        cat_width = np.array(cat_width, dtype=np.int64)
+        self.decoder = {
+            "con_index": con_index,
+            "con_pos": np.array(con_pos, dtype=np.int64),
+            "con_max": np.array(con_max, dtype=np.float64),
+            "con_min": np.array(con_min, dtype=np.float64),
+            "cat_index": cat_index,
+            "cat_pos": np.concatenate(
+                [np.arange(s, s + w) for s, w in zip(cat_start, cat_width)]
+            ).astype(np.int64)
+            if cat_index
+            else np.zeros(0, dtype=np.int64),
+            # segment starts inside the gathered categorical block
+            "cat_offset": np.cumsum(cat_width) - cat_width,
+            "cat_width": cat_width,
+            "cat_lookup": cat_lookup,
+            # embedded columns are decoded one block at a time by nearest embedding
+            "emb_index": emb_index,
+            "emb_start": emb_start,
+            "emb_end": emb_end,
+            "emb_embedding": emb_embedding,
+            "emb_lookup": emb_lookup,
+        }
 
     def create_imputed_dataframe(self, data):
         """Convert imputed data matrix to a dataframe with original column types"""
-        df_imputed = pd.DataFrame()
+        if self.decoder is None:
+            self.build_decoder()
+        dec = self.decoder
+        columns = {}
+
+        # Rescale all continuous columns to their original range together
+        con_values = np.round(
+            data[:, dec["con_pos"]] * (dec["con_max"] - dec["con_min"])
+            + dec["con_min"],
+            1,
+        )
+        for k, i in enumerate(dec["con_index"]):
+            columns[self.column_name[i]] = con_values[:, k]
+
+        # Argmax every one-hot segment in one pass and map the codes to categories
+        if dec["cat_index"]:
+            indices = segment_argmax(
+                data[:, dec["cat_pos"]], dec["cat_offset"], dec["cat_width"]
+            )
+            for k, i in enumerate(dec["cat_index"]):
+                columns[self.column_name[i]] = dec["cat_lookup"][k][indices[:, k]]
 
-        for i, col_name in enumerate(self.column_name):
-            col_data = (
-                data[:, : self.column_location[0]]
-                if i == 0
-                else data[:, self.column_location[i - 1] : self.column_location[i]]
+        for k, i in enumerate(dec["emb_index"]):
+            indices = nearest_embedding(
+                data[:, dec["emb_start"][k] : dec["emb_end"][k]],
+                dec["emb_embedding"][k],
             )
-            df_imputed[col_name] = self.decode_column(i, col_data)
+            columns[self.column_name[i]] = dec["emb_lookup"][k][indices]
 
-        return df_imputed
+        # Columns without any observed category cannot be decoded
+        return pd.DataFrame(
+            {
+                col_name: columns.get(col_name, np.full(data.shape[0], np.nan))
+                for col_name in self.column_name
+            }
+        )
 
-    def save_results(self, imputed_data, mask_df):
-        """Save imputed data to the appropriate directories"""
+    def return_save_path(self, draw=None):
+        """Path of the imputed dataset (or of one of its draws), its folder is created if needed"""
         # Construct base folder path
         save_folder = (
             self.base_path
             / f"data_gain/{self.cohort}/{self.cohort}_all/{self.miss_method}/miss{self.miss_ratio}"
         )
+        file_name = self.index_file
+        if draw is not None:
+            # Draws of one dataset are kept together, as the MICE imputations in data_mice_store
+            save_folder = (
+                self.base_path
+                / f"data_gain_store/{self.cohort}/{self.cohort}_all/{self.miss_method}/miss{self.miss_ratio}/{self.index_file}"
+            )
+            file_name = draw
 
         # Create directories if they do not exist
         save_folder.mkdir(parents=True, exist_ok=True)
 
         # Create full save path with index file
-        save_path = save_folder / f"{self.index_file}.csv"
+        return save_folder / f"{file_name}.{self.output_format}"
 
-        # Generate and save imputed dataframe
+    def save_results(self, imputed_data, mask_df):
+        """Save imputed data to the appropriate directories"""
+        # The whole cohort as a single chunk, so that the cat_ columns are stored with
+        # the same categories as in save_results_chunked (including the never-masked
+        # columns, which are all NaN in the output)
+        return self.save_results_chunked([(0, imputed_data)], mask_df)
+
+    def open_appender(self, draw=None):
+        """Table_appender of the imputed dataset, with the categories of every cat_ column"""
+        if self.decoder is None:
+            self.build_decoder()
+        return Table_appender(
+            self.return_save_path(draw),
+            self.output_format,
+            categories={
+                self.column_name[i]: lookup
+                for i, lookup in zip(
+                    self.decoder["cat_index"] + self.decoder["emb_index"],
+                    self.decoder["cat_lookup"] + self.decoder["emb_lookup"],
+                )
+            },
+        )
+
+    def append_results(self, appender, imputed_data, mask_chunk, nan_columns):
+        """Decode and mask one chunk of rows, then append it"""
         df_imputed = self.create_imputed_dataframe(imputed_data)
-        df_imputed = df_imputed.mask(~mask_df)
-        df_imputed.to_csv(save_path, index=False)
+        df_imputed = df_imputed.mask(~mask_chunk.reset_index(drop=True))
+        # Columns masked anywhere are float in the whole table, even in a chunk without NaN
+        for col in nan_columns:
+            if pd.api.types.is_integer_dtype(df_imputed[col]):
+                df_imputed[col] = df_imputed[col].astype(np.float64)
+        appender.append(df_imputed)
+
+    def save_results_chunked(self, imputed_chunks, mask_df):
+        """
+        Decode, mask and append the imputed data chunk by chunk, so only one chunk of
+        rows is held in memory at a time.
+
+        Args:
+            imputed_chunks (iterable): (first row, imputed rows) of consecutive chunks
+            mask_df (pd.DataFrame): Mask of the whole cohort, as in save_results
+
+        Returns:
+            Path: Path of the imputed dataset
+        """
+        nan_columns = mask_df.columns[(~mask_df).any().to_numpy()]
+        with self.open_appender() as appender:
+            for start, imputed_data in imputed_chunks:
+                mask_chunk = mask_df.iloc[start : start + imputed_data.shape[0]]
+                self.append_results(appender, imputed_data, mask_chunk, nan_columns)
+        return appender.path
+
+    @staticmethod
+    def return_mode_codes(codes):
+        """
+        Most common code of every position across the draws, ties going to the
+        earliest draw as in mice_combine.pool_categorical_mode.
+
+        Args:
+            codes (np.ndarray): Category codes, shape (n_draws, rows, ...)
 
-    def select_best_index(self, continuous_metrics, categorical_accuracies):
-        """Select the best index based on the strategy"""
+        Returns:
+            np.ndarray: Mode of the codes, shape (rows, ...)
+        """
+        # Votes for the category of each draw, O(n_draws^2) comparisons of code arrays
+        votes = np.zeros(codes.shape, dtype=np.int64)
+        for k in range(codes.shape[0]):
+            votes += codes == codes[k]
+        return np.take_along_axis(codes, np.argmax(votes, axis=0)[None], axis=0)[0]
+
+    def pool_draws(self, draws):
+        """
+        Pool several imputations of the same rows in the encoded space: mean of the
+        continuous features and mode of the categories.
+
+        Args:
+            draws (np.ndarray): Imputed data, shape (n_draws, rows, features)
+
+        Returns:
+            np.ndarray: Pooled imputed data, shape (rows, features)
+        """
+        if self.decoder is None:
+            self.build_decoder()
+        dec = self.decoder
+        pooled = draws.mean(axis=0)
+        n_draws, n_rows, _ = draws.shape
+
+        if dec["cat_index"]:
+            codes = segment_argmax(
+                draws[:, :, dec["cat_pos"]].reshape(n_draws * n_rows, -1),
+                dec["cat_offset"],
+                dec["cat_width"],
+            ).reshape(n_draws, n_rows, -1)
+            mode = self.return_mode_codes(codes)
+
+            # One-hot of the mode in every categorical segment
+            cat_block = np.zeros((n_rows, len(dec["cat_pos"])), dtype=pooled.dtype)
+            np.put_along_axis(cat_block, mode + dec["cat_offset"], 1.0, axis=1)
+            pooled[:, dec["cat_pos"]] = cat_block
+
+        # Embedding of the mode of every embedded column
+        for start, end, embedding in zip(
+            dec["emb_start"], dec["emb_end"], dec["emb_embedding"]
+        ):
+            codes = nearest_embedding(
+                draws[:, :, start:end].reshape(n_draws * n_rows, -1), embedding
+            ).reshape(n_draws, n_rows)
+            pooled[:, start:end] = embedding[self.return_mode_codes(codes)]
+        return pooled
+
+    def save_draws_chunked(self, draw_chunks, mask_df, n_draws, pool=True):
+        """
+        Save several imputations of the cohort, chunk by chunk: pooled into the
+        imputed dataset, or every draw to data_gain_store/.../{index_file}/{draw}.
+
+        Args:
+            draw_chunks (iterable): (first row, imputed rows of every draw) of
+                consecutive chunks, the rows of shape (n_draws, rows, features)
+            mask_df (pd.DataFrame): Mask of the whole cohort, as in save_results
+            n_draws (int): Num of draws
+            pool (bool): Whether to save the pooled imputation instead of the draws
+
+        Returns:
+            list: Paths of the saved datasets
+        """
+        if pool:
+            return [
+                self.save_results_chunked(
+                    ((start, self.pool_draws(draws)) for start, draws in draw_chunks),
+                    mask_df,
+                )
+            ]
+
+        appenders = [self.open_appender(draw) for draw in range(n_draws)]
+        nan_columns = mask_df.columns[(~mask_df).any().to_numpy()]
+        try:
+            for start, draws in draw_chunks:
+                mask_chunk = mask_df.iloc[start : start + draws.shape[1]]
+                for appender, imputed_data in zip(appenders, draws):
+                    self.append_results(appender, imputed_data, mask_chunk, nan_columns)
+        except BaseException:
+            for appender in appenders:
+                appender.discard()
+            raise
+        # The draws are moved in order, so the last one exists only once all are saved
+        return [appender.close() for appender in appenders]
+
+    def return_monitor_value(self, continuous_metric, categorical_accuracy):
+        """Value to minimize when tracking the best epoch, following the strategy"""
         if self.index_pick == "continuous_first":
-            # Select index with minimum continuous error
-            if continuous_metrics:
-                return continuous_metrics.index(min(continuous_metrics)) + 1
-        else:
-            if not categorical_accuracies:
-                raise ValueError("categorical_accuracies is empty")
-            return categorical_accuracies.index(max(categorical_accuracies)) + 1
+            return continuous_metric
+        return -categorical_accuracy
+
+    def return_layout(self):
+        """
+        Encoded layout of the data as a JSON string: the kind, end position and
+        categories of every column. Two masks can give the same total width with
+        different one-hot segments, so weights are only reused on an equal layout.
+        """
+        boundaries = [0] + list(self.column_location)
+        columns = []
+        for i, name in enumerate(self.column_name):
+            kind, info = self.label_reverse[i]
+            column = {"name": name, "kind": kind, "end": int(boundaries[i + 1])}
+            if kind != "con":
+                column["categories"] = [info[1][idx] for idx in range(len(info[1]))]
+            columns.append(column)
+        return json.dumps(columns, default=str)
+
+    def save_checkpoint(self, weights):
+        """Save the generator and discriminator weights of the best sample-test epoch"""
+        save_folder = (
+            self.base_path
+            / f"checkpoint_gain_sample/{self.cohort}/{self.cohort}_all/{self.miss_method}/miss{self.miss_ratio}"
+        )
+        save_folder.mkdir(parents=True, exist_ok=True)
+        save_path = save_folder / f"{self.index_file}.npz"
+
+        arrays = {"layout": np.array(self.return_layout())}
+        for name, values in zip(["G", "D"], weights):
+            for i, value in enumerate(values):
+                arrays[f"{name}_{i}"] = value
+        np.savez(save_path, **arrays)
+        return save_path
+
+    def load_checkpoint(self, checkpoint_path):
+        """
+        Load the weights saved by save_checkpoint, if they were trained on the layout of
+        this data (see return_layout).
+
+        Returns:
+            list: Generator and discriminator weights, None if the layouts differ
+        """
+        with np.load(checkpoint_path) as checkpoint:
+            if (
+                "layout" not in checkpoint.files
+                or str(checkpoint["layout"]) != self.return_layout()
+            ):
+                return None
+            return [
+                [
+                    checkpoint[f"{name}_{i}"]
+                    for i in range(
+                        sum(key.startswith(f"{name}_") for key in checkpoint.files)
+                    )
+                ]
+                for name in ["G", "D"]
+            ]
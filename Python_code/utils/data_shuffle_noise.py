@@ -6,6 +6,8 @@
 @Time        :   2025/02/21 01:01:04
 """
 
+import queue
+import threading
 import numpy as np
 
 
@@ -48,3 +50,67 @@ class data_shuffle_noise:
         train_m = train_mask[idx]
         train_d = self._add_noise_(train_data=train_d, train_mask=train_m)
         return train_d, train_m
+
+    def batch_generator(self, train_data, train_mask, batch_size, hint_fn):
+        """
+        Yield shuffled (data, mask, hint) batches without copying the whole arrays.
+        Only the row indices are shuffled; noise and hints are drawn per batch.
+        The last incomplete batch is dropped.
+        """
+        idx = np.random.permutation(train_data.shape[0])
+        for iteration in range(int(train_data.shape[0] / batch_size)):
+            batch_idx = idx[iteration * batch_size : (iteration + 1) * batch_size]
+            train_m_batch = train_mask[batch_idx]
+            train_d_batch = self._add_noise_(
+                train_data=train_data[batch_idx], train_mask=train_m_batch
+            )
+            train_h_batch = hint_fn(train_m_batch=train_m_batch)
+            yield (
+                np.float32(train_d_batch),
+                np.float32(train_m_batch),
+                np.float32(train_h_batch),
+            )
+
+    def prefetch_batches(self, batches, buffer_size=4):
+        """
+        Run a batch generator in a background thread to prefetch batches.
+        An exception of the generator is raised again in the consumer, and a consumer
+        that stops early (e.g. sess.run raises) stops the thread as well.
+        """
+        buffer = queue.Queue(maxsize=buffer_size)
+        stop = threading.Event()
+        errors = []
+        end = object()
+
+        def put(item):
+            # Wait for a free slot, unless the consumer has stopped
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in batches:
+                    if not put(batch):
+                        return
+            except BaseException as error:
+                errors.append(error)
+            put(end)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = buffer.get()
+                if batch is end:
+                    break
+                yield batch
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+            thread.join()
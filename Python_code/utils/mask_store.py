@@ -0,0 +1,183 @@
+#!/home/siyi.sun/miniconda3/bin python3
+# -*- coding: UTF-8 -*-
+"""
+@Description :   Bit-packed, memory-mapped store for the missing masks
+@Author      :   siyi.sun
+@Time        :   2025/03/02 14:20:31
+"""
+import os
+import re
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+
+def mask_root(base_path, sampletest=False):
+    """Return the root folder of the mask tree"""
+    return base_path / ("data_miss_mask_sample" if sampletest else "data_miss_mask")
+
+
+def mask_store_path(base_path, cohort, miss_method, miss_ratio, sampletest=False):
+    """
+    Return the path of the packed store of one (cohort, mechanism, ratio).
+    It sits next to the folder holding the CSV masks, e.g. .../MCAR/miss10.npy
+    """
+    return (
+        mask_root(base_path, sampletest)
+        / f"{cohort}/{cohort}_all/{miss_method}/miss{miss_ratio}.npy"
+    )
+
+
+def create_mask_store(path, columns, n_rows, n_samples, index_files=None):
+    """
+    Create an empty packed store, one slot per sample id.
+
+    Args:
+        path (Path): Path of the .npy store
+        columns (list): Column names of the masks
+        n_rows (int): Number of rows in each mask
+        n_samples (int): Number of masks (sample ids 0..n_samples-1)
+        index_files (list): Sample ids that will be written, when some slots stay
+            empty (default: all of 0..n_samples-1)
+
+    Returns:
+        np.memmap: Writable store of shape (n_samples, n_rows, ceil(n_columns / 8))
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if index_files is None:
+        index_files = range(n_samples)
+    with open(path.with_suffix(".json"), "w") as f:
+        json.dump(
+            {
+                "columns": list(columns),
+                "n_rows": int(n_rows),
+                "index_files": [int(index_file) for index_file in index_files],
+            },
+            f,
+        )
+    return np.lib.format.open_memmap(
+        path,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(n_samples, n_rows, (len(columns) + 7) // 8),
+    )
+
+
+def write_mask(store, index_file, mask):
+    """Bit-pack a boolean mask (True for missing) into the slot of its sample id"""
+    store[int(index_file)] = np.packbits(np.asarray(mask, dtype=bool), axis=1)
+
+
+def open_mask_store(path):
+    """
+    Memory-map a packed store read-only.
+
+    Returns:
+        store (np.memmap), columns (list), index_files (set): the sample ids held
+    """
+    path = Path(path)
+    with open(path.with_suffix(".json")) as f:
+        meta = json.load(f)
+    store = np.load(path, mmap_mode="r")
+    # Stores written before the sample ids were recorded hold every slot
+    index_files = set(meta.get("index_files", range(store.shape[0])))
+    return store, meta["columns"], index_files
+
+
+def load_mask(base_path, cohort, miss_method, miss_ratio, index_file, sampletest=False):
+    """
+    Load one mask as a boolean array (True for missing).
+
+    Only the rows of the requested sample are read from the memory-mapped store and
+    unpacked once; the result is a bool view of the unpacked bytes. Falls back to the
+    CSV mask when the tree has not been converted yet, or when the sample is not in
+    the store.
+
+    Returns:
+        mask (np.ndarray), columns (list)
+    """
+    path = mask_store_path(base_path, cohort, miss_method, miss_ratio, sampletest)
+    csv_path = path.with_suffix("") / f"{index_file}.csv"
+    if path.exists():
+        store, columns, index_files = open_mask_store(path)
+        if int(index_file) in index_files:
+            mask = np.unpackbits(store[int(index_file)], axis=1, count=len(columns))
+            return mask.view(bool), columns
+        # An empty slot would read as all-observed
+        if not csv_path.exists():
+            raise FileNotFoundError(
+                f"Sample {index_file} is neither in the mask store {path} "
+                f"nor at {csv_path}"
+            )
+
+    df_mask = pd.read_csv(csv_path)
+    return df_mask.to_numpy(dtype=bool), list(df_mask.columns)
+
+
+def load_mask_frame(
+    base_path, cohort, miss_method, miss_ratio, index_file, sampletest=False
+):
+    """Load one mask as a boolean DataFrame, the way the CSV masks were used"""
+    mask, columns = load_mask(
+        base_path, cohort, miss_method, miss_ratio, index_file, sampletest
+    )
+    return pd.DataFrame(mask, columns=columns, copy=False)
+
+
+def convert_csv_masks(root, remove_csv=False):
+    """
+    Convert a tree of CSV masks (.../{mechanism}/miss{ratio}/{index_file}.csv) into
+    one packed store per miss{ratio} folder.
+
+    Args:
+        root (Path): Root of the CSV mask tree, e.g. data_stored/data_miss_mask
+        remove_csv (bool): Whether to delete the CSV masks once converted
+    """
+    for folder, _, files in os.walk(root):
+        folder = Path(folder)
+        if not re.fullmatch(r"miss\d+", folder.name):
+            continue
+        index_files = sorted(int(f[:-4]) for f in files if re.fullmatch(r"\d+\.csv", f))
+        if not index_files:
+            continue
+
+        store = None
+        for index_file in index_files:
+            df_mask = pd.read_csv(folder / f"{index_file}.csv")
+            if store is None:
+                store = create_mask_store(
+                    folder.with_suffix(".npy"),
+                    df_mask.columns,
+                    df_mask.shape[0],
+                    index_files[-1] + 1,
+                    index_files,
+                )
+            write_mask(store, index_file, df_mask.to_numpy(dtype=bool))
+        store.flush()
+        del store
+
+        if remove_csv:
+            for index_file in index_files:
+                os.remove(folder / f"{index_file}.csv")
+        print(f"Converted: {folder}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="argparse")
+    parser.add_argument(
+        "--root",
+        "-r",
+        type=str,
+        required=True,
+        help="The root of the CSV mask tree to convert, e.g. data_stored/data_miss_mask.",
+    )
+    parser.add_argument(
+        "--remove_csv",
+        action="store_true",
+        help="Delete the CSV masks once they are converted.",
+    )
+    args = parser.parse_args()
+    convert_csv_masks(Path(args.root), remove_csv=args.remove_csv)
@@ -6,140 +6,378 @@
 @Time        :   2025/02/21 01:02:14
 """
 import os
+import hashlib
 import numpy as np
 import pandas as pd
+from utils.mask_store import load_mask_frame
+from utils.table_store import read_table, table_path
 
 
-def create_category_mappings(column_values):
-    """Create dictionaries to map categorical values to indices and back"""
-    unique_values = list(set([v for v in column_values if str(v) != "nan"]))
+def factorize_categorical(values):
+    """Factorize a categorical column into integer codes (-1 for missing) and its categories"""
+    codes, uniques = pd.factorize(pd.Series(values), sort=False)
+    return codes.astype(np.int32), list(uniques.tolist())
+
+
+def create_category_mappings(codes, categories):
+    """
+    Create dictionaries to map the observed categorical values to indices and back.
+
+    Args:
+        codes (np.ndarray): Integer codes into `categories`, -1 where the value is missing
+        categories (list): All categories of the column
+
+    Returns:
+        value_to_index (dict), index_to_value (dict), and the codes remapped to the
+        observed categories (-1 where the value is missing)
+    """
+    observed = np.flatnonzero(
+        np.bincount(codes[codes >= 0], minlength=len(categories))
+    )
+    lookup = np.full(len(categories) + 1, -1, dtype=np.int32)
+    lookup[observed] = np.arange(len(observed), dtype=np.int32)
+    # codes of -1 pick the trailing -1 of the lookup table
+    local_codes = lookup[codes]
+
+    unique_values = [categories[i] for i in observed]
     value_to_index = {val: idx for idx, val in enumerate(unique_values)}
     index_to_value = {idx: val for idx, val in enumerate(unique_values)}
 
-    return value_to_index, index_to_value
+    return value_to_index, index_to_value, local_codes
 
 
-def encode_categorical(values, mapping):
-    """Encode categorical values using one-hot"""
-    encoded = []
-    dict_size = len(mapping)
+def encode_categorical(codes, out):
+    """Encode categorical codes using one-hot, writing into the preallocated block `out`"""
+    missing = codes < 0
+    rows = np.flatnonzero(~missing)
+    out[:] = 0.0
+    out[rows, codes[rows]] = 1.0
+    out[missing] = np.nan
+    return out
 
-    for val in values:
-        if pd.isna(val):
-            encoded.append([np.nan] * dict_size)
-        else:
-            encoded.append(list(np.eye(dict_size)[mapping[val]]))
 
-    return np.array(encoded, dtype=np.float32)
+def normalize_continuous(values, out, mode="one_hot"):
+    """Normalize continuous values with min-max scaling, writing into the column `out`"""
+    observed = ~np.isnan(values)
 
+    if not observed.any():
+        out[:] = 0.0
+        return out, 0, 0
 
-def normalize_continuous(values, mode="one_hot"):
-    """Normalize continuous values"""
-    values_array = np.array([v for v in values if not pd.isna(v)])
+    max_val = np.max(values[observed])
+    min_val = np.min(values[observed])
 
-    if len(values_array) == 0:
-        return np.zeros((len(values), 1), dtype=np.float32), 0, 0
+    if min_val == max_val:
+        out[:] = 0.0
+        return out, min_val, max_val
 
-    max_val = np.max(values_array)
-    min_val = np.min(values_array)
+    out[:] = (values - min_val) / (max_val - min_val)
+    return out, min_val, max_val
 
-    if min_val == max_val:
-        return np.zeros((len(values), 1), dtype=np.float32), min_val, max_val
 
-    normalized = []
-    for val in values:
-        if pd.isna(val):
-            normalized.append(np.nan)
-        else:
-            norm_val = (val - min_val) / (max_val - min_val)
-            normalized.append(norm_val)
+def segment_argmax(data, offsets, widths):
+    """
+    Argmax inside every one-hot segment of `data` in one pass.
 
-    return np.array(normalized, dtype=np.float32).reshape(-1, 1), min_val, max_val
+    Args:
+        data (np.ndarray): Concatenated one-hot blocks, shape (rows, sum(widths))
+        offsets (np.ndarray): Start of each segment, all widths must be positive
+        widths (np.ndarray): Width of each segment
 
+    Returns:
+        np.ndarray: Index of the first maximum inside each segment, shape (rows, segments)
+    """
+    segment_max = np.maximum.reduceat(data, offsets, axis=1)
+    is_max = data == np.repeat(segment_max, widths, axis=1)
+    position = np.where(is_max, np.arange(data.shape[1]), np.iinfo(np.int64).max)
+    return np.minimum.reduceat(position, offsets, axis=1) - offsets
 
-def processed_data(
-    base_path,
-    cohort,
-    miss_method,
-    miss_ratio,
-    index_file,
-    mode="one_hot",
-    sampletest=False,
+
+def nearest_embedding(values, embedding):
+    """
+    Index of the nearest category embedding (Euclidean distance) of every row.
+
+    Args:
+        values (np.ndarray): Generated embeddings of one column, shape (rows, width)
+        embedding (np.ndarray): Embedding of every category, shape (categories, width)
+
+    Returns:
+        np.ndarray: Category index of every row
+    """
+    # argmin |v - e|^2 = argmax (v.e - |e|^2 / 2), one matrix product for all rows
+    scores = values @ embedding.T - 0.5 * np.sum(embedding**2, axis=1)
+    return np.argmax(scores, axis=1)
+
+
+def return_category_embedding(
+    codes, n_categories, features, feature_pos, embedding_dim
 ):
-    """Process data files and prepare them for imputation"""
-    # Load data
-    # Full data path
-    full_path = base_path / f"Completed_data/{cohort}/{cohort}_all.csv"
-    if sampletest:
-        # Missing data mask path
-        mask_path = (
-            base_path
-            / f"data_miss_mask_sample/{cohort}/{cohort}_all/{miss_method}/miss{miss_ratio}/{index_file}.csv"
-        )
-    else:
-        # Missing data mask path
-        mask_path = (
-            base_path
-            / f"data_miss_mask/{cohort}/{cohort}_all/{miss_method}/miss{miss_ratio}/{index_file}.csv"
-        )
+    """
+    Embedding of the categories of one column, learned from the rest of the data.
+    Every category gets the mean of the other encoded features over its observed rows;
+    the leading principal components of these profiles place categories seen with
+    similar values close together. Each dimension is min-max scaled to [0, 1], the
+    range of the generator output.
 
-    # Load data
-    df_full = pd.read_csv(full_path)
-    df_mask = pd.read_csv(mask_path)
-    df_mask = df_mask.astype(bool)
-    df_miss = df_full.mask(df_mask)
+    Args:
+        codes (np.ndarray): Codes of the observed categories, -1 where the value is missing
+        n_categories (int): Num of observed categories, all of them appear in `codes`
+        features (np.ndarray): Encoded data, NaN where missing, rows x features
+        feature_pos (np.ndarray): Positions of the features the profiles are made of
+        embedding_dim (int): Width of the embedding
 
-    # Identify column types
-    con_cols = [col for col in df_mask.columns if col.startswith("con")]
-    cat_cols = [col for col in df_mask.columns if col.startswith("cat")]
+    Returns:
+        np.ndarray: Embedding of every category, shape (n_categories, embedding_dim)
+    """
+    rows = np.flatnonzero(codes >= 0)
+    order = rows[np.argsort(codes[rows], kind="stable")]
+    starts = np.searchsorted(codes[order], np.arange(n_categories))
+    values = features[np.ix_(order, feature_pos)]
+    observed = ~np.isnan(values)
+    values[~observed] = 0.0
+    # Mean of every feature over the observed rows of each category
+    sums = np.add.reduceat(values, starts, axis=0, dtype=np.float64)
+    counts = np.add.reduceat(observed, starts, axis=0, dtype=np.int64)
+    means = sums / np.maximum(counts, 1)
 
-    # Process all columns
-    column_info_miss = []
-    column_info_full = []
-    feature_boundaries = []
-    current_boundary = 0
-    processed_features = None
+    centered = means - means.mean(axis=0)
+    u, singular, _ = np.linalg.svd(centered, full_matrices=False)
+    embedding = np.zeros((n_categories, embedding_dim))
+    width = min(embedding_dim, len(singular))
+    embedding[:, :width] = u[:, :width] * singular[:width]
 
-    for col in df_full.columns:
-        miss_values = df_miss[col].tolist()
-        full_values = df_full[col].tolist()
+    low, high = embedding.min(axis=0), embedding.max(axis=0)
+    span = np.where(high > low, high - low, 1.0)
+    return ((embedding - low) / span).astype(np.float32)
 
-        if col in cat_cols:
-            # Process categorical column
-            miss_mapping, miss_inverse = create_category_mappings(miss_values)
-            full_mapping, full_inverse = create_category_mappings(full_values)
-            encoded = encode_categorical(miss_values, miss_mapping)
 
+def encode_columns(
+    columns, miss_mask, mode="one_hot", embedding_threshold=20, embedding_dim=8
+):
+    """
+    Encode all columns into a single preallocated float32 matrix.
+
+    Args:
+        columns (list): [name, kind, values, categories] for each column, where kind is
+            "con" (values are floats) or "cat" (values are codes into categories)
+        miss_mask (np.ndarray): Boolean matrix (rows x columns), True where the value is missing
+        mode (str): "one_hot" encodes every categorical column with one-hot, "embedding"
+            encodes the ones with more than `embedding_threshold` observed categories
+            with a learned embedding of `embedding_dim` features instead
+
+    Returns:
+        processed_features, feature_boundaries, column_info_miss, column_info_full
+    """
+    n_rows = miss_mask.shape[0]
+    column_info_miss = []
+    column_info_full = []
+    miss_values = []
+
+    # First pass: build the mappings so the output width is known up front
+    for j, (_, kind, values, categories) in enumerate(columns):
+        if kind == "cat":
+            miss_codes = np.where(miss_mask[:, j], -1, values)
+            miss_mapping, miss_inverse, local_codes = create_category_mappings(
+                miss_codes, categories
+            )
+            full_mapping, full_inverse, _ = create_category_mappings(
+                values, categories
+            )
             column_info_miss.append(["cat", [miss_mapping, miss_inverse]])
             column_info_full.append(["cat", [full_mapping, full_inverse]])
+            miss_values.append(local_codes)
+        else:
+            observed = values[~np.isnan(values)]
+            column_info_full.append(["con", [np.max(observed), np.min(observed)]])
+            column_info_miss.append(None)
+            miss_values.append(np.where(miss_mask[:, j], np.nan, values))
 
-        elif col in con_cols:
-            # Process continuous column
-            encoded, min_val, max_val = normalize_continuous(miss_values, mode)
-            full_min = np.min([v for v in full_values if not pd.isna(v)])
-            full_max = np.max([v for v in full_values if not pd.isna(v)])
+    # High-cardinality columns are embedded, their info is completed below
+    for info in column_info_miss:
+        if (
+            mode == "embedding"
+            and info is not None
+            and len(info[1][0]) > embedding_threshold
+        ):
+            info[0] = "emb"
 
-            column_info_miss.append(["con", [max_val, min_val]])
-            column_info_full.append(["con", [full_max, full_min]])
+    widths = [
+        1 if info is None else embedding_dim if info[0] == "emb" else len(info[1][0])
+        for info in column_info_miss
+    ]
+    feature_boundaries = np.cumsum(widths).tolist()
+    processed_features = np.empty((n_rows, feature_boundaries[-1]), dtype=np.float32)
 
+    # Second pass: write every column straight into its block of the matrix
+    start = 0
+    for j, (_, kind, _, _) in enumerate(columns):
+        end = feature_boundaries[j]
+        if kind == "cat":
+            if column_info_miss[j][0] == "cat":
+                encode_categorical(miss_values[j], processed_features[:, start:end])
         else:
-            # Skip other columns
-            continue
+            _, min_val, max_val = normalize_continuous(
+                miss_values[j], processed_features[:, start]
+            )
+            column_info_miss[j] = ["con", [max_val, min_val]]
+        start = end
 
-        # Update feature array
-        if processed_features is None:
-            processed_features = encoded
-        else:
-            processed_features = np.concatenate((processed_features, encoded), axis=1)
+    # Third pass: learn the embeddings from the one-hot and continuous features
+    embedded = [j for j, info in enumerate(column_info_miss) if info[0] == "emb"]
+    if embedded:
+        boundaries = [0] + feature_boundaries
+        profile_pos = np.concatenate(
+            [
+                np.arange(boundaries[j], boundaries[j + 1])
+                for j in range(len(columns))
+                if j not in embedded
+            ]
+            + [np.zeros(0, dtype=np.int64)]
+        )
+        for j in embedded:
+            codes = miss_values[j]
+            embedding = return_category_embedding(
+                codes,
+                len(column_info_miss[j][1][0]),
+                processed_features,
+                profile_pos,
+                embedding_dim,
+            )
+            column_info_miss[j][1].append(embedding)
+            block = processed_features[:, boundaries[j] : boundaries[j + 1]]
+            block[:] = embedding[np.maximum(codes, 0)]
+            block[codes < 0] = np.nan
 
-        # Update feature boundaries
-        new_boundary = current_boundary + encoded.shape[1]
-        feature_boundaries.append(new_boundary)
-        current_boundary = new_boundary
+    return processed_features, feature_boundaries, column_info_miss, column_info_full
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """Return a short content hash of a file, read in chunks"""
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()[:16]
+
+
+def decode_categories(codes, categories):
+    """Map integer codes (-1 for missing) back to their categorical values"""
+    lookup = pd.Series(categories)
+    if (codes < 0).any():
+        # codes of -1 pick the trailing NaN
+        lookup = pd.concat([lookup, pd.Series([np.nan])], ignore_index=True)
+    return lookup.to_numpy()[codes]
+
+
+def load_encoded_cohort(base_path, cohort):
+    """
+    Load the factorized full cohort, building the on-disk cache on first use.
+
+    The cache is keyed by the content hash of Completed_data/{cohort}/{cohort}_all
+    (CSV, Parquet or Feather), so it is rebuilt automatically whenever the full data changes.
+
+    Args:
+        base_path (Path): Base path containing all the data directories
+        cohort (str): Cohort identifier
+
+    Returns:
+        list: [name, kind, values, categories] for each con/cat column
+    """
+    full_path = table_path(base_path / f"Completed_data/{cohort}/{cohort}_all")
+    cache_dir = base_path / f"encoded_cache/{cohort}"
+    cache_path = cache_dir / f"{cohort}_all_{hash_file(full_path)}.npz"
+
+    if cache_path.exists():
+        columns = []
+        with np.load(cache_path, allow_pickle=True) as cache:
+            for j, (col, kind) in enumerate(
+                zip(cache["column_name"].tolist(), cache["column_kind"].tolist())
+            ):
+                categories = (
+                    cache[f"categories_{j}"].tolist() if kind == "cat" else None
+                )
+                columns.append([col, kind, cache[f"values_{j}"], categories])
+        return columns
+
+    df_full = read_table(full_path)
+    columns = []
+    for col in df_full.columns:
+        if col.startswith("cat"):
+            codes, categories = factorize_categorical(df_full[col])
+            columns.append([col, "cat", codes, categories])
+        elif col.startswith("con"):
+            values = df_full[col].to_numpy(dtype=np.float64, na_value=np.nan)
+            columns.append([col, "con", values, None])
+
+    arrays = {
+        "column_name": np.array([column[0] for column in columns]),
+        "column_kind": np.array([column[1] for column in columns]),
+    }
+    for j, (_, kind, values, categories) in enumerate(columns):
+        arrays[f"values_{j}"] = values
+        if kind == "cat":
+            arrays[f"categories_{j}"] = np.array(categories, dtype=object)
+
+    # Write to a temporary file first so concurrent runs never read a partial cache
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_dir / f"{cache_path.stem}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, cache_path)
+
+    return columns
+
+
+def processed_data(
+    base_path,
+    cohort,
+    miss_method,
+    miss_ratio,
+    index_file,
+    mode="one_hot",
+    sampletest=False,
+    embedding_threshold=20,
+    embedding_dim=8,
+):
+    """
+    Process data files and prepare them for imputation.
+
+    With mode="embedding", categorical columns with more than `embedding_threshold`
+    observed categories are encoded by `embedding_dim` learned features instead of
+    one-hot; their column info is ["emb", [value_to_index, index_to_value, embedding]].
+    """
+    # Load the pre-factorized full data and the mask of this run
+    columns = load_encoded_cohort(base_path, cohort)
+    column_name = pd.Index([column[0] for column in columns])
+    df_mask = load_mask_frame(
+        base_path, cohort, miss_method, miss_ratio, index_file, sampletest=sampletest
+    )
+    df_mask = df_mask[column_name]
+
+    # Apply the mask with NaN-assignment and encode
+    (
+        processed_features,
+        feature_boundaries,
+        column_info_miss,
+        column_info_full,
+    ) = encode_columns(
+        columns,
+        df_mask.to_numpy(dtype=bool),
+        mode=mode,
+        embedding_threshold=embedding_threshold,
+        embedding_dim=embedding_dim,
+    )
+
+    df_full = pd.DataFrame(
+        {
+            col: decode_categories(values, categories) if kind == "cat" else values
+            for col, kind, values, categories in columns
+        }
+    )
+    df_miss = df_full.mask(df_mask)
 
     return (
         processed_features,
-        df_full.columns,
+        column_name,
         feature_boundaries,
         column_info_miss,
         df_full,
@@ -0,0 +1,115 @@
+#!/home/siyi.sun/miniconda3/bin python3
+# -*- coding: UTF-8 -*-
+"""
+@Description :   Per-phase timing and memory records of an imputation run
+@Author      :   siyi.sun
+@Time        :   2025/03/17 21:47:12
+"""
+import os
+import json
+import time
+import cProfile
+import resource
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager
+
+
+def lifetime_peak_rss_mb():
+    """
+    Peak resident set size of this process since it started, in MB (ru_maxrss is in KB
+    on Linux). It never goes down, so it is not the peak of a single phase.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def env_flag(name):
+    """Whether an environment switch such as GAIN_CPROFILE=1 is on"""
+    return os.environ.get(name, "0").lower() not in ("", "0", "false", "no")
+
+
+class Run_profiler:
+    """
+    Records wall time, CPU time and memory of the phases of one run, e.g. data
+    loading, graph construction, every epoch, inference and saving the results.
+    A phase that sets record["batches"] also gets its batches per second.
+
+    Memory is the lifetime peak RSS of the process at the end of the phase
+    (lifetime_peak_rss_mb), and how much the phase raised it (peak_rss_growth_mb, 0
+    when an earlier phase peaked higher). Neither is the peak of the phase alone; the
+    tracemalloc hook below gives that for the Python heap.
+
+    The records are appended to a JSON lines file by finish(). Two optional hooks are
+    switched on by environment variables:
+    - GAIN_CPROFILE=1: cProfile the whole run, saved next to the log as a .prof file
+    - GAIN_TRACEMALLOC=1: peak Python heap allocation of every phase
+    """
+
+    def __init__(self, log_path=None, **context):
+        self.log_path = Path(log_path) if log_path is not None else None
+        # Identifies the run in every record, e.g. cohort, mechanism, ratio, index_file
+        self.context = context
+        self.records = []
+        self.use_cprofile = env_flag("GAIN_CPROFILE")
+        self.use_tracemalloc = env_flag("GAIN_TRACEMALLOC")
+        self.profile = None
+
+    def start(self):
+        if self.use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.use_cprofile:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    @contextmanager
+    def phase(self, name, **extra):
+        record = {"phase": name, **extra}
+        if self.use_tracemalloc and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        rss_start = lifetime_peak_rss_mb()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall_time"] = time.perf_counter() - wall_start
+            record["cpu_time"] = time.process_time() - cpu_start
+            record["lifetime_peak_rss_mb"] = lifetime_peak_rss_mb()
+            # Growth of the peak during this phase, 0 if an earlier phase peaked higher
+            record["peak_rss_growth_mb"] = record["lifetime_peak_rss_mb"] - rss_start
+            if "batches" in record and record["wall_time"] > 0:
+                record["batches_per_second"] = record["batches"] / record["wall_time"]
+            if self.use_tracemalloc and tracemalloc.is_tracing():
+                record["python_heap_peak_mb"] = (
+                    tracemalloc.get_traced_memory()[1] / 1024.0**2
+                )
+            self.records.append(record)
+
+    def return_run_name(self):
+        return "_".join(str(value) for value in self.context.values()) or "run"
+
+    def finish(self):
+        """Stop the hooks and append the records of this run to the JSON lines log"""
+        if self.log_path is not None:
+            self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.profile is not None:
+            self.profile.disable()
+            if self.log_path is not None:
+                self.profile.dump_stats(
+                    self.log_path.with_name(
+                        f"{self.log_path.stem}_{self.return_run_name()}.prof"
+                    )
+                )
+            self.profile = None
+
+        if self.log_path is None:
+            return
+        lines = "".join(
+            json.dumps({**self.context, "pid": os.getpid(), **record}, default=str)
+            + "\n"
+            for record in self.records
+        )
+        # One append per run, so parallel workers do not interleave their lines
+        with open(self.log_path, "a") as f:
+            f.write(lines)
+        self.records = []
@@ -0,0 +1,323 @@
+#!/home/siyi.sun/miniconda3/bin python3
+# -*- coding: UTF-8 -*-
+"""
+@Description :   Columnar storage for the tables of the data_stored tree
+@Author      :   siyi.sun
+@Time        :   2025/03/08 16:05:42
+"""
+import os
+import argparse
+import pandas as pd
+from pathlib import Path
+
+# Table formats, in the order they are preferred when several copies exist
+table_formats = ["parquet", "feather", "csv"]
+
+
+def table_path(path, file_format=None):
+    """
+    Return the path of a table stored in `file_format`, or of the existing copy.
+
+    Args:
+        path (Path): Path of the table with or without suffix, e.g. .../miss10/0.csv
+        file_format (str): "parquet", "feather" or "csv". If None, `path` itself when it
+            exists, else the first existing copy in the order of `table_formats` (the CSV
+            path if none exists).
+
+    Returns:
+        Path: Path of the table
+    """
+    path = Path(path)
+    if file_format is None and path.suffix[1:] in table_formats and path.exists():
+        return path
+    if path.suffix[1:] in table_formats:
+        path = path.with_suffix("")
+    if file_format is not None:
+        return path.with_name(f"{path.name}.{file_format}")
+    for candidate in table_formats:
+        candidate_path = path.with_name(f"{path.name}.{candidate}")
+        if candidate_path.exists():
+            return candidate_path
+    return path.with_name(f"{path.name}.csv")
+
+
+def filter_frame(df, filters):
+    """Apply [(column, op, value), ...] filters (all of them must hold) with pandas"""
+    keep = pd.Series(True, index=df.index)
+    for column, op, value in filters:
+        values = df[column]
+        if op in ("=", "=="):
+            keep &= values == value
+        elif op == "!=":
+            keep &= values != value
+        elif op == "<":
+            keep &= values < value
+        elif op == "<=":
+            keep &= values <= value
+        elif op == ">":
+            keep &= values > value
+        elif op == ">=":
+            keep &= values >= value
+        elif op == "in":
+            keep &= values.isin(value)
+        elif op == "not in":
+            keep &= ~values.isin(value)
+        else:
+            raise ValueError(f"Unsupported filter operator: {op}")
+    return df[keep].reset_index(drop=True)
+
+
+def read_table(path, columns=None, filters=None):
+    """
+    Read a table in whichever format it is stored.
+
+    Args:
+        path (Path): Path of the table, the suffix is resolved with `table_path`
+        columns (list): Columns to read, None for all of them
+        filters (list): [(column, op, value), ...] row filters that must all hold.
+            Parquet pushes them down to the row groups; other formats filter after reading.
+
+    Returns:
+        pd.DataFrame: Table, with the cat_ columns of Parquet/Feather as categoricals
+    """
+    path = table_path(path)
+    file_format = path.suffix[1:]
+    # Columns only needed by the filters are read too and dropped afterwards
+    read_columns = columns
+    if columns is not None and filters:
+        read_columns = list(columns) + [f[0] for f in filters if f[0] not in columns]
+
+    if file_format == "parquet":
+        return pd.read_parquet(path, columns=columns, filters=filters or None)
+    if file_format == "feather":
+        df = pd.read_feather(path, columns=read_columns)
+    else:
+        df = pd.read_csv(path, usecols=read_columns)
+    if filters:
+        df = filter_frame(df, filters)
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def to_categorical(df):
+    """
+    Store the cat_ columns as categoricals. Columns mixing numbers and strings are
+    kept as strings, since a categorical column needs a single type for its categories.
+    """
+    df = df.copy()
+    for column in df.columns:
+        if not column.startswith("cat_") or isinstance(
+            df[column].dtype, pd.CategoricalDtype
+        ):
+            continue
+        values = df[column]
+        if pd.api.types.infer_dtype(values, skipna=True) in ("mixed", "mixed-integer"):
+            values = values.where(values.isna(), values.astype(str))
+        df[column] = values.astype("category")
+    return df
+
+
+def write_table(df, path, file_format=None):
+    """
+    Write a table without its index.
+
+    Args:
+        df (pd.DataFrame): Table to write
+        path (Path): Path of the table, its suffix is replaced by the format's
+        file_format (str): "parquet", "feather" or "csv". If None, the suffix of
+            `path` is used (CSV when it has none).
+
+    Returns:
+        Path: Path the table was written to
+    """
+    path = Path(path)
+    if file_format is None:
+        file_format = path.suffix[1:] if path.suffix[1:] in table_formats else "csv"
+    path = table_path(path, file_format)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    if file_format == "parquet":
+        to_categorical(df).to_parquet(path, index=False)
+    elif file_format == "feather":
+        to_categorical(df).reset_index(drop=True).to_feather(path)
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+
+class Table_appender:
+    """
+    Write a table chunk by chunk, so only one chunk is held in memory.
+
+    CSV chunks are appended to the file, Parquet chunks become row groups and Feather
+    chunks record batches. The chunks of a Parquet/Feather table must share their
+    schema, so the cat_ columns are stored with the fixed categories given for them.
+
+    The chunks go to a temporary file that close() moves onto the path, so a run that
+    stops halfway never leaves a truncated table that looks finished. Used as a context
+    manager, the temporary file is discarded if an exception escapes.
+    """
+
+    def __init__(self, path, file_format=None, categories=None, csv_index=False):
+        """
+        Args:
+            path (Path): Path of the table, its suffix is replaced by the format's
+            file_format (str): "parquet", "feather" or "csv". If None, the suffix of
+                `path` is used (CSV when it has none).
+            categories (dict): All the categories of each cat_ column, for Parquet/Feather
+            csv_index (bool): Whether a CSV keeps the row index as its leading unnamed
+                column, the layout of the Raw_data CSVs. Parquet/Feather never store it.
+        """
+        path = Path(path)
+        if file_format is None:
+            file_format = path.suffix[1:] if path.suffix[1:] in table_formats else "csv"
+        self.file_format = file_format
+        self.csv_index = csv_index
+        self.path = table_path(path, file_format)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        self.categories = {
+            column: self.return_category_values(values)
+            for column, values in (categories or {}).items()
+        }
+        self.writer = None
+        self.schema = None
+        self.num_chunks = 0
+
+    @staticmethod
+    def return_category_values(values):
+        """Unique categories, as strings when they mix numbers and strings (see to_categorical)"""
+        values = pd.Series(values).dropna().drop_duplicates()
+        if pd.api.types.infer_dtype(values, skipna=True) in ("mixed", "mixed-integer"):
+            values = values.astype(str).drop_duplicates()
+        return values.to_numpy()
+
+    def to_fixed_categorical(self, df):
+        df = df.copy()
+        for column, categories in self.categories.items():
+            values = df[column]
+            if categories.dtype == object and pd.api.types.infer_dtype(
+                values, skipna=True
+            ) in ("mixed", "mixed-integer", "integer", "floating"):
+                values = values.where(values.isna(), values.astype(str))
+            df[column] = pd.Categorical(values, categories=categories)
+        return to_categorical(df)
+
+    def append(self, df):
+        """Write the next chunk of rows"""
+        try:
+            self.write_chunk(df)
+        except BaseException:
+            self.discard()
+            raise
+        self.num_chunks += 1
+
+    def write_chunk(self, df):
+        if self.file_format == "csv":
+            df.to_csv(
+                self.tmp_path,
+                index=self.csv_index,
+                mode="w" if self.num_chunks == 0 else "a",
+                header=self.num_chunks == 0,
+            )
+        else:
+            import pyarrow as pa
+
+            table = pa.Table.from_pandas(
+                self.to_fixed_categorical(df), schema=self.schema, preserve_index=False
+            )
+            if self.writer is None:
+                self.schema = table.schema
+                if self.file_format == "parquet":
+                    import pyarrow.parquet as pq
+
+                    self.writer = pq.ParquetWriter(self.tmp_path, self.schema)
+                else:
+                    self.writer = pa.ipc.new_file(
+                        self.tmp_path,
+                        self.schema,
+                        options=pa.ipc.IpcWriteOptions(compression="lz4"),
+                    )
+            self.writer.write_table(table)
+
+    def close(self):
+        """Finish the file, move it onto the path and return the path"""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.tmp_path.exists():
+            os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def discard(self):
+        """Drop the chunks written so far, the path is left untouched"""
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+            self.writer = None
+        if self.tmp_path.exists():
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def convert_csv_tree(root, file_format="parquet", remove_csv=False):
+    """
+    Convert every CSV table under `root` (Completed_data, data_miss, data_mice_store,
+    data_gain, ...) into `file_format`, keeping the folder layout.
+
+    Args:
+        root (Path): Root of the tree to convert, e.g. data_stored
+        file_format (str): "parquet" or "feather"
+        remove_csv (bool): Whether to delete the CSV tables once converted
+    """
+    for folder, _, files in os.walk(root):
+        for file in sorted(files):
+            if not file.endswith(".csv"):
+                continue
+            csv_path = Path(folder) / file
+            # The missing masks are packed by utils.mask_store instead
+            if any(part.startswith("data_miss_mask") for part in csv_path.parts):
+                continue
+            write_table(pd.read_csv(csv_path), csv_path, file_format)
+            if remove_csv:
+                os.remove(csv_path)
+            print(f"Converted: {csv_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="argparse")
+    parser.add_argument(
+        "--root",
+        "-r",
+        type=str,
+        required=True,
+        help="The root of the CSV tree to convert, e.g. data_stored.",
+    )
+    parser.add_argument(
+        "--format",
+        "-f",
+        type=str,
+        default="parquet",
+        choices=["parquet", "feather"],
+        help="The columnar format to convert to.",
+    )
+    parser.add_argument(
+        "--remove_csv",
+        action="store_true",
+        help="Delete the CSV tables once they are converted.",
+    )
+    args = parser.parse_args()
+    convert_csv_tree(
+        Path(args.root), file_format=args.format, remove_csv=args.remove_csv
+    )
@@ -6,8 +6,15 @@
 @Time        :   2025/02/02 09:52:41
 """
 
+import sys
+import argparse
 import pandas as pd
 import numpy as np
+from pathlib import Path
+from wave_mapping import add_wave_columns, month_to_wave, read_csv_chunks, restore_income_columns
+
+sys.path.append(str(Path(__file__).resolve().parents[2] / "Python_code"))
+from utils.table_store import Table_appender, table_formats
 
 def get_wave_number(month_year):
     """
@@ -23,28 +30,7 @@ def get_wave_number(month_year):
     Returns:
         int: Wave number
     """
-    # Convert month names to numbers (1-12)
-    month_to_num = {
-        'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4,
-        'May': 5, 'Jun': 6, 'Jul': 7, 'Aug': 8,
-        'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
-    }
-    
-    # Split the month and year
-    month, year = month_year.split()
-    month_num = month_to_num[month]
-    year = int(year)
-    
-    # Calculate wave within year (1, 2, or 3)
-    wave_in_year = (month_num - 1) // 4 + 1
-    
-    # Calculate total waves since start (2014)
-    waves_before = (year - 2014) * 3
-    
-    # Final wave number
-    wave_number = waves_before + wave_in_year
-    
-    return wave_number
+    return int(month_to_wave(pd.Series([month_year]))[0][0])
 
 # Apply to your dataframe
 def apply_wave_mapping(data):
@@ -57,10 +43,18 @@ def apply_wave_mapping(data):
     Returns:
         pd.DataFrame: Original dataframe with new 'Wave' column
     """
-    data['WAVE_NO'] = data['MONTH'].apply(get_wave_number)
-    return data.drop("MONTH",axis = 1)
+    return add_wave_columns(data).drop("MONTH", axis = 1)
+
+parser = argparse.ArgumentParser(description='argparse')
+parser.add_argument('--format', '-f', type=str, default='csv', choices=table_formats,
+                    help="The format of completed_income_mem.")
+args = parser.parse_args()
 
-income_mem = pd.read_csv("income_mem.csv", header = 0, index_col=0)
-income_mem_na = income_mem.replace([-99],np.nan)
-income_mem_na.dropna(inplace = True)
-apply_wave_mapping(income_mem_na).to_csv("completed_income_mem.csv")
+# Process the file in chunks, so it never has to fit in memory. A CSV keeps the row
+# index of the raw extract as its leading column, as it always did
+appender = Table_appender("completed_income_mem", args.format, csv_index=True)
+for income_mem in read_csv_chunks("income_mem.csv", header = 0, index_col=0):
+    income_mem_na = income_mem.replace([-99],np.nan)
+    income_mem_na.dropna(inplace = True)
+    appender.append(apply_wave_mapping(restore_income_columns(income_mem_na)))
+print(f"Saved {appender.close()}")
@@ -7,14 +7,18 @@
 """
 
 import os
-import pandas as pd
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[2] / "Python_code"))
+from utils.table_store import read_table, write_table, table_formats
 
 def process_csv_files(folder_path, fix_df):
     for filename in os.listdir(folder_path):
-        if filename.endswith(".csv"):
+        if filename.rsplit(".", 1)[-1] in table_formats:
             file_path = os.path.join(folder_path, filename)
-            # Read CSV file
-            df = pd.read_csv(file_path, header=0)
+            # Read the table (CSV, Parquet or Feather)
+            df = read_table(file_path)
             # drop columns
             drop_col = ['con_HH_ID', 'con_MEM_ID']
             df.drop(columns=drop_col, inplace=True)
@@ -32,7 +36,7 @@ def process_csv_files(folder_path, fix_df):
                     'con_INC_OF_MEM_FRM_ALL_SRCS_2', 'con_INC_OF_MEM_FRM_ALL_SRCS_3',
                     'con_INC_OF_MEM_FRM_ALL_SRCS_4']]
             # Save back to the same file (overwrite)
-            df.to_csv(file_path, index=False)
+            write_table(df, file_path)
             print(f"Processed: {file_path}")
 
 
@@ -40,9 +44,8 @@ cohorts = ["C18"]
 mm = ["MCAR", "MAR", "MNAR"]
 mr = [10, 20, 30, 40, 50]
 for cohort in cohorts:
-    fix_df = pd.read_csv(f"/home/siyi.sun/CMIE_Project/data_stored/Completed_data/{cohort}/{cohort}_all.csv",
-                         header=0,
-                         usecols=['cat_GENDER',"cat_EMPLOYMENT_STATUS"])
+    fix_df = read_table(f"/home/siyi.sun/CMIE_Project/data_stored/Completed_data/{cohort}/{cohort}_all",
+                         columns=['cat_GENDER',"cat_EMPLOYMENT_STATUS"])
     for m in mm:
         for r in mr:
             folder_path = f"/home/siyi.sun/CMIE_Project/data_stored/data_miss/{cohort}/{cohort}_all/{m}/miss{r}"
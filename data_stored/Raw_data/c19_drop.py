@@ -7,7 +7,11 @@
 """
 
 import os
-import pandas as pd
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[2] / "Python_code"))
+from utils.table_store import read_table, write_table, table_formats
 
 cohorts = ["C19"]
 mm = ["MNAR"]
@@ -15,10 +19,10 @@ mr = [10, 20, 30, 40, 50]
 
 def process_csv_files(folder_path, fix_df):
     for filename in os.listdir(folder_path):
-        if filename.endswith(".csv"):
+        if filename.rsplit(".", 1)[-1] in table_formats:
             file_path = os.path.join(folder_path, filename)
-            # Read CSV file
-            df = pd.read_csv(file_path, header=0)
+            # Read the table (CSV, Parquet or Feather)
+            df = read_table(file_path)
             # drop columns
             drop_col = [i for i in df.columns if i in ['con_HH_ID', 'con_MEM_ID']]
             df.drop(columns=drop_col, inplace=True)
@@ -26,14 +30,13 @@ def process_csv_files(folder_path, fix_df):
             fix_col = ['cat_GENDER']
             df[fix_col] = fix_df
             # Save back to the same file (overwrite)
-            df.to_csv(file_path, index=False)
+            write_table(df, file_path)
             print(f"Processed: {file_path}")
 
 
 for cohort in cohorts:
-    fix_df = pd.read_csv(f"/home/siyi.sun/CMIE_Project/data_stored/Completed_data/{cohort}/{cohort}_all.csv",
-                         header=0,
-                         usecols=['cat_GENDER'])
+    fix_df = read_table(f"/home/siyi.sun/CMIE_Project/data_stored/Completed_data/{cohort}/{cohort}_all",
+                         columns=['cat_GENDER'])
     for m in mm:
         for r in mr:
             folder_path = f"/home/siyi.sun/CMIE_Project/data_stored/data_miss/{cohort}/{cohort}_all/{m}/miss{r}"
@@ -7,15 +7,19 @@
 """
 
 import os
-import pandas as pd
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[2] / "Python_code"))
+from utils.table_store import read_table, write_table, table_formats
 
 def process_csv_files(folder_path, fix_df):
     for filename in os.listdir(folder_path):
-        if filename.endswith(".csv"):
+        if filename.rsplit(".", 1)[-1] in table_formats:
             file_path = os.path.join(folder_path, filename)
             
-            # Read CSV file
-            df = pd.read_csv(file_path, header=0)
+            # Read the table (CSV, Parquet or Feather)
+            df = read_table(file_path)
             
             # drop columns
             drop_col = [i for i in df.columns if i[:-1] == "con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_" or i in ['con_HH_ID', 'con_MEM_ID', "cat_EMPLOYMENT_STATUS"]]
@@ -26,7 +30,7 @@ def process_csv_files(folder_path, fix_df):
             df[fix_col] = fix_df
             
             # Save back to the same file (overwrite)
-            df.to_csv(file_path, index=False)
+            write_table(df, file_path)
             print(f"Processed: {file_path}")
 
 
@@ -35,9 +39,8 @@ cohorts = ["C19"]
 mm = ["MNAR"]
 mr = [10, 20, 30, 40, 50]
 for cohort in cohorts:
-    fix_df = pd.read_csv(f"/home/siyi.sun/CMIE_Project/data_stored/Completed_data/{cohort}/{cohort}_all.csv",
-                         header=0,
-                         usecols=['con_WAVE_NO', 'cat_STATE', 'cat_HR', 'cat_REGION_TYPE', 'cat_GENDER'])
+    fix_df = read_table(f"/home/siyi.sun/CMIE_Project/data_stored/Completed_data/{cohort}/{cohort}_all",
+                         columns=['con_WAVE_NO', 'cat_STATE', 'cat_HR', 'cat_REGION_TYPE', 'cat_GENDER'])
     for m in mm:
         for r in mr:
             folder_path = f"/home/siyi.sun/CMIE_Project/data_stored/data_miss/{cohort}/{cohort}_all/{m}/miss{r}"
@@ -1,4 +1,23 @@
+import os
+import sys
+import shutil
+import argparse
 import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from wave_mapping import add_wave_columns, read_csv_chunks
+
+sys.path.append(str(Path(__file__).resolve().parents[2] / "Python_code"))
+from utils.table_store import Table_appender, read_table, write_table, table_formats
+
+index_cols = ['WAVE_NO', 'HH_ID', 'MEM_ID', 'Relative_Month']
+
+# List of columns to unstack (excluding the index columns)
+cols_to_unstack = ['TOT_INC', 'INC_OF_HH_FRM_ALL_SRCS', 
+                   'INC_OF_ALL_MEMS_FRM_ALL_SRCS', 'INC_OF_MEM_FRM_ALL_SRCS']
+
+# Months of a wave, every pivoted partition gets all of them
+relative_months = [1, 2, 3, 4]
 
 def transform_data(data_1):
     """
@@ -13,48 +32,12 @@ def transform_data(data_1):
     # Create a copy to avoid modifying original
     df = data_1.copy()
     
-    # 1. Month to Wave mapping
-    def get_wave_number(month_year):
-        month_to_num = {
-            'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4,
-            'May': 5, 'Jun': 6, 'Jul': 7, 'Aug': 8,
-            'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
-        }
-        month, year = month_year.split()
-        month_num = month_to_num[month]
-        year = int(year)
-        wave_in_year = (month_num - 1) // 4 + 1
-        waves_before = (year - 2014) * 3
-        return waves_before + wave_in_year
-    
-    # Add WAVE_NO column
-    df['WAVE_NO'] = df['MONTH'].apply(get_wave_number)
-    
-    # 2. Add Relative_Month column
-    def get_relative_month(month_year):
-        month, _ = month_year.split()
-        # First month of each wave period (Jan, May, Sep)
-        if month in ['Jan', 'May', 'Sep']:
-            return 1
-        # Second month of each wave period (Feb, Jun, Oct)
-        elif month in ['Feb', 'Jun', 'Oct']:
-            return 2
-        # Third month of each wave period (Mar, Jul, Nov)
-        elif month in ['Mar', 'Jul', 'Nov']:
-            return 3
-        # Fourth month of each wave period (Apr, Aug, Dec)
-        else:
-            return 4
-    
-    df['Relative_Month'] = df['MONTH'].apply(get_relative_month)
+    # 1-2. WAVE_NO and Relative_Month, parsing each distinct month string once
+    df = add_wave_columns(df, relative_month=True)
     
     # 3. Set multiindex and unstack
     # First set the multiindex
-    df = df.set_index(['WAVE_NO', 'HH_ID', 'MEM_ID', 'Relative_Month'])
-    
-    # List of columns to unstack (excluding the index columns)
-    cols_to_unstack = ['TOT_INC', 'INC_OF_HH_FRM_ALL_SRCS', 
-                      'INC_OF_ALL_MEMS_FRM_ALL_SRCS', 'INC_OF_MEM_FRM_ALL_SRCS']
+    df = df.set_index(index_cols)
     
     # Unstack the Relative_Month
     df_unstacked = df[cols_to_unstack].unstack('Relative_Month')
@@ -64,5 +47,116 @@ def transform_data(data_1):
     
     return df_unstacked
 
-# Example usage:
-# transformed_data = transform_data(data_1)
\ No newline at end of file
+def flatten_columns(df_unstacked):
+    """
+    Flatten ('TOT_INC', 1) style columns to TOT_INC_1 and move the index back to
+    columns, the columns of income.csv read by join_three_and_split_by_state.py
+    (which adds the con_ prefix).
+    """
+    df_flat = df_unstacked.copy()
+    df_flat.columns = [f'{col}_{month}' for col, month in df_flat.columns]
+    return df_flat.reset_index()
+
+def partition_file(input_path, parts_dir, partition_by='WAVE_NO', n_partitions=16,
+                   chunksize=1_000_000):
+    """
+    Stream the income file once and append each row to the partition of its key, so
+    that every (WAVE_NO, HH_ID, MEM_ID) group ends up whole in a single partition.
+
+    Args:
+        input_path: CSV with columns HH_ID, MEM_ID, MONTH and the income columns
+        parts_dir: Folder of the partition files
+        partition_by: 'WAVE_NO' (one partition per wave) or 'HH_ID' (hash of the household)
+        n_partitions: Num of partitions when partitioning by HH_ID
+        chunksize: Num of rows read at a time
+
+    Returns:
+        list: Paths of the partition files
+    """
+    os.makedirs(parts_dir, exist_ok=True)
+    part_paths = {}
+    for chunk in read_csv_chunks(input_path, chunksize=chunksize, header=0, index_col=0):
+        chunk = add_wave_columns(chunk, relative_month=True)[index_cols + cols_to_unstack]
+        if partition_by == 'WAVE_NO':
+            keys = chunk['WAVE_NO']
+        else:
+            keys = pd.util.hash_pandas_object(chunk['HH_ID'], index=False) % n_partitions
+        for key, part in chunk.groupby(keys.to_numpy(), sort=False):
+            if key not in part_paths:
+                part_paths[key] = os.path.join(parts_dir, f'{partition_by}={key}.csv')
+                part.to_csv(part_paths[key], index=False)
+            else:
+                part.to_csv(part_paths[key], index=False, mode='a', header=False)
+    return [part_paths[key] for key in sorted(part_paths)]
+
+def pivot_partition(part_path, output_dir, file_format='csv'):
+    """Pivot one partition in memory and write it with flattened columns"""
+    part = pd.read_csv(part_path)
+    df_unstacked = part.set_index(index_cols)[cols_to_unstack].unstack('Relative_Month')
+    # A partition may lack some months (e.g. a wave cut short by the input), keep the
+    # same columns in every partition so that they concatenate under one header
+    df_unstacked = df_unstacked.reindex(
+        columns=pd.MultiIndex.from_product([cols_to_unstack, relative_months]))
+    # Missing months are NaN, so the incomes are floats in every partition alike
+    df_unstacked = df_unstacked.astype('float64')
+    output_path = Path(output_dir) / Path(part_path).stem
+    return write_table(flatten_columns(df_unstacked), output_path, file_format)
+
+def transform_file(input_path, output_dir, partition_by='WAVE_NO', n_partitions=16,
+                   chunksize=1_000_000, workers=4, output_file=None, file_format='csv'):
+    """
+    Out-of-core version of transform_data for files larger than memory.
+
+    The input is streamed once into partitions that keep every (WAVE_NO, HH_ID, MEM_ID)
+    group whole, then each partition is pivoted independently in a worker process.
+    Peak memory is bounded by the largest partition times the num of workers.
+
+    Args:
+        input_path: CSV with columns HH_ID, MEM_ID, MONTH and the income columns
+        output_dir: Folder of the pivoted partitions, one table per partition
+        partition_by: 'WAVE_NO' or 'HH_ID' (hash into n_partitions)
+        n_partitions: Num of partitions when partitioning by HH_ID
+        chunksize: Num of rows read at a time
+        workers: Num of partitions pivoted in parallel
+        output_file: If given, the pivoted partitions are also concatenated into this
+            single table, in partition order (sorted by wave when partitioning by WAVE_NO)
+        file_format: Format of the pivoted tables, "csv", "parquet" or "feather"
+
+    Returns:
+        list: Paths of the pivoted partitions
+    """
+    parts_dir = os.path.join(output_dir, '_parts')
+    part_paths = partition_file(input_path, parts_dir, partition_by, n_partitions, chunksize)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        output_paths = list(executor.map(pivot_partition, part_paths,
+                                         [output_dir] * len(part_paths),
+                                         [file_format] * len(part_paths)))
+    shutil.rmtree(parts_dir)
+
+    if output_file is not None:
+        # Append the partitions one after the other, only one is in memory at a time.
+        # A CSV keeps a row index as its leading column, the layout income.csv always had
+        with Table_appender(output_file, file_format, csv_index=True) as appender:
+            n_rows = 0
+            for path in output_paths:
+                part = read_table(path)
+                part.index = pd.RangeIndex(n_rows, n_rows + len(part))
+                appender.append(part)
+                n_rows += len(part)
+    return output_paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='argparse')
+    parser.add_argument('--file', '-f', type=str, required=True, help="The income CSV to pivot.")
+    parser.add_argument('--output_dir', '-o', type=str, required=True, help="The folder of the pivoted partitions.")
+    parser.add_argument('--output_file', type=str, default=None, help="Also concatenate the partitions into this table.")
+    parser.add_argument('--format', type=str, default='csv', choices=table_formats, help="The format of the pivoted tables.")
+    parser.add_argument('--partition_by', type=str, default='WAVE_NO', choices=['WAVE_NO', 'HH_ID'])
+    parser.add_argument('--n_partitions', type=int, default=16, help="Num of HH_ID hash partitions.")
+    parser.add_argument('--chunksize', type=int, default=1_000_000)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    transform_file(args.file, args.output_dir, args.partition_by, args.n_partitions,
+                   args.chunksize, args.workers, args.output_file, args.format)
\ No newline at end of file
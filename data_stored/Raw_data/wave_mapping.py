@@ -0,0 +1,100 @@
+#!/home/siyi.sun/miniconda3/bin python3
+# -*- coding: UTF-8 -*-
+"""
+@Description :   Vectorized mapping of 'Month Year' strings to CMIE waves.
+@Author      :   siyi.sun
+@Time        :   2025/03/12 10:18:55
+"""
+
+import numpy as np
+import pandas as pd
+
+# Convert month names to numbers (1-12)
+month_to_num = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4,
+    'May': 5, 'Jun': 6, 'Jul': 7, 'Aug': 8,
+    'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+}
+
+
+def month_to_wave(month_year):
+    """
+    Convert a 'Month Year' column to wave numbers and months within the wave.
+    Wave 1 starts from Jan 2014, with 3 waves per year.
+    Jan-Apr: Wave 1
+    May-Aug: Wave 2
+    Sep-Dec: Wave 3
+
+    Each distinct string is parsed once: the column is factorized and the wave of every
+    category is computed with integer arithmetic, then gathered back with the codes.
+
+    Args:
+        month_year (pd.Series): Strings in format 'Month Year' (e.g., 'Jan 2014')
+
+    Returns:
+        (np.ndarray, np.ndarray): WAVE_NO and Relative_Month (1-4) of every row
+    """
+    codes, categories = pd.factorize(month_year, sort=False)
+    parts = pd.Series(categories).str.split(n=1, expand=True)
+    if (codes < 0).any() or parts.shape[1] != 2:
+        raise ValueError("MONTH must be a non-missing 'Month Year' string")
+    month_num = parts[0].map(month_to_num)
+    year = pd.to_numeric(parts[1], errors='coerce')
+    invalid = month_num.isna() | year.isna()
+    if invalid.any():
+        raise ValueError(f"Unknown 'Month Year' values: {list(categories[invalid.to_numpy()])}")
+
+    month_num = month_num.to_numpy(dtype=np.int64)
+    year = year.to_numpy(dtype=np.int64)
+    # Calculate total waves since start (2014) plus the wave within year (1, 2, or 3)
+    wave_lookup = (year - 2014) * 3 + (month_num - 1) // 4 + 1
+    # Jan/May/Sep are the first month of a wave, Apr/Aug/Dec the fourth
+    relative_lookup = (month_num - 1) % 4 + 1
+    return wave_lookup[codes], relative_lookup[codes]
+
+
+def add_wave_columns(data, relative_month=False):
+    """
+    Add WAVE_NO (and Relative_Month) to a dataframe with a 'MONTH' column, in place.
+
+    Args:
+        data (pd.DataFrame): DataFrame with 'MONTH' column in 'Month Year' format
+        relative_month (bool): Whether to also add the month within the wave
+
+    Returns:
+        pd.DataFrame: The same dataframe with the new columns
+    """
+    wave_no, relative = month_to_wave(data['MONTH'])
+    data['WAVE_NO'] = wave_no
+    if relative_month:
+        data['Relative_Month'] = relative
+    return data
+
+
+def income_columns(columns, id_columns=('HH_ID', 'MEM_ID')):
+    """Return the income columns, the ones that may hold -99: all but MONTH and `id_columns`"""
+    return [column for column in columns if column != 'MONTH' and column not in id_columns]
+
+
+def read_csv_chunks(path, chunksize=1_000_000, id_columns=('HH_ID', 'MEM_ID'), **kwargs):
+    """
+    Read a CSV in chunks with MONTH as a categorical, so each month string is stored once.
+
+    pandas infers the dtypes of every chunk on its own, so an income column would be
+    int in the chunks without -99 and float in the chunks where -99 becomes NaN, and
+    the chunks would print 5 or 5.0. The income columns are read as float64 in every
+    chunk alike, and cast back with restore_income_columns once -99 rows are dropped.
+    """
+    dtype = kwargs.pop('dtype', {})
+    header = pd.read_csv(path, nrows=0, **kwargs).columns
+    pinned = dict.fromkeys(income_columns(header, id_columns), 'float64')
+    dtype = {**pinned, **dtype, 'MONTH': 'category'} if isinstance(dtype, dict) else dtype
+    return pd.read_csv(path, chunksize=chunksize, dtype=dtype, **kwargs)
+
+
+def restore_income_columns(data, id_columns=('HH_ID', 'MEM_ID')):
+    """
+    Cast the income columns pinned to float64 by read_csv_chunks to nullable Int64, so
+    every chunk writes whole incomes as 5 whether or not it held a -99.
+    """
+    return data.astype(dict.fromkeys(income_columns(data.columns, id_columns), 'Int64'))
@@ -7,22 +7,28 @@
 """
 
 # export PATH="/home/siyi.sun/miniconda3/bin:$PATH"
+import os
+import sys
+import argparse
 import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "Python_code"))
+from utils.table_store import Table_appender, read_table, table_formats
 
 def combine_dataframes(c19_df, income_df):
     """
-    Combine three dataframes using inner joins.
-    
+    Combine one chunk of a cohort with the income table using an inner join.
+    pandas keeps the order of the left keys, so joining the chunks one after the
+    other gives the same rows, in the same order, as joining the whole table.
+
     Args:
-        c19_df: DataFrame with WAVE_NO, HH_ID, MEM_ID
-        income_hh_df: DataFrame with WAVE_NO, HH_ID
-        income_mem_df: DataFrame with WAVE_NO, HH_ID, MEM_ID
-        
+        c19_df: DataFrame chunk with WAVE_NO, HH_ID, MEM_ID
+        income_df: DataFrame with WAVE_NO, HH_ID, MEM_ID
+
     Returns:
-        pandas.DataFrame: Combined dataframe with all matching records
+        pandas.DataFrame: Combined chunk with all matching records
     """
-    print(c19_df.shape)
-
     # merge C19 with income
     # Join on WAVE_NO, HH_ID, and MEM_ID to ensure correct matching
     final_df = c19_df.merge(
@@ -30,42 +36,128 @@ def combine_dataframes(c19_df, income_df):
         on=['WAVE_NO', 'HH_ID', 'MEM_ID'],
         how='inner'
     )
-    print(final_df.shape)
 
     return final_df
 
-def split_and_save_by_state(final_df,C_num,save_url):
+def split_and_save_by_state(final_df, C_num, save_url, state_count, appenders,
+                            file_format='csv', categories=None):
     """
-    Split dataframe by STATE and save each subset with formatted filename.
-    
+    Append every STATE of a chunk to its own table, in a single groupby pass.
+
     Args:
-        final_df: DataFrame containing a 'STATE' column
+        final_df: DataFrame chunk containing a 'cat_STATE' column
+        state_count: Rows written so far for each formatted state, updated in place
+        appenders: Table_appender of each formatted state, updated in place.
+            A state not seen yet in this run starts a new table.
+        file_format: Format of the per-state tables
+        categories: Categories of the cat_ columns, for Parquet/Feather
     """
-    # Get unique states
-    states = final_df['cat_STATE'].unique()
-    state_count = {}
-    
-    # Process each state
-    for state in states:
-        # Create state-specific dataframe
-        state_df = final_df[final_df['cat_STATE'] == state]
-        
+    for state, state_df in final_df.groupby('cat_STATE', sort=False):
         # Format state name for filename:
         # 1. Replace spaces with underscore
-        # 2. Replace & with underscore
-        # 3. Strip any leading/trailing spaces
+        # 2. Strip any leading/trailing spaces
         formatted_state = state.strip().replace(' ', '_')
-        
+
         # Create filename
         filename = f'C{C_num}_{formatted_state}'
-        
+
         # Save the dataframe
-        state_df.to_csv(f'{save_url}{filename}.csv', index=False)
-        state_count[formatted_state] = len(state_df)
-        
-        # Print confirmation
-        print(f"Saved {filename}.csv with {len(state_df)} rows")
-        
+        if formatted_state not in appenders:
+            appenders[formatted_state] = Table_appender(f'{save_url}{filename}', file_format,
+                                                        categories)
+        appenders[formatted_state].append(state_df)
+        state_count[formatted_state] = state_count.get(formatted_state, 0) + len(state_df)
+
+    return state_count
+
+def return_dtype(dtypes):
+    """dtype a full read gives a column that was read in chunks with `dtypes`"""
+    dtypes = set(dtypes)
+    if len(dtypes) == 1:
+        return dtypes.pop()
+    # Ints with NaN in some chunks only, or strings in some chunks only
+    if all(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+           for dtype in dtypes):
+        return 'float64'
+    return 'object'
+
+def scan_cohort(left_path, columns_int, new_columns, chunksize=500_000):
+    """
+    One chunked pass over a cohort, before the join.
+
+    pandas infers the dtypes of every chunk on its own, e.g. an int column with NaN in
+    some chunks only is read as int in the others and would print 5 or 5.0 depending
+    on the chunk. The join reads its chunks with the dtypes of a full read instead.
+    The chunks of a Parquet/Feather table must also share their categories, so all the
+    values of the columns that become cat_ columns are collected, converted like the
+    joined chunks.
+
+    Returns:
+        (dict, dict): dtypes of the cohort columns, categories of each cat_ column
+            under its final name
+    """
+    header = pd.read_csv(left_path, header=0, index_col=0, nrows=0).columns
+    # The cohort columns come first in the join, in the order of new_columns
+    renames = {old: new for old, new in zip(header, new_columns) if new.startswith('cat_')}
+    chunk_dtypes = {column: [] for column in header}
+    values = {column: [] for column in renames}
+    for chunk in pd.read_csv(left_path, header=0, index_col=0, chunksize=chunksize):
+        for column in header:
+            chunk_dtypes[column].append(chunk[column].dtype)
+        for column in renames:
+            values[column].append(chunk[column].drop_duplicates())
+    dtypes = {column: return_dtype(chunk_dtypes[column]) for column in header}
+
+    categories = {}
+    for column, new in renames.items():
+        unique = pd.concat(values[column]).astype(dtypes[column]).drop_duplicates().to_frame()
+        unique = convert_to_int(unique, [c for c in columns_int if c == column])
+        categories[new] = unique[column].drop_duplicates().to_numpy()
+    return dtypes, categories
+
+def join_and_split(left_path, income_df, columns_int, new_columns, C_num, save_url, all_path,
+                   chunksize=500_000, file_format='csv'):
+    """
+    Stream a cohort in chunks: join each chunk with the income table, write it to the
+    full cohort table and append its rows to the per-state tables. Only one chunk of the
+    cohort is in memory at a time.
+
+    Args:
+        left_path: CSV of the cohort (first column is the index)
+        income_df: Income table, held in memory and shared by the cohorts
+        columns_int: Columns converted to int
+        new_columns: Final column names, in order
+        C_num: Cohort number, used in the per-state filenames
+        save_url: Folder of the per-state tables
+        all_path: Path of the full cohort table, its suffix is replaced by the format's
+        chunksize: Num of cohort rows read at a time
+        file_format: Format of the tables, "csv", "parquet" or "feather"
+
+    Returns:
+        dict: Num of rows of each state
+    """
+    os.makedirs(save_url, exist_ok=True)
+    dtypes, categories = scan_cohort(left_path, columns_int, new_columns, chunksize)
+    if file_format == 'csv':
+        categories = None
+    all_appender = Table_appender(all_path, file_format, categories)
+    state_appenders = {}
+    state_count = {}
+    n_rows = 0
+    for chunk in pd.read_csv(left_path, header=0, index_col=0, chunksize=chunksize,
+                             dtype=dtypes):
+        final_chunk = combine_dataframes(chunk, income_df)
+        final_chunk = convert_to_int(final_chunk, columns_int)
+        final_chunk.columns = new_columns
+
+        all_appender.append(final_chunk)
+        split_and_save_by_state(final_chunk, C_num, save_url, state_count, state_appenders,
+                                file_format, categories)
+        n_rows += len(final_chunk)
+
+    print(f"Saved {all_appender.close()} with {n_rows} rows")
+    for formatted_state, count in state_count.items():
+        print(f"Saved {state_appenders[formatted_state].close()} with {count} rows")
     return state_count
 
 def convert_to_int(df, columns_to_convert):
@@ -94,10 +186,16 @@ def convert_to_int(df, columns_to_convert):
     
     return df_copy
 
-c19 = pd.read_csv("Raw_data/complete_data_wo_was_hospitalized.csv", header = 0, index_col = 0)
-c18 = pd.read_csv("Raw_data/complete_data_wo_ts_was.csv", header = 0, index_col = 0)
-c22 = pd.read_csv("Raw_data/complete_data_onehot_was.csv", header = 0, index_col = 0)
-income = pd.read_csv("Raw_data/income.csv", header = 0, index_col = 0)
+parser = argparse.ArgumentParser(description='argparse')
+parser.add_argument('--format', '-f', type=str, default='csv', choices=table_formats,
+                    help="The format of the joined cohorts and of their per-state splits.")
+args = parser.parse_args()
+
+# The cohorts are streamed in chunks; only the income table (in any format) is held in memory
+income = read_table("Raw_data/income")
+# income.csv carries its row index as a leading unnamed column, not part of the join
+if income.columns[0].startswith('Unnamed:'):
+    income = income.iloc[:, 1:]
 columns_int = ['WAVE_NO', 'HH_ID', 'MEM_ID', 'AGE_YRS', 
                        'IS_HOSPITALISED', 'HAS_BANK_AC', 'HAS_MOBILE',
                        'IS_HEALTHY', 'TOT_INC_1', 'TOT_INC_2', 'TOT_INC_3', 'TOT_INC_4',
@@ -107,22 +205,10 @@ columns_int = ['WAVE_NO', 'HH_ID', 'MEM_ID', 'AGE_YRS',
                        'INC_OF_ALL_MEMS_FRM_ALL_SRCS_3', 'INC_OF_ALL_MEMS_FRM_ALL_SRCS_4',
                        'INC_OF_MEM_FRM_ALL_SRCS_1', 'INC_OF_MEM_FRM_ALL_SRCS_2',
                        'INC_OF_MEM_FRM_ALL_SRCS_3', 'INC_OF_MEM_FRM_ALL_SRCS_4']
-new_columns = ['con_WAVE_NO', 'con_HH_ID', 'con_MEM_ID', 'cat_STATE', 'cat_HR', 'cat_REGION_TYPE',
-                 'cat_MEM_STATUS', 'con_AGE_YRS', 'cat_GENDER', 'cat_RELIGION', 'cat_EMPLOYMENT_STATUS',
-                 'cat_PLACE_OF_WORK', 'con_TS_ON_WORK_FOR_EMPLOYER', 'con_TS_ON_TRAVEL',
-                 'con_TS_ON_OUTDOOR_SPORTS', 'cat_IS_HOSPITALISED', 'cat_HAS_BANK_AC', 'cat_HAS_MOBILE',
-                 'cat_IS_HEALTHY', 'con_TOT_INC_1', 'con_TOT_INC_2', 'con_TOT_INC_3', 'con_TOT_INC_4',
-                 'con_INC_OF_HH_FRM_ALL_SRCS_1','con_INC_OF_HH_FRM_ALL_SRCS_2','con_INC_OF_HH_FRM_ALL_SRCS_3', 
-                 'con_INC_OF_HH_FRM_ALL_SRCS_4','con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_1', 
-                 'con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_2','con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_3', 
-                 'con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_4','con_INC_OF_MEM_FRM_ALL_SRCS_1', 
-                 'con_INC_OF_MEM_FRM_ALL_SRCS_2','con_INC_OF_MEM_FRM_ALL_SRCS_3', 'con_INC_OF_MEM_FRM_ALL_SRCS_4']
 
 ################################# C19 #######################################
 print("Start processing C19.")
-final_c19 = combine_dataframes(c19, income)
-final_c19 = convert_to_int(final_c19, columns_int)
-final_c19.columns = ['con_WAVE_NO', 'con_HH_ID', 'con_MEM_ID', 'cat_STATE', 'cat_HR', 'cat_REGION_TYPE',
+columns_c19 = ['con_WAVE_NO', 'con_HH_ID', 'con_MEM_ID', 'cat_STATE', 'cat_HR', 'cat_REGION_TYPE',
                  'cat_MEM_STATUS', 'con_AGE_YRS', 'cat_GENDER', 'cat_RELIGION', 'cat_EMPLOYMENT_STATUS',
                  'cat_PLACE_OF_WORK', 'con_TS_ON_WORK_FOR_EMPLOYER', 'con_TS_ON_TRAVEL',
                  'con_TS_ON_OUTDOOR_SPORTS', 'cat_IS_HOSPITALISED', 'cat_HAS_BANK_AC', 'cat_HAS_MOBILE',
@@ -132,15 +218,13 @@ final_c19.columns = ['con_WAVE_NO', 'con_HH_ID', 'con_MEM_ID', 'cat_STATE', 'cat
                  'con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_2','con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_3', 
                  'con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_4','con_INC_OF_MEM_FRM_ALL_SRCS_1', 
                  'con_INC_OF_MEM_FRM_ALL_SRCS_2','con_INC_OF_MEM_FRM_ALL_SRCS_3', 'con_INC_OF_MEM_FRM_ALL_SRCS_4']
-
-final_c19.to_csv("Completed_data/C19/C19_all.csv", index=False)
-dataset_state_c19 = split_and_save_by_state(final_c19, 19, "Completed_data/C19/STATE/")
+dataset_state_c19 = join_and_split("Raw_data/complete_data_wo_was_hospitalized.csv", income, columns_int,
+                                   columns_c19, 19, "Completed_data/C19/STATE/",
+                                   "Completed_data/C19/C19_all.csv", file_format=args.format)
 
 ################################# C18 #######################################
 print("Start processing C18.")
-final_c18 = combine_dataframes(c18, income)
-final_c18 = convert_to_int(final_c18, columns_int)
-final_c18.columns = ['con_WAVE_NO', 'con_HH_ID', 'con_MEM_ID', 'cat_STATE', 'cat_HR', 'cat_REGION_TYPE',
+columns_c18 = ['con_WAVE_NO', 'con_HH_ID', 'con_MEM_ID', 'cat_STATE', 'cat_HR', 'cat_REGION_TYPE',
                  'cat_MEM_STATUS', 'con_AGE_YRS', 'cat_GENDER', 'cat_RELIGION', 'cat_EMPLOYMENT_STATUS',
                  'cat_PLACE_OF_WORK', 'con_TS_ON_TRAVEL',
                  'con_TS_ON_OUTDOOR_SPORTS', 'cat_IS_HOSPITALISED', 'cat_HAS_BANK_AC', 'cat_HAS_MOBILE',
@@ -150,14 +234,13 @@ final_c18.columns = ['con_WAVE_NO', 'con_HH_ID', 'con_MEM_ID', 'cat_STATE', 'cat
                  'con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_2','con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_3', 
                  'con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_4','con_INC_OF_MEM_FRM_ALL_SRCS_1', 
                  'con_INC_OF_MEM_FRM_ALL_SRCS_2','con_INC_OF_MEM_FRM_ALL_SRCS_3', 'con_INC_OF_MEM_FRM_ALL_SRCS_4']
-
-final_c18.to_csv("Completed_data/C18/C18_all.csv", index=False)
-dataset_state_c18 = split_and_save_by_state(final_c18, 18, "Completed_data/C18/STATE/")
+dataset_state_c18 = join_and_split("Raw_data/complete_data_wo_ts_was.csv", income, columns_int,
+                                   columns_c18, 18, "Completed_data/C18/STATE/",
+                                   "Completed_data/C18/C18_all.csv", file_format=args.format)
 
 ################################# C22 #######################################
 print("Start processing C22.")
-final_c22 = combine_dataframes(c22, income)
-final_c22 = convert_to_int(final_c22, ['WAVE_NO', 'HH_ID', 'MEM_ID', 'AGE_YRS', 
+columns_int_c22 = ['WAVE_NO', 'HH_ID', 'MEM_ID', 'AGE_YRS', 
                        'IS_HOSPITALISED', 'WAS_HOSPITALISED_0','WAS_HOSPITALISED_1', 
                        'WAS_HOSPITALISED_NAN','HAS_BANK_AC', 'HAS_MOBILE',
                        'IS_HEALTHY', 'TOT_INC_1', 'TOT_INC_2', 'TOT_INC_3', 'TOT_INC_4',
@@ -166,8 +249,8 @@ final_c22 = convert_to_int(final_c22, ['WAVE_NO', 'HH_ID', 'MEM_ID', 'AGE_YRS',
                        'INC_OF_ALL_MEMS_FRM_ALL_SRCS_1', 'INC_OF_ALL_MEMS_FRM_ALL_SRCS_2',
                        'INC_OF_ALL_MEMS_FRM_ALL_SRCS_3', 'INC_OF_ALL_MEMS_FRM_ALL_SRCS_4',
                        'INC_OF_MEM_FRM_ALL_SRCS_1', 'INC_OF_MEM_FRM_ALL_SRCS_2',
-                       'INC_OF_MEM_FRM_ALL_SRCS_3', 'INC_OF_MEM_FRM_ALL_SRCS_4'])
-final_c22.columns = ['con_WAVE_NO', 'con_HH_ID', 'con_MEM_ID', 'cat_STATE', 'cat_HR', 'cat_REGION_TYPE',
+                       'INC_OF_MEM_FRM_ALL_SRCS_3', 'INC_OF_MEM_FRM_ALL_SRCS_4']
+columns_c22 = ['con_WAVE_NO', 'con_HH_ID', 'con_MEM_ID', 'cat_STATE', 'cat_HR', 'cat_REGION_TYPE',
                  'cat_MEM_STATUS', 'con_AGE_YRS', 'cat_GENDER', 'cat_RELIGION', 'cat_EMPLOYMENT_STATUS',
                  'cat_PLACE_OF_WORK', 'con_TS_ON_WORK_FOR_EMPLOYER','con_TS_ON_TRAVEL', 
                  'con_TS_ON_OUTDOOR_SPORTS', 'cat_IS_HOSPITALISED', 'cat_WAS_HOSPITALISED_0', 
@@ -178,9 +261,9 @@ final_c22.columns = ['con_WAVE_NO', 'con_HH_ID', 'con_MEM_ID', 'cat_STATE', 'cat
                  'con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_2','con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_3', 
                  'con_INC_OF_ALL_MEMS_FRM_ALL_SRCS_4','con_INC_OF_MEM_FRM_ALL_SRCS_1', 
                  'con_INC_OF_MEM_FRM_ALL_SRCS_2','con_INC_OF_MEM_FRM_ALL_SRCS_3', 'con_INC_OF_MEM_FRM_ALL_SRCS_4']
-
-final_c22.to_csv("Completed_data/C22/C22_all.csv", index=False)
-dataset_state_c22 = split_and_save_by_state(final_c22, 22, "Completed_data/C22/STATE/")
+dataset_state_c22 = join_and_split("Raw_data/complete_data_onehot_was.csv", income, columns_int_c22,
+                                   columns_c22, 22, "Completed_data/C22/STATE/",
+                                   "Completed_data/C22/C22_all.csv", file_format=args.format)
 
 ################################ summary count for each state for each dataset #################
 df_c19 = pd.DataFrame.from_dict(dataset_state_c19, orient='index', columns=["C19"])